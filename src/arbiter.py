@@ -0,0 +1,259 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# I/O arbitration between recording and web downloads sharing the
+# SD card.
+#
+# Downloads take read budget from one token bucket. Its rate follows
+# the mp4 writer backlog: unlimited while the backlog is below
+# ARBITER_BACKLOG_LOW_BYTES, falling to ARBITER_MIN_READ_BYTES_PER_SEC
+# at ARBITER_BACKLOG_HIGH_BYTES.
+# In addition ffmpeg gets a higher and download threads a lower CPU
+# and I/O scheduling class (ionice has effect only with I/O schedulers
+# supporting priorities, e.g. bfq). Thread priorities are set with
+# ioprio_set system call directly, ionice is forked only on machines
+# whose system call numbers are not known here.
+
+import ctypes
+import os
+import platform
+import shutil
+import subprocess
+import threading
+import time
+import logging
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# ionice classes
+IOPRIO_CLASS_REALTIME = 1
+IOPRIO_CLASS_BEST_EFFORT = 2
+IOPRIO_CLASS_IDLE = 3
+
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_WHO_PROCESS = 1
+
+# (ioprio_set, ioprio_get) system call numbers by machine.
+_IOPRIO_SYSCALLS = {
+    'armv6l': (314, 315),
+    'armv7l': (314, 315),
+    'aarch64': (30, 31),
+    'x86_64': (251, 252),
+    'i686': (289, 290),
+}
+
+# Callable returning writer backlog in bytes, set by recorder.
+_backlog_source = None
+
+throttled_sec = metrics.Counter("dashcam_download_throttled_seconds_total",
+                "Time downloads waited for read budget.")
+
+def set_backlog_source(func):
+    global _backlog_source
+    _backlog_source = func
+
+def get_read_rate():
+    # Allowed download bytes per second, None for unlimited.
+    if not config.ARBITER_ENABLED or _backlog_source is None:
+        return None
+    try:
+        backlog = _backlog_source()
+    except Exception as e:
+        logger.debug(e)
+        return None
+
+    low = config.ARBITER_BACKLOG_LOW_BYTES
+    high = config.ARBITER_BACKLOG_HIGH_BYTES
+    if backlog <= low:
+        return None
+    if backlog >= high:
+        return config.ARBITER_MIN_READ_BYTES_PER_SEC
+    # Linear from max at low to min at high.
+    frac = (backlog - low) / float(high - low)
+    return (config.ARBITER_MAX_READ_BYTES_PER_SEC - frac
+            * (config.ARBITER_MAX_READ_BYTES_PER_SEC
+            - config.ARBITER_MIN_READ_BYTES_PER_SEC))
+
+def get_background_rate(limit):
+    # Read rate for background jobs (tiering, scrubbing): at most
+    # limit and never more than downloads get.
+    rate = get_read_rate()
+    if rate is None or rate > limit:
+        return limit
+    return rate
+
+class TokenBucket:
+    # Shared by all readers, rate is re-evaluated on every acquire().
+    def __init__(self, rate_func=get_read_rate,
+                burst_bytes=config.ARBITER_BURST_BYTES):
+        self._rate_func = rate_func
+        self._burst = burst_bytes
+        self._tokens = burst_bytes
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, nbytes):
+        # Blocks until nbytes may be read.
+        while True:
+            rate = self._rate_func()
+            with self._lock:
+                now = time.monotonic()
+                if rate is None:
+                    self._tokens = self._burst
+                    self._last = now
+                    return
+                self._tokens = min(self._burst,
+                                self._tokens + (now - self._last) * rate)
+                self._last = now
+                # Requests bigger than burst go through once bucket
+                # is full, leaving it in debt.
+                if self._tokens >= min(nbytes, self._burst):
+                    self._tokens -= nbytes
+                    return
+                wait = (min(nbytes, self._burst) - self._tokens) / rate
+            # Re-check at least every 100 ms as backlog changes.
+            wait = min(wait, 0.1)
+            throttled_sec.inc(wait)
+            time.sleep(wait)
+
+downloads = TokenBucket()
+
+_ionice = shutil.which("ionice")
+_nice = shutil.which("nice")
+
+_ioprio_syscalls = _IOPRIO_SYSCALLS.get(platform.machine())
+_libc = None
+if _ioprio_syscalls is not None:
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        pass
+
+# Priorities a thread had before deprioritize_current_thread(), I/O
+# and CPU are kept apart as only I/O can always be restored.
+_thread_state = threading.local()
+# Saved I/O priority of a thread lowered by forking ionice, which can't
+# be restored.
+_IOPRIO_UNKNOWN = -1
+
+def _ioprio_syscall(nr, *args):
+    ret = _libc.syscall(nr, *args)
+    if ret < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return ret
+
+def get_io_priority(tid):
+    # Raw ioprio value of thread, None when not available.
+    if _libc is None:
+        return None
+    try:
+        return _ioprio_syscall(_ioprio_syscalls[1], _IOPRIO_WHO_PROCESS,
+                            tid)
+    except OSError as e:
+        logger.debug("ioprio_get %s failed: %s", tid, e)
+        return None
+
+def _set_raw_io_priority(tid, ioprio):
+    try:
+        _ioprio_syscall(_ioprio_syscalls[0], _IOPRIO_WHO_PROCESS, tid,
+                        ioprio)
+        return True
+    except OSError as e:
+        logger.debug("ioprio_set %s failed: %s", tid, e)
+        return False
+
+def set_io_priority(pid, io_class, level=None):
+    # pid may also be a thread id from threading.get_native_id()
+    if _libc is not None:
+        if level is None or io_class == IOPRIO_CLASS_IDLE:
+            level = 0
+        return _set_raw_io_priority(pid,
+                            (io_class << _IOPRIO_CLASS_SHIFT) | level)
+    if _ionice is None:
+        return False
+    cmd = [_ionice, "-c", str(io_class)]
+    if level is not None and io_class != IOPRIO_CLASS_IDLE:
+        cmd += ["-n", str(level)]
+    cmd += ["-p", str(pid)]
+    try:
+        subprocess.check_call(cmd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+        return True
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.debug("ionice %s failed: %s", pid, e)
+        return False
+
+def set_cpu_priority(pid, nice):
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, nice)
+        return True
+    except OSError as e:
+        # Raising priority needs root.
+        logger.debug("setpriority %s failed: %s", pid, e)
+        return False
+
+def recording_command_prefix():
+    # Prefix for ffmpeg command line of mp4 writer, ionice and nice 
+    # exec the command so priority is set without delaying it.
+    if not config.ARBITER_ENABLED:
+        return []
+    prefix = []
+    if _ionice:
+        io_class, level = config.ARBITER_RECORD_IONICE
+        prefix += [_ionice, "-c", str(io_class), "-n", str(level)]
+    if _nice and config.ARBITER_RECORD_NICE < 0 and os.geteuid() == 0:
+        prefix += [_nice, "-n", str(config.ARBITER_RECORD_NICE)]
+    return prefix
+
+def deprioritize_current_thread():
+    # Called by web interface threads before serving a file, and by
+    # background threads. Each of I/O and CPU priority is lowered once 
+    # until restore_current_thread().
+    if not config.ARBITER_ENABLED:
+        return
+    tid = threading.get_native_id()
+    if getattr(_thread_state, 'ioprio', None) is None:
+        ioprio = get_io_priority(tid)
+        if set_io_priority(tid, *config.ARBITER_DOWNLOAD_IONICE):
+            _thread_state.ioprio = (_IOPRIO_UNKNOWN if ioprio is None 
+                                    else ioprio)
+    if getattr(_thread_state, 'nice', None) is None:
+        try:
+            nice = os.getpriority(os.PRIO_PROCESS, tid)
+        except OSError:
+            return
+        if set_cpu_priority(tid, config.ARBITER_DOWNLOAD_NICE):
+            _thread_state.nice = nice
+
+def restore_current_thread():
+    # Called at the end of every web request: a keep-alive connection
+    # serves following requests on the same thread.
+    tid = threading.get_native_id()
+    ioprio = getattr(_thread_state, 'ioprio', None)
+    if ioprio is not None and ioprio != _IOPRIO_UNKNOWN:
+        _set_raw_io_priority(tid, ioprio)
+        _thread_state.ioprio = None
+    # Raising CPU priority back needs root, without it the thread
+    # stays lowered and is not lowered again.
+    nice = getattr(_thread_state, 'nice', None)
+    if nice is not None and set_cpu_priority(tid, nice):
+        _thread_state.nice = None
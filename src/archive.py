@@ -0,0 +1,147 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Uncompressed tar archive of several records, built on the fly.
+#
+# Layout of the archive is computed from the member list alone: for
+# each member a 512 byte ustar header, its data and zero padding to a
+# multiple of 512 bytes, then two zero blocks. So size and ETag are
+# known before sending, any byte range maps to headers (in memory) and
+# file ranges (sent with sendfile) and the same selection gives the
+# same bytes again for resuming.
+
+import collections
+import hashlib
+import os
+import tarfile
+from datetime import datetime
+
+import config
+import catalog
+import protect
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+_END_OF_ARCHIVE = bytes(2 * BLOCK_SIZE)
+
+# path - file to send, name - name in archive
+Member = collections.namedtuple('Member', ['name', 'path', 'size', 'mtime'])
+
+# Accepted formats of from/to times, datetime-local input gives the
+# first one.
+_TIME_FORMATS = ("%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S",
+                "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d_%H-%M-%S")
+
+def parse_time(text):
+    # datetime from query parameter, ValueError when not understood.
+    for fmt in _TIME_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Bad time: " + text)
+
+def select_members(start=None, end=None, names=None, exclude=()):
+    # Records overlapping [start, end] or named ones, each followed by
+    # its summary when present, oldest first.
+    selected = []
+    for path in protect.all_record_paths():
+        name = os.path.basename(path)
+        if name in exclude:
+            continue
+        if names is not None and name not in names:
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        rec_start = catalog.parse_start_time(name)
+        if rec_start is None:
+            continue
+        rec_end = datetime.fromtimestamp(st.st_mtime)
+        if start is not None and rec_end < start:
+            continue
+        if end is not None and rec_start > end:
+            continue
+        selected.append((rec_start, name, path, st))
+
+    members = []
+    for rec_start, name, path, st in sorted(selected):
+        members.append(Member(name, path, st.st_size, int(st.st_mtime)))
+        summary = catalog.summary_path(path)
+        try:
+            sst = os.stat(summary)
+        except OSError:
+            continue
+        members.append(Member(os.path.basename(summary), summary,
+                            sst.st_size, int(sst.st_mtime)))
+    return members
+
+def tar_header(member):
+    info = tarfile.TarInfo(member.name)
+    info.size = member.size
+    info.mtime = member.mtime
+    info.mode = 0o644
+    info.type = tarfile.REGTYPE
+    return info.tobuf(tarfile.USTAR_FORMAT)
+
+class TarLayout:
+    # Byte layout of the archive of given members.
+    def __init__(self, members):
+        self.members = members
+        # (offset, length, bytes or None, member or None)
+        self._parts = []
+        offset = 0
+        for m in members:
+            header = tar_header(m)
+            self._add(offset, header, None)
+            offset += len(header)
+            self._add(offset, None, m)
+            offset += m.size
+            pad = -m.size % BLOCK_SIZE
+            if pad:
+                self._add(offset, bytes(pad), None)
+                offset += pad
+        self._add(offset, _END_OF_ARCHIVE, None)
+        self.size = offset + len(_END_OF_ARCHIVE)
+
+        h = hashlib.sha1()
+        for m in members:
+            h.update("{0} {1} {2}\n".format(m.name, m.size,
+                                            m.mtime).encode('utf-8'))
+        self.etag = '"' + h.hexdigest()[:20] + '"'
+
+    def _add(self, offset, data, member):
+        length = len(data) if data is not None else member.size
+        self._parts.append((offset, length, data, member))
+
+    def iter_range(self, first, last):
+        # Yields (bytes, None, 0, n) for in-memory parts and (None,
+        # member, file offset, n) for file parts covering first to last
+        # (inclusive).
+        for offset, length, data, member in self._parts:
+            end = offset + length
+            if end <= first or length == 0:
+                continue
+            if offset > last:
+                break
+            lo = max(first, offset) - offset
+            hi = min(last + 1, end) - offset
+            if data is not None:
+                yield data[lo:hi], None, 0, hi - lo
+            else:
+                yield None, member, lo, hi - lo
@@ -0,0 +1,163 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Recording under concurrent downloads, with and without arbiter.
+#
+# MP4Writer is fed synthetic h264 at frame rate while --readers
+# threads read large files from the same directory the way web
+# interface sends records (page cache of the files is dropped before
+# every pass so reads hit the card). Reported per run:
+#   record_mbps_min/avg - bytes taken from writer queue by the
+#       backend per second
+#   backlog_max_bytes - highest writer backlog sampled
+#   download_mbps - total read throughput of readers
+#   throttled_sec - time readers waited for arbiter
+#
+# Run from src directory with --dir on the SD card:
+# > python3 bench/bench_arbiter.py --dir /home/pi/bench --duration 30
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+MB = 1024 * 1024
+CHUNK = 64 * 1024
+
+def _make_download_files(directory, count, size_mb):
+    paths = []
+    block = os.urandom(MB)
+    for i in range(count):
+        path = "{0}/download_{1}.bin".format(directory, i)
+        if not os.path.exists(path) or os.path.getsize(path) != size_mb * MB:
+            with open(path, 'wb') as f:
+                for j in range(size_mb):
+                    f.write(block)
+                f.flush()
+                os.fsync(f.fileno())
+        paths.append(path)
+    return paths
+
+def _reader(path, stop, counts, index, use_arbiter):
+    import arbiter
+    if use_arbiter:
+        arbiter.deprioritize_current_thread()
+    while not stop.is_set():
+        with open(path, 'rb', buffering=0) as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            while not stop.is_set():
+                if use_arbiter:
+                    arbiter.downloads.acquire(CHUNK)
+                d = f.read(CHUNK)
+                if len(d) == 0:
+                    break
+                counts[index] += len(d)
+
+def run(args, use_arbiter, download_paths):
+    import fakecam
+    import mp4writer
+    import arbiter
+
+    config.ARBITER_ENABLED = use_arbiter
+    config.WRITER_BACKEND = args.backend
+    gen = fakecam.H264Generator(args.width, args.height, args.fps,
+                                args.bitrate, args.fps)
+    frames = [gen.next() for i in range(args.fps * 10)]
+
+    filepath = args.dir + "/bench_arbiter.mp4"
+    writer = mp4writer.MP4Writer(filepath=filepath, fps=args.fps)
+    arbiter.set_backlog_source(writer.get_backlog_bytes)
+
+    stop = threading.Event()
+    counts = [0] * len(download_paths)
+    readers = [threading.Thread(target=_reader,
+                    args=(p, stop, counts, i, use_arbiter))
+                for i, p in enumerate(download_paths)]
+    throttled_start = arbiter.throttled_sec.get()
+    for t in readers:
+        t.start()
+
+    samples = []
+    backlog_max = 0
+    last_size = 0
+    start = time.monotonic()
+    next_sample = start + 1
+    n_frames = int(args.duration * args.fps)
+    for i in range(n_frames):
+        delay = start + i / float(args.fps) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        for frame_type, data in frames[i % len(frames)]:
+            writer.write(data)
+        backlog_max = max(backlog_max, writer.get_backlog_bytes())
+        if time.monotonic() >= next_sample:
+            next_sample += 1
+            size = writer.get_stats()['bytes_written']
+            samples.append(size - last_size)
+            last_size = size
+    elapsed = time.monotonic() - start
+
+    stop.set()
+    for t in readers:
+        t.join()
+    writer.close()
+    writer.wait()
+    arbiter.set_backlog_source(None)
+
+    # First second includes ffmpeg start.
+    rates = [s / float(MB) for s in samples[1:]] or [0.0]
+    return {
+        'arbiter': use_arbiter,
+        'record_mbps_min': round(min(rates), 2),
+        'record_mbps_avg': round(sum(rates) / len(rates), 2),
+        'backlog_max_bytes': backlog_max,
+        'download_mbps': round(sum(counts) / float(MB) / elapsed, 2),
+        'throttled_sec': round(arbiter.throttled_sec.get()
+                            - throttled_start, 2)
+    }
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", required=True,
+                help="Directory on the card under test")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--readers", type=int, default=2)
+    parser.add_argument("--file-mb", type=int, default=256,
+                help="Size of each download file")
+    parser.add_argument("--backend", default="raw")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--bitrate", type=int, default=17000000)
+    parser.add_argument("--mode", default="off,on",
+                help="Arbiter off and/or on")
+    args = parser.parse_args(argv)
+
+    paths = _make_download_files(args.dir, args.readers, args.file_mb)
+    results = [run(args, mode == "on", paths)
+                for mode in args.mode.split(',')]
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,196 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# BLE location writes, thread per write against latest value
+# dispatcher.
+#
+# No D-Bus needed: the body of LocationSpeedChrc.WriteValue is run
+# in a loop the way the main loop calls it, and a consumer thread
+# stands in for the recorder taking one location per --poll seconds,
+# from the command queue (thread per write) or from its latest value
+# slot (dispatcher). Reported per mode:
+#   callbacks_per_sec - WriteValue calls the main loop got through
+#       when writes arrive back to back
+#   delivered - locations the recorder got
+#   backlog_max - highest number of locations waiting for recorder
+#   age_max_ms - oldest location the recorder took, from write to
+#       being taken
+#
+# Run from src directory:
+# > python3 bench/bench_ble_dispatch.py --rate 10 --duration 10
+
+import argparse
+import json
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+_SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _SRC)
+sys.path.insert(0, _SRC + "/ble")
+
+import location_speed
+from dispatch import Dispatcher
+from command import Command
+
+# Speed, location and heading present.
+_FLAGS = 0x0001 | 0x0004 | 0x0010
+
+def _packet(i):
+    return struct.pack('<HHiiH', _FLAGS, 1000 + i % 100,
+                    515000000 + i, -1000000 + i, 9000)
+
+class _ThreadPerWrite:
+    # Previous WriteValue: parse, then a new thread putting a command
+    # on the queue.
+    def __init__(self):
+        self._cmd_q = queue.Queue()
+
+    def write(self, value):
+        loc = location_speed.LocationSpeed(bytes(value))
+        threading.Thread(target=self._cb, args=(loc,)).start()
+
+    def _cb(self, loc):
+        self._cmd_q.put(Command(Command.CMD_SET_LOCATION_SPEED, loc))
+
+    def backlog(self):
+        return self._cmd_q.qsize()
+
+    def take(self):
+        try:
+            return self._cmd_q.get(block=False).data
+        except queue.Empty:
+            return None
+
+class _Dispatched:
+    # Current WriteValue and recorder.set_location().
+    def __init__(self):
+        self._slot = None
+        self._lock = threading.Lock()
+        self._dispatcher = Dispatcher("bench", self._on_value)
+
+    def write(self, value):
+        self._dispatcher.post(bytes(value))
+
+    def _on_value(self, value):
+        loc = location_speed.LocationSpeed(value)
+        with self._lock:
+            self._slot = loc
+
+    def backlog(self):
+        return 0 if self._slot is None else 1
+
+    def take(self):
+        with self._lock:
+            loc = self._slot
+            self._slot = None
+        return loc
+
+def _throughput(mode, count):
+    # Writes back to back, consumer drains immediately.
+    target = mode()
+    stop = threading.Event()
+
+    def drain():
+        while not stop.is_set():
+            if target.take() is None:
+                time.sleep(0.01)
+
+    th = threading.Thread(target=drain)
+    th.start()
+    packets = [_packet(i) for i in range(count)]
+    t0 = time.perf_counter()
+    for p in packets:
+        target.write(p)
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    th.join()
+    return count / elapsed
+
+class _Timed(location_speed.LocationSpeed):
+    # Parsed value remembers when it was written.
+    __slots__ = ('written',)
+    sent = {}
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.written = _Timed.sent[bytes(data)]
+
+def _paced(mode, rate, duration, poll):
+    # Writes at rate, recorder takes one location per poll.
+    stop = threading.Event()
+    result = {'delivered': 0, 'backlog_max': 0, 'age_max_ms': 0.0}
+    original = location_speed.LocationSpeed
+    location_speed.LocationSpeed = _Timed
+    target = mode()
+
+    def recorder():
+        while not stop.is_set():
+            result['backlog_max'] = max(result['backlog_max'],
+                                        target.backlog())
+            loc = target.take()
+            if loc is not None:
+                age = time.monotonic() - loc.written
+                result['age_max_ms'] = max(result['age_max_ms'],
+                                        age * 1000)
+                result['delivered'] += 1
+            time.sleep(poll)
+
+    th = threading.Thread(target=recorder)
+    th.start()
+    try:
+        t_end = time.monotonic() + duration
+        i = 0
+        while time.monotonic() < t_end:
+            p = _packet(i)
+            _Timed.sent[p] = time.monotonic()
+            target.write(p)
+            i += 1
+            time.sleep(1.0 / rate)
+    finally:
+        stop.set()
+        th.join()
+        location_speed.LocationSpeed = original
+    result['writes'] = i
+    result['age_max_ms'] = round(result['age_max_ms'], 1)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=5000,
+                        help="Writes for callback throughput")
+    parser.add_argument("--rate", type=float, default=10,
+                        help="Location writes per second")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--poll", type=float, default=1.0,
+                        help="Recorder command poll interval")
+    args = parser.parse_args()
+
+    results = {}
+    for name, mode in (("thread_per_write", _ThreadPerWrite),
+                    ("dispatcher", _Dispatched)):
+        r = {'callbacks_per_sec': round(_throughput(mode, args.count))}
+        r.update(_paced(mode, args.rate, args.duration, args.poll))
+        results[name] = r
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
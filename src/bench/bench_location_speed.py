@@ -0,0 +1,160 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# BLE Location and Speed decoding, previous builder based parser
+# against compiled layouts of location_speed.
+#
+# Packets with a few typical flag combinations are decoded by both,
+# results are compared field by field first. Reported per flags:
+#   legacy_us / decode_us / batch_us - microseconds per packet,
+#       best of three runs
+#
+# Run from src directory:
+# > python3 bench/bench_location_speed.py --count 20000
+
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+
+_SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _SRC)
+sys.path.insert(0, _SRC + "/ble")
+
+import util
+import location_speed
+
+_FIELDS = ('flags', 'ispeed', 'total_distance', 'latitude', 'longitude',
+        'elevation', 'heading', 'rolling_time', 'utc_time',
+        'position_status', 'speed_distance_fmt', 'elevation_source',
+        'heading_source')
+
+# Parser as it was before compiled layouts.
+def _build_ispeed(obj, flags, data):
+    obj.ispeed = util.unpack_uint16(data, 10**-2, 2)
+    return 2
+
+def _build_total_distance(obj, flags, data):
+    obj.total_distance = util.unpack_uint24(data, 10**-1, 1)
+    return 3
+
+def _build_location(obj, flags, data):
+    obj.latitude = util.unpack_sint32(data, 10**-7, 7)
+    obj.longitude = util.unpack_sint32(data[4:8], 10**-7, 7)
+    return 8
+
+def _build_elevation(obj, flags, data):
+    obj.elevation = util.unpack_sint24(data, 10**-2, 2)
+    return 3
+
+def _build_heading(obj, flags, data):
+    obj.heading = util.unpack_uint16(data, 10**-2, 2)
+    return 2
+
+def _build_rolling_time(obj, flags, data):
+    obj.rolling_time = data[0]
+    return 1
+
+def _build_utc_time(obj, flags, data):
+    obj.utc_time = util.unpack_ble_gatt_datetime(data)
+    return 7
+
+_builder_index = [_build_ispeed, _build_total_distance, _build_location,
+                _build_elevation, _build_heading, _build_rolling_time,
+                _build_utc_time] + [None] * 9
+
+class _LegacyLocationSpeed():
+    def __init__(self, data):
+        flags = struct.unpack("<H", data[0:2])[0]
+        self.flags = flags
+        offset = 2
+        for i in range(0,7):
+            if (flags & (1<<i)) != 0:
+                if _builder_index[i]:
+                    offset += _builder_index[i](self, flags, data[offset:])
+        self.position_status = (flags >> 7) & 0x3
+        self.speed_distance_fmt = (flags >> 9) & 0x1
+        self.elevation_source = (flags >> 10) & 0x3
+        self.heading_source = (flags >> 12) & 0x1
+
+def _packet(flags, i):
+    data = struct.pack('<H', flags)
+    if flags & 0x01:
+        data += struct.pack('<H', (1234 + i) & 0xffff)
+    if flags & 0x02:
+        data += struct.pack('<I', 5000000 + i)[0:3]
+    if flags & 0x04:
+        data += struct.pack('<ii', 515012345 + i, -1234567 - i)
+    if flags & 0x08:
+        data += struct.pack('<i', -12345 - i)[0:3]
+    if flags & 0x10:
+        data += struct.pack('<H', (9000 + i) % 36000)
+    if flags & 0x20:
+        data += bytes([i & 0xff])
+    if flags & 0x40:
+        data += struct.pack('<HBBBBB', 2020, 1 + i % 12, 1 + i % 28,
+                            i % 24, i % 60, i % 60)
+    return data
+
+def _check(packets):
+    for p in packets:
+        a = _LegacyLocationSpeed(p)
+        b = location_speed.LocationSpeed(p)
+        for f in _FIELDS:
+            if getattr(a, f, None) != getattr(b, f, None):
+                raise SystemExit("Mismatch {0} in {1}: {2} != {3}".format(
+                        f, p.hex(), getattr(a, f, None), getattr(b, f, None)))
+
+def _time_us(fn, packets):
+    # Best of three runs.
+    best = None
+    for _ in range(3):
+        t0 = time.perf_counter()
+        fn(packets)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1e6 / len(packets), 2)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=20000,
+                        help="Packets decoded per flags value")
+    args = parser.parse_args()
+
+    results = {}
+    # Speed+location+heading (phone apps), everything, speed only.
+    for flags in (0x0015, 0x007f, 0x0001):
+        packets = [_packet(flags, i) for i in range(args.count)]
+        _check(packets)
+        legacy = _time_us(lambda ps: [_LegacyLocationSpeed(p) for p in ps],
+                        packets)
+        decode = _time_us(lambda ps: [location_speed.LocationSpeed(p)
+                                    for p in ps], packets)
+        batch = _time_us(location_speed.decode_batch, packets)
+        results["0x{0:04x}".format(flags)] = {
+            'legacy_us': legacy,
+            'decode_us': decode,
+            'batch_us': batch,
+            'speedup': round(legacy / batch, 2),
+        }
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
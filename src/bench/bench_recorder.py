@@ -0,0 +1,298 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Recording pipeline benchmark. Runs every combination of given
+# parameters as a separate process (so that peak RSS is per scenario)
+# and prints results as json.
+#
+# Mode "writer" feeds synthetic h264 from fakecam.H264Generator into
+# MP4Writer as fast as it accepts (or at frame rate with --realtime):
+#   throughput_mbps - bytes written by writer / time until file is
+#       finalized
+#   write_latency_* - time spent in MP4Writer.write() per call
+#   finalize_sec - time from close() until the file is finished
+#   output_* - record file write sizes and throughput when written in
+#       blocks (ffmpeg-pipe and raw backends, --block-bytes)
+# Mode "loop" runs recorder loop with fake hardware backend for a few
+# short segments:
+#   segment_gap_* - time between stop_recording() of a segment and
+#       start_recording() of the next one
+#   frames_dropped - from segment summaries
+# Both report peak RSS of this process and of ffmpeg and CPU seconds
+# (this process and ffmpeg) per MB of video.
+#
+# Run from src directory, ffmpeg must be installed for ffmpeg backend:
+# > python3 bench/bench_recorder.py --profile 1080p30,720p30 \
+#       --backend ffmpeg,raw --bio-size 262144,1048576 -o results.json
+# > python3 bench/bench_recorder.py --backend ffmpeg-pipe,raw \
+#       --block-bytes 0,4194304 --dir /path/on/sd/card
+
+import argparse
+import itertools
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+# name: (width, height, fps, bitrate)
+PROFILES = {
+    '1080p30': (1920, 1080, 30, 17000000),
+    '720p30': (1280, 720, 30, 10000000)
+}
+
+MB = 1024 * 1024
+
+def _csv(type_):
+    return lambda v: [type_(x) for x in v.split(',')]
+
+def _percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def _resource_usage():
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_rss_kb': me.ru_maxrss,
+        'children_peak_rss_kb': children.ru_maxrss,
+        'cpu_sec': (me.ru_utime + me.ru_stime
+                    + children.ru_utime + children.ru_stime)
+    }
+
+def _apply_tunables(params, records_dir):
+    import mp4writer
+    config.update_records_location(records_dir)
+    config.WRITER_BACKEND = params['backend']
+    mp4writer.MP4Writer.MAX_VIDEO_BIO_SIZE = params['bio_size']
+    mp4writer.MP4Writer.MAX_QUEUE_BYTES = params['queue_bytes']
+    config.WRITER_BLOCK_BYTES = params['block_bytes']
+
+def run_writer(params, records_dir):
+    import fakecam
+    import mp4writer
+
+    width, height, fps, bitrate = PROFILES[params['profile']]
+    gen = fakecam.H264Generator(width, height, fps, bitrate,
+                                params['intra_period'])
+    n_frames = int(params['duration'] * fps)
+    # Generate video up front so that generator cost is not measured.
+    frames = [gen.next() for i in range(min(n_frames, fps * 10))]
+
+    latencies = []
+    writer = mp4writer.MP4Writer(filepath=records_dir + "/bench.mp4",
+                        fps=fps)
+
+    start = time.monotonic()
+    for i in range(n_frames):
+        if params['realtime']:
+            delay = start + i / float(fps) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        for frame_type, data in frames[i % len(frames)]:
+            t = time.monotonic()
+            writer.write(data)
+            latencies.append(time.monotonic() - t)
+    fed = time.monotonic()
+    writer.close()
+    writer.wait()
+    end = time.monotonic()
+
+    stats = writer.get_stats()
+    usage = _resource_usage()
+    mbytes = stats['bytes_written'] / float(MB)
+    return {
+        'video_sec': params['duration'],
+        'bytes_written': stats['bytes_written'],
+        'throughput_mbps': round(mbytes / (end - start), 2),
+        'feed_sec': round(fed - start, 3),
+        'finalize_sec': round(end - fed, 3),
+        'write_calls': len(latencies),
+        'write_latency_p50_ms': round(_percentile(latencies, 50) * 1000, 3),
+        'write_latency_p99_ms': round(_percentile(latencies, 99) * 1000, 3),
+        'write_latency_max_ms': round(max(latencies) * 1000, 3),
+        'queue_high_water_bytes': stats['queue_high_water_bytes'],
+        'spilled_bytes': stats['spilled_bytes'],
+        'dropped_bytes': stats['dropped_bytes'],
+        'exit_code': stats['ffmpeg_exit_code'],
+        'output_write_sizes': stats.get('output_write_sizes'),
+        'output_write_sec': stats.get('output_write_sec'),
+        'output_mbps': stats.get('output_mbps'),
+        'output_write_mbps': stats.get('output_write_mbps'),
+        'peak_rss_kb': usage['peak_rss_kb'],
+        'children_peak_rss_kb': usage['children_peak_rss_kb'],
+        'cpu_sec_per_mb': round(usage['cpu_sec'] / mbytes, 4) if mbytes else None
+    }
+
+def run_loop(params, records_dir):
+    import fakecam
+    import hal
+    import recorder
+
+    width, height, fps, bitrate = PROFILES[params['profile']]
+    config.DURATION_SEC = params['segment_sec']
+    config.FAKE_CAMERA_BITRATE = bitrate
+    config.GOVERNOR_LEVELS = [(width, height, fps, config.VIDEO_QUALITY, 0)]
+    fakecam.DEFAULT_BITRATE = bitrate
+    hal.init(hal.BACKEND_FAKE)
+
+    events = []
+
+    class TimedCamera(fakecam.FakeCamera):
+        def start_recording(self, *args, **kwargs):
+            fakecam.FakeCamera.start_recording(self, *args, **kwargs)
+            events.append(('start', time.monotonic()))
+
+        def stop_recording(self):
+            fakecam.FakeCamera.stop_recording(self)
+            events.append(('stop', time.monotonic()))
+
+    hal.open_camera = lambda: TimedCamera()
+
+    recorder.init()
+    recorder.start()
+    while len([e for e in events if e[0] == 'stop']) < params['segments']:
+        time.sleep(0.1)
+    recorder.stop()
+    # Let last writer finish its file.
+    time.sleep(1)
+
+    gaps = []
+    for i in range(1, len(events)):
+        if events[i-1][0] == 'stop' and events[i][0] == 'start':
+            gaps.append(events[i][1] - events[i-1][1])
+
+    summaries = []
+    for name in os.listdir(records_dir):
+        if name.endswith(config.SEGMENT_SUMMARY_EXTENSION) and name[0].isdigit():
+            with open(records_dir + '/' + name) as f:
+                summaries.append(json.load(f))
+
+    usage = _resource_usage()
+    bytes_written = sum(s['bytes_written'] for s in summaries)
+    mbytes = bytes_written / float(MB)
+    return {
+        'segments': len(summaries),
+        'bytes_written': bytes_written,
+        'segment_gap_max_ms': round(max(gaps) * 1000, 1) if gaps else None,
+        'segment_gap_avg_ms': (round(sum(gaps) / len(gaps) * 1000, 1)
+                            if gaps else None),
+        'frames_received': sum(s['frames_received'] for s in summaries),
+        'frames_expected': sum(s['frames_expected'] for s in summaries),
+        'frames_dropped': sum(s['frames_dropped'] or 0 for s in summaries),
+        'write_max_blocked_ms': round(max([s['write_max_blocked_sec']
+                                for s in summaries] or [0]) * 1000, 3),
+        'peak_rss_kb': usage['peak_rss_kb'],
+        'children_peak_rss_kb': usage['children_peak_rss_kb'],
+        'cpu_sec_per_mb': round(usage['cpu_sec'] / mbytes, 4) if mbytes else None
+    }
+
+def run_one(params):
+    records_dir = tempfile.mkdtemp(prefix="dcam-bench-", dir=params['dir'])
+    try:
+        _apply_tunables(params, records_dir)
+        if params['mode'] == 'writer':
+            return run_writer(params, records_dir)
+        return run_loop(params, records_dir)
+    finally:
+        shutil.rmtree(records_dir, ignore_errors=True)
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=_csv(str), default=['writer'],
+                help="writer and/or loop")
+    parser.add_argument("--profile", type=_csv(str),
+                default=sorted(PROFILES.keys()))
+    parser.add_argument("--backend", type=_csv(str),
+                default=[config.WRITER_BACKEND])
+    parser.add_argument("--bio-size", type=_csv(int),
+                default=[1*MB], help="MP4Writer.MAX_VIDEO_BIO_SIZE")
+    parser.add_argument("--queue-bytes", type=_csv(int),
+                default=[config.WRITER_MAX_QUEUE_BYTES],
+                help="MP4Writer.MAX_QUEUE_BYTES")
+    parser.add_argument("--block-bytes", type=_csv(int),
+                default=[config.WRITER_BLOCK_BYTES],
+                help="config.WRITER_BLOCK_BYTES")
+    parser.add_argument("--duration", type=float, default=60,
+                help="Seconds of video in writer mode")
+    parser.add_argument("--realtime", action="store_true",
+                help="Feed video at frame rate in writer mode")
+    parser.add_argument("--intra-period", type=int, default=60)
+    parser.add_argument("--segments", type=int, default=3,
+                help="Segments to record in loop mode")
+    parser.add_argument("--segment-sec", type=int, default=5,
+                help="Segment duration in loop mode")
+    parser.add_argument("--dir", default=None,
+                help="Directory for output files, system temp by default")
+    parser.add_argument("-o", "--output", default=None,
+                help="Write json results to this file")
+    parser.add_argument("--run-one", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_one:
+        json.dump(run_one(json.loads(args.run_one)), sys.stdout)
+        return
+
+    results = []
+    for mode, profile, backend, bio_size, queue_bytes, block_bytes in \
+            itertools.product(args.mode, args.profile, args.backend, 
+                            args.bio_size, args.queue_bytes, 
+                            args.block_bytes):
+        params = {
+            'mode': mode,
+            'profile': profile,
+            'backend': backend,
+            'bio_size': bio_size,
+            'queue_bytes': queue_bytes,
+            'block_bytes': block_bytes,
+            'duration': args.duration,
+            'realtime': args.realtime,
+            'intra_period': args.intra_period,
+            'segments': args.segments,
+            'segment_sec': args.segment_sec,
+            'dir': args.dir
+        }
+        sys.stderr.write("Running {}\n".format(params))
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__),
+                            '--run-one', json.dumps(params)],
+                            stdout=subprocess.PIPE)
+        result = {'params': params}
+        if proc.returncode == 0:
+            result['metrics'] = json.loads(proc.stdout.decode('utf-8'))
+        else:
+            result['error'] = "exit code {}".format(proc.returncode)
+        results.append(result)
+
+    out = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    print(out)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,181 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Loop recording file pattern benchmark on a loopback filesystem.
+#
+# Fills the filesystem with a ring of segment files and keeps looping
+# over it, segment sizes vary like variable bitrate video:
+#   create - delete old file of the index, create a new one (recorder
+#       default)
+#   slot - recycle old file with slots.SlotFile (RECORD_SLOT_MODE)
+# Reported per pattern:
+#   write_latency_* - per chunk write including fdatasync every
+#       --sync-bytes, so that block allocation is part of it
+#   extents_* - extents per file at the end (filefrag), 1 is ideal
+#
+# Needs root for mkfs and loop mount, or give a mounted directory
+# with --dir (it is emptied). Run from src directory:
+# > sudo python3 bench/bench_slots.py --image-size 2048 --segments 400
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import slots
+
+MB = 1024 * 1024
+
+def _percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def _mount_image(image_mb, fs_type):
+    work = tempfile.mkdtemp(prefix="dcam-slots-")
+    image = work + "/fs.img"
+    mnt = work + "/mnt"
+    os.mkdir(mnt)
+    with open(image, 'wb') as f:
+        f.truncate(image_mb * MB)
+    subprocess.check_call(["mkfs." + fs_type, "-q", image]
+                        + (["-F"] if fs_type.startswith("ext") else []))
+    subprocess.check_call(["mount", "-o", "loop", image, mnt])
+    return work, mnt
+
+def _unmount_image(work, mnt):
+    subprocess.call(["umount", mnt])
+    shutil.rmtree(work, ignore_errors=True)
+
+def _count_extents(path):
+    try:
+        out = subprocess.check_output(["filefrag", path]).decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    m = re.search(r'(\d+) extents? found', out)
+    return int(m.group(1)) if m else None
+
+def _write_segment(f, nbytes, chunk, sync_bytes, latencies):
+    data = b'\xa5' * chunk
+    written = 0
+    unsynced = 0
+    while written < nbytes:
+        n = min(chunk, nbytes - written)
+        t = time.monotonic()
+        f.write(data[:n])
+        unsynced += n
+        if unsynced >= sync_bytes:
+            os.fdatasync(f.fileno())
+            unsynced = 0
+        latencies.append(time.monotonic() - t)
+        written += n
+
+def run_pattern(pattern, directory, args):
+    st = os.statvfs(directory)
+    fs_bytes = st.f_blocks * st.f_frsize
+    ring = max(2, int(fs_bytes * args.fill_percent / 100.0
+                        / (args.segment_mb * MB * (1 + args.variation))))
+    slot_bytes = int(args.segment_mb * MB * (1 + args.variation))
+    rnd = random.Random(args.seed)
+    names = {}
+    latencies = []
+    segment_times = []
+
+    start = time.monotonic()
+    for n in range(args.segments):
+        index = n % ring
+        nbytes = int(args.segment_mb * MB
+                    * (1 + rnd.uniform(-args.variation, args.variation)))
+        path = "{0}/{1}_{2:06d}.mp4".format(directory, index, n)
+        old = names.get(index)
+        t = time.monotonic()
+        if pattern == "slot":
+            f = slots.SlotFile(path, slot_bytes, reuse_path=old)
+            _write_segment(f, nbytes, args.chunk_kb * 1024,
+                        args.sync_mb * MB, latencies)
+        else:
+            if old:
+                os.remove(old)
+            f = open(path, 'wb', buffering=0)
+            _write_segment(f, nbytes, args.chunk_kb * 1024,
+                        args.sync_mb * MB, latencies)
+        f.close()
+        segment_times.append(time.monotonic() - t)
+        names[index] = path
+    total = time.monotonic() - start
+
+    extents = [e for e in (_count_extents(p) for p in names.values())
+                if e is not None]
+    return {
+        'ring_files': ring,
+        'total_sec': round(total, 2),
+        'write_latency_p50_ms': round(_percentile(latencies, 50) * 1000, 3),
+        'write_latency_p99_ms': round(_percentile(latencies, 99) * 1000, 3),
+        'write_latency_max_ms': round(max(latencies) * 1000, 3),
+        'segment_sec_max': round(max(segment_times), 3),
+        'extents_avg': (round(sum(extents) / float(len(extents)), 2)
+                        if extents else None),
+        'extents_max': max(extents) if extents else None
+    }
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pattern", default="create,slot")
+    parser.add_argument("--image-size", type=int, default=1024,
+                help="Loopback filesystem size in MB")
+    parser.add_argument("--fs", default="ext4", help="mkfs type")
+    parser.add_argument("--dir", default=None,
+                help="Use this mounted directory instead of an image")
+    parser.add_argument("--segments", type=int, default=200)
+    parser.add_argument("--segment-mb", type=float, default=16)
+    parser.add_argument("--variation", type=float, default=0.2,
+                help="Segment size varies by this fraction")
+    parser.add_argument("--fill-percent", type=float, default=85)
+    parser.add_argument("--chunk-kb", type=int, default=1024)
+    parser.add_argument("--sync-mb", type=float, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    results = []
+    for pattern in args.pattern.split(','):
+        sys.stderr.write("Running {}\n".format(pattern))
+        if args.dir:
+            for name in os.listdir(args.dir):
+                os.remove(os.path.join(args.dir, name))
+            results.append({'pattern': pattern,
+                        'metrics': run_pattern(pattern, args.dir, args)})
+            continue
+        work, mnt = _mount_image(args.image_size, args.fs)
+        try:
+            results.append({'pattern': pattern,
+                        'metrics': run_pattern(pattern, mnt, args)})
+        finally:
+            _unmount_image(work, mnt)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,212 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Crash test of recorder configuration persistence.
+#
+# A child process runs the recorder's segment bookkeeping (save index,
+# create record file, rotate now and then) at a fast pace and is
+# killed with SIGKILL at a random moment. Afterwards the configuration
+# file is loaded and the recovered index is compared with the last
+# record file created. Each store is tested:
+#   inplace - configuration rewritten in place on every change, as
+#       done before state.StateStore
+#   store - state.StateStore with write-behind and atomic replace
+# Reported per store: corrupt (file not loadable), wrong_index (index
+# neither the last record nor recoverable from catalog) and writes per
+# segment.
+#
+# SIGKILL keeps page cache, so this shows torn and lost updates of the
+# program itself but not of the card. Run from src directory:
+# > python3 bench/crash_state.py --runs 200
+
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import catalog
+
+CFG_CURR_INDEX_KEY = 'cindex'
+CFG_ROT_KEY = 'rotation'
+CFG_MAX_FILES_KEY = 'max-files'
+
+def _record_name(index, n):
+    # Unique time stamp per record keeps names distinct.
+    t = time.gmtime(1500000000 + n)
+    return "{0}_{1}{2}".format(index, time.strftime("%Y-%m-%d_%H-%M-%S", t),
+                            config.RECORD_FORMAT_EXTENSION)
+
+def child(store_name, records_dir, max_files, segment_sec, flush_delay):
+    import state
+
+    cfg_file = records_dir + '/' + config.CFG_FILENAME
+    defaults = {CFG_CURR_INDEX_KEY: 0, CFG_ROT_KEY: 0,
+                CFG_MAX_FILES_KEY: max_files}
+    counts = {'writes': 0, 'segments': 0}
+    if store_name == 'store':
+        cfg = state.StateStore(cfg_file, defaults, flush_delay)
+        set_value = cfg.set
+    else:
+        cfg = dict(defaults)
+        def set_value(key, value, durable=False):
+            cfg[key] = value
+            with open(cfg_file, 'w') as f:
+                json.dump(cfg, f)
+            counts['writes'] += 1
+
+    try:
+        _child_loop(records_dir, max_files, segment_sec, set_value, counts)
+    except KeyboardInterrupt:
+        # Normal end of write counting run.
+        if store_name == 'store':
+            cfg.close()
+            counts['writes'] = cfg.writes
+        with open(records_dir + '/counts', 'w') as f:
+            json.dump(counts, f)
+
+def _child_loop(records_dir, max_files, segment_sec, set_value, counts):
+    index = 0
+    n = 0
+    while True:
+        index = catalog.next_index(index, max_files)
+        n += 1
+        counts['segments'] = n
+        set_value(CFG_CURR_INDEX_KEY, index)
+        for r in catalog.list_records(records_dir):
+            if r.index == index:
+                os.remove(r.path)
+        with open(records_dir + '/' + _record_name(index, n), 'w') as f:
+            f.write('x')
+        # Parent reads last created record from here.
+        with open(records_dir + '/last', 'w') as f:
+            f.write(str(index))
+        if n % 50 == 0:
+            set_value(CFG_ROT_KEY, (n // 50) % 4 * 90, durable=True)
+        time.sleep(segment_sec)
+
+def check(records_dir, max_files):
+    result = {'corrupt': False, 'wrong_index': False}
+    try:
+        with open(records_dir + '/' + config.CFG_FILENAME) as f:
+            cfg = json.load(f)
+        saved = cfg[CFG_CURR_INDEX_KEY]
+    except FileNotFoundError:
+        saved = 0
+    except (ValueError, KeyError):
+        result['corrupt'] = True
+        return result
+
+    try:
+        with open(records_dir + '/last') as f:
+            last = int(f.read())
+    except (FileNotFoundError, ValueError):
+        # Killed before first record completed.
+        return result
+
+    recovered = catalog.recover_index(saved, max_files,
+                                    catalog.list_records(records_dir))
+    # Record of next index may have been created after last was
+    # written, that is recovered correctly too.
+    result['wrong_index'] = recovered not in (last,
+                                catalog.next_index(last, max_files))
+    result['lag'] = (last - saved) % max_files
+    return result
+
+def run_store(store_name, args):
+    totals = {'store': store_name, 'runs': args.runs, 'corrupt': 0,
+            'wrong_index': 0, 'max_saved_index_lag': 0}
+    for i in range(args.runs):
+        records_dir = tempfile.mkdtemp(prefix="dcam-crash-", dir=args.dir)
+        try:
+            proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                            '--child', store_name, '--records', records_dir,
+                            '--max-files', str(args.max_files),
+                            '--segment-sec', str(args.segment_sec),
+                            '--flush-delay', str(args.flush_delay)])
+            time.sleep(random.uniform(0.05, args.max_run_sec))
+            proc.send_signal(signal.SIGKILL)
+            proc.wait()
+            r = check(records_dir, args.max_files)
+            totals['corrupt'] += r['corrupt']
+            totals['wrong_index'] += r['wrong_index']
+            totals['max_saved_index_lag'] = max(
+                        totals['max_saved_index_lag'], r.get('lag', 0))
+        finally:
+            shutil.rmtree(records_dir, ignore_errors=True)
+    return totals
+
+def count_writes(store_name, args):
+    # Writes of configuration file per segment over a normal run.
+    records_dir = tempfile.mkdtemp(prefix="dcam-crash-", dir=args.dir)
+    try:
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                            '--child', store_name, '--records', records_dir,
+                            '--max-files', str(args.max_files),
+                            '--segment-sec', str(args.segment_sec),
+                            '--flush-delay', str(args.flush_delay)])
+        time.sleep(args.max_run_sec * 4)
+        proc.send_signal(signal.SIGINT)
+        proc.wait()
+        with open(records_dir + '/counts') as f:
+            counts = json.load(f)
+        return round(counts['writes'] / float(max(1, counts['segments'])), 4)
+    finally:
+        shutil.rmtree(records_dir, ignore_errors=True)
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", default="inplace,store",
+                help="Comma separated stores to test")
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--max-files", type=int, default=20)
+    parser.add_argument("--segment-sec", type=float, default=0.002,
+                help="Time between segments in child")
+    parser.add_argument("--flush-delay", type=float, default=0.2,
+                help="STATE_FLUSH_DELAY_SEC for store")
+    parser.add_argument("--max-run-sec", type=float, default=0.5,
+                help="Child is killed at random within this time")
+    parser.add_argument("--dir", default=None,
+                help="Directory for test files, system temp by default")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--records", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(args.child, args.records, args.max_files,
+            args.segment_sec, args.flush_delay)
+        return
+
+    results = []
+    for store_name in args.store.split(','):
+        sys.stderr.write("Testing {}\n".format(store_name))
+        totals = run_store(store_name, args)
+        totals['writes_per_segment'] = count_writes(store_name, args)
+        results.append(totals)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,199 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Tiered storage check with two local directories (see tiering.py).
+#
+#   loop - records short segments with fake hardware backend in a
+#       loop of --max-files, waits for the mover and checks that each
+#       record of the ring is in exactly one location and no part
+#       file is left over
+#   resume - stops the mover in the middle of a copy and starts it
+#       again, the copy has to continue from its part file
+#   recover - moves the older half of a written loop, record mtimes
+#       must be kept and index recovery has to find the newest record
+#       across both locations
+#
+# Run from src directory, ffmpeg must be installed:
+# > python3 bench/tier_check.py --mode loop,resume,recover
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+MB = 1024 * 1024
+
+def _setup(work):
+    primary = work + "/primary"
+    secondary = work + "/secondary"
+    os.mkdir(primary)
+    os.mkdir(secondary)
+    config.update_records_location(primary)
+    config.SECONDARY_LOCATION = secondary
+    return primary, secondary
+
+def run_loop(args, work):
+    import hal
+    import recorder
+    import catalog
+    import tiering
+
+    primary, secondary = _setup(work)
+    config.DURATION_SEC = args.segment_sec
+    hal.init(hal.BACKEND_FAKE)
+    recorder.init()
+    recorder._cfg.set(recorder.CFG_MAX_FILES_KEY, args.max_files)
+    recorder.start()
+    time.sleep(args.duration)
+    recorder.stop()
+    time.sleep(1)
+    # Last segment is only moved once finished.
+    deadline = time.monotonic() + 30
+    while (tiering._q.qsize() > 0 and time.monotonic() < deadline):
+        time.sleep(0.2)
+    time.sleep(1)
+    tiering.stop()
+
+    ring = catalog.ring_paths()
+    names = [os.path.basename(p) for p in ring]
+    in_primary = set(n for n in os.listdir(primary)
+                    if catalog.parse_index(n) is not None)
+    in_secondary = set(n for n in os.listdir(secondary)
+                    if catalog.parse_index(n) is not None)
+    leftovers = [n for n in os.listdir(secondary)
+                if n.endswith(tiering.PART_EXTENSION)]
+    return {
+        'ring_records': len(ring),
+        'in_primary': len(in_primary),
+        'in_secondary': len(in_secondary),
+        'in_both': len(in_primary & in_secondary),
+        'not_in_ring': sorted((in_primary | in_secondary) - set(names)),
+        'ring_missing': [p for p in ring if not os.path.exists(p)],
+        'part_files_left': leftovers,
+        'moved_records': tiering.moved_records.get(),
+        'moved_bytes': tiering.moved_bytes.get(),
+        'verify_failures': tiering.verify_failures.get()
+    }
+
+def run_resume(args, work):
+    import catalog
+    import tiering
+
+    primary, secondary = _setup(work)
+    name = "0_2020-01-01_00-00-00" + config.RECORD_FORMAT_EXTENSION
+    path = primary + '/' + name
+    with open(path, 'wb') as f:
+        f.write(os.urandom(args.file_mb * MB))
+    records = catalog.list_records()
+    catalog.load_ring(records)
+    config.TIER_MOVE_BYTES_PER_SEC = args.file_mb * MB // 4
+
+    tiering.start(records)
+    time.sleep(1.5)
+    tiering.stop()
+    part = secondary + '/' + name + tiering.PART_EXTENSION
+    part_bytes = os.path.getsize(part) if os.path.exists(part) else 0
+
+    config.TIER_MOVE_BYTES_PER_SEC = 64 * MB
+    tiering.start(tiering.list_records())
+    deadline = time.monotonic() + 30
+    while os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    tiering.stop()
+
+    dst = secondary + '/' + name
+    return {
+        'part_bytes_at_stop': part_bytes,
+        'moved': os.path.exists(dst) and not os.path.exists(path),
+        'ring_path': catalog.ring_find(name),
+        'verify_failures': tiering.verify_failures.get()
+    }
+
+def run_recover(args, work):
+    import catalog
+    import tiering
+
+    primary, secondary = _setup(work)
+    count = 6
+    t0 = time.time() - 3600
+    for i in range(count):
+        name = "{0}_2020-01-01_00-{1:02d}-00{2}".format(i, i,
+                                        config.RECORD_FORMAT_EXTENSION)
+        path = primary + '/' + name
+        with open(path, 'wb') as f:
+            f.write(os.urandom(64 * 1024))
+        os.utime(path, (t0 + i * 60, t0 + i * 60))
+    records = catalog.list_records()
+    mtimes = {r.name: r.mtime for r in records}
+    catalog.load_ring(records)
+
+    # Only the older ones, the rest stays on primary.
+    moved = [r for r in records if r.index < count - 2]
+    tiering.start(moved)
+    deadline = time.monotonic() + 30
+    while (any(os.path.exists(r.path) for r in moved)
+            and time.monotonic() < deadline):
+        time.sleep(0.1)
+    tiering.stop()
+
+    records = tiering.list_records()
+    return {
+        'in_secondary': len(catalog.list_records(secondary)),
+        'mtime_changed': sorted(r.name for r in records
+                                if r.mtime != mtimes[r.name]),
+        # Saved index behind, as after a power cut.
+        'recovered_index': catalog.recover_index(1, 0, records),
+        'expected_index': count - 1
+    }
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", default="loop,resume,recover")
+    parser.add_argument("--duration", type=float, default=20,
+                help="Seconds of recording in loop mode")
+    parser.add_argument("--segment-sec", type=int, default=2)
+    parser.add_argument("--max-files", type=int, default=4)
+    parser.add_argument("--file-mb", type=int, default=16,
+                help="Record size in resume mode")
+    args = parser.parse_args(argv)
+
+    results = []
+    for mode in args.mode.split(','):
+        work = tempfile.mkdtemp(prefix="dcam-tier-")
+        try:
+            if mode == "loop":
+                results.append({'mode': mode, 'result': run_loop(args, work)})
+            elif mode == "recover":
+                results.append({'mode': mode,
+                                'result': run_recover(args, work)})
+            else:
+                results.append({'mode': mode,
+                                'result': run_resume(args, work)})
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -22,7 +22,6 @@
 
 import struct
 import dbus
-import threading
 import logging
 from datetime import datetime
 import traceback
@@ -32,6 +31,9 @@ from gatt_dbus_service import *
 import uuids
 import util
 import location_speed
+import metrics
+import config
+from dispatch import Dispatcher
 
 logger = logging.getLogger(__name__)
 
@@ -67,6 +69,7 @@ CTRL_CMD_SHUTDOWN       = 2
 CTRL_CMD_STOP_REC       = 3
 CTRL_CMD_START_REC      = 4
 CTRL_CMD_ENABLE_GPS_LOC = 5
+CTRL_CMD_LOCK_RECORD    = 6
 #CTRL_CMD_REC_MODE_LOOP  = 
 #CTRL_CMD_REC_MODE_TRIG  = 
 #CTRL_CMD_TRIG_REC       = 
@@ -108,7 +111,8 @@ class DCamService(Service):
                                 "2 = Shutdown\n" \
                                 "3 = Stop Recording\n" \
                                 "4 = Start Recording\n" \
-                                "5 = Enable GPS Location\n"
+                                "5 = Enable GPS Location\n" \
+                                "6 = Lock Current Recording\n"
                                 )
         
         self.add_characteristic(self.control_char)
@@ -161,25 +165,37 @@ class TemperatureChar(Characteristic):
                 service)
         self.notifying = False
         self._current_temp = dbus.Array([0,0], signature='y')
+        # Last value notified, unchanged values are not sent again.
+        self._notified = None
+        self._notifier = Dispatcher("temperature-notify", self._notify,
+                                min_interval=config.BLE_NOTIFY_INTERVAL_SEC)
         if description:
             self.add_descriptor(
                 CharacteristicUserDescriptionDescriptor(bus, 0, self, description))
 
     """
     Temperature value should be signed 16 bit integer.
+    Called from recorder thread, notification is sent by notifier
+    thread.
     """
     def update(self, new_value):
         if new_value is not None:
             self._current_temp = dbus.Array(struct.pack('<h', new_value), signature='y')
 
-        if not self.notifying:
-            return self.notifying
+        if self.notifying:
+            self._notifier.post(self._current_temp)
+
+        return self.notifying
 
-        logger.info('Updating value: ' + repr(self._current_temp))
+    def _notify(self, value):
+        if not self.notifying or value == self._notified:
+            return
 
-        self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': self._current_temp }, [])
+        logger.info('Updating value: ' + repr(value))
 
-        return self.notifying
+        self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': value }, [])
+        self._notified = value
+        metrics.ble_notifications.inc()
 
     def StartNotify(self):
         if self.notifying:
@@ -187,6 +203,7 @@ class TemperatureChar(Characteristic):
             return
 
         self.notifying = True
+        self._notified = None
         self.update(None)
 
     def StopNotify(self):
@@ -208,6 +225,10 @@ class TextReadNotifyChar(Characteristic):
                 service)
         self.notifying = False
         self._text = dbus.ByteArray("na".encode())
+        # Last value notified, unchanged values are not sent again.
+        self._notified = None
+        self._notifier = Dispatcher("text-notify", self._notify,
+                                min_interval=config.BLE_NOTIFY_INTERVAL_SEC)
         if description:
             self.add_descriptor(
                 CharacteristicUserDescriptionDescriptor(bus, 0, self, description))
@@ -219,14 +240,20 @@ class TextReadNotifyChar(Characteristic):
         if new_value is not None:
             self._text = dbus.ByteArray(new_value.encode())
 
-        if not self.notifying:
-            return self.notifying
+        if self.notifying:
+            self._notifier.post(self._text)
+
+        return self.notifying
 
-        logger.info('Updating value: ' + repr(self._text))
+    def _notify(self, value):
+        if not self.notifying or value == self._notified:
+            return
 
-        self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': self._text }, [])
+        logger.info('Updating value: ' + repr(value))
 
-        return self.notifying
+        self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': value }, [])
+        self._notified = value
+        metrics.ble_notifications.inc()
 
     def StartNotify(self):
         if self.notifying:
@@ -234,6 +261,7 @@ class TextReadNotifyChar(Characteristic):
             return
 
         self.notifying = True
+        self._notified = None
         self.update(None)
 
     def StopNotify(self):
@@ -292,20 +320,25 @@ class ByteWriteChrc(Characteristic):
                 CharacteristicUserDescriptionDescriptor(bus, 0, self, description))
         
         self.on_write_cb = on_write_cb
+        # Commands are kept in order, none is dropped.
+        self._dispatcher = Dispatcher("control", self._on_value,
+                                    depth=None)
         
     def register_cb(self, cb):
         self.on_write_cb = cb
             
     def WriteValue(self, value, options):
         logger.info('ByteWriteChrc WriteValue called')
+        metrics.ble_writes.inc()
 
         if len(value) != 1:
             raise InvalidValueLengthException()
 
-        byte = value[0]
-        
+        self._dispatcher.post(int(value[0]))
+
+    def _on_value(self, byte):
         if self.on_write_cb:
-            threading.Thread(target=self.on_write_cb, args=(byte,)).start()
+            self.on_write_cb(byte)
             
 class SystemDateTimeRWChrc(Characteristic):
     def __init__(self, bus, index, service, description=None, on_write_cb=None):
@@ -320,12 +353,15 @@ class SystemDateTimeRWChrc(Characteristic):
                 CharacteristicUserDescriptionDescriptor(bus, 0, self, description))
         
         self.on_write_cb = on_write_cb
+        self._dispatcher = Dispatcher("datetime", self._on_value,
+                        dropped_counter=metrics.ble_writes_coalesced)
         
     def register_cb(self, cb):
         self.on_write_cb = cb
         
     def WriteValue(self, value, options):
         logger.info("SystemDateTimeRWChrc WriteValue called")
+        metrics.ble_writes.inc()
 
         if len(value) != 7:
             logger.error("Invalid length: " + str(len(value)))
@@ -335,12 +371,15 @@ class SystemDateTimeRWChrc(Characteristic):
             dt = util.unpack_ble_gatt_datetime(bytes(value))
             logger.info("Setting System time to :" + repr(dt))
             
-            if self.on_write_cb:
-                threading.Thread(target=self.on_write_cb, args=(dt,)).start()
+            self._dispatcher.post(dt)
         except Exception as e:
             logger.error(e)
             logger.error(traceback.format_exc())
 
+    def _on_value(self, dt):
+        if self.on_write_cb:
+            self.on_write_cb(dt)
+
     def ReadValue(self, options):
         logger.info("SystemDateTimeRWChrc ReadValue called")
         now = datetime.today()
@@ -362,23 +401,24 @@ class LocationSpeedChrc(Characteristic):
                 CharacteristicUserDescriptionDescriptor(bus, 0, self, description))
         
         self.on_write_cb = on_write_cb
+        # Only the newest location matters, raw value is parsed on
+        # the worker so replaced ones cost nothing.
+        self._dispatcher = Dispatcher("location", self._on_value,
+                        dropped_counter=metrics.ble_writes_coalesced)
         
     def register_cb(self, cb):
         self.on_write_cb = cb
         
     def WriteValue(self, value, options):
-        logger.info("LocationSpeedChrc WriteValue called")
+        # Streamed several times a second, no info log per write.
+        metrics.ble_writes.inc()
+        self._dispatcher.post(bytes(value))
 
-        try:
-            loc = location_speed.LocationSpeed(bytes(value))
-            
-            logger.info("Got location info :" + str(loc))
-            
-            if self.on_write_cb:
-                threading.Thread(target=self.on_write_cb, args=(loc,)).start()
-        except Exception as e:
-            logger.error(e)
-            logger.error(traceback.format_exc())
+    def _on_value(self, value):
+        loc = location_speed.LocationSpeed(value)
+        logger.debug("Got location info :" + str(loc))
+        if self.on_write_cb:
+            self.on_write_cb(loc)
 
 class CharacteristicUserDescriptionDescriptor(Descriptor):
     """
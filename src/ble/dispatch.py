@@ -0,0 +1,83 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Hands characteristic writes from D-Bus main loop to one worker
+# thread per characteristic.
+#
+# WriteValue only stores the value and returns. The worker calls the
+# handler with pending values in order; when more than depth values
+# are pending the oldest ones are dropped, depth None keeps all. With
+# depth 1 the handler always gets the newest value: a phone streaming
+# location faster than it is handled never builds a backlog, and a
+# value waits at most for the one handler call in progress.
+#
+# min_interval spaces handler calls, used for notifications: values
+# posted meanwhile are coalesced the same way.
+
+import collections
+import threading
+import time
+import logging
+import traceback
+
+logger = logging.getLogger(__name__)
+
+class Dispatcher:
+    def __init__(self, name, handler=None, depth=1, min_interval=0,
+                dropped_counter=None):
+        # handler - called on worker thread with each value.
+        # dropped_counter - metrics.Counter of values never handled.
+        self.handler = handler
+        self._dropped_counter = dropped_counter
+        self._min_interval = min_interval
+        self._next_time = 0
+        self._pending = collections.deque(maxlen=depth)
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run,
+                                        name="ble-" + name, daemon=True)
+        self._thread.start()
+
+    def post(self, value):
+        # Called from D-Bus main loop, never blocks on handler.
+        with self._cond:
+            if (self._pending.maxlen is not None
+                    and len(self._pending) == self._pending.maxlen
+                    and self._dropped_counter is not None):
+                self._dropped_counter.inc()
+            self._pending.append(value)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            delay = self._next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self._cond:
+                value = self._pending.popleft()
+            self._next_time = time.monotonic() + self._min_interval
+            handler = self.handler
+            if handler is None:
+                continue
+            try:
+                handler(value)
+            except Exception as e:
+                logger.error(e)
+                logger.error(traceback.format_exc())
@@ -19,119 +19,126 @@
 # Implements Bluetooth SIG - Location and Speed  Characteristic Value
 # parser.
 
-import struct 
-import util
+import struct
+import datetime
 
 """
-Builder functions return their data length for next
-running offset.
-
-Each builder function parses data as per :
+Value is parsed as per :
 https://www.bluetooth.com/wp-content/uploads/Sitecore-Media-Library/Gatt/Xml/Characteristics/org.bluetooth.characteristic.location_and_speed.xml
-"""
 
+Which fields are present, and so their offsets, depends only on flags.
+For every flags value seen a layout is compiled once: one struct.Struct
+for the whole value and a field map telling how unpacked integers
+become attributes. A packet is then decoded with a single unpack_from.
+"""
 
 # TODO Test precision due to rounding/float conversion 
 
-def _build_ispeed(obj, flags, data):
-    obj.ispeed = util.unpack_uint16(data, 10**-2, 2)
-    return 2
-    
-def _build_total_distance(obj, flags, data):
-    obj.total_distance = util.unpack_uint24(data, 10**-1, 1)
-    return 3
-    
-def _build_location(obj, flags, data):
-    obj.latitude = util.unpack_sint32(data, 10**-7, 7)
-    obj.longitude = util.unpack_sint32(data[4:8], 10**-7, 7)
-    return 8
-
-def _build_elevation(obj, flags, data):
-    obj.elevation = util.unpack_sint24(data, 10**-2, 2)
-    return 3
-    
-def _build_heading(obj, flags, data):
-    obj.heading = util.unpack_uint16(data, 10**-2, 2)
-    return 2
-
-def _build_rolling_time(obj, flags, data):
-    obj.rolling_time = data[0]
-    return 1
-
-def _build_utc_time(obj, flags, data):
-    obj.utc_time = util.unpack_ble_gatt_datetime(data)
-    return 7
-
-def _build_position_status(obj, flags):
-    obj.position_status = (flags >> 7) & 0x3
-    return 0
-    
-def _build_speed_dist_format(obj, flags):
-    obj.speed_distance_fmt = (flags >> 9) & 0x1
-    return 0
-
-def _build_elevation_source(obj, flags):
-    obj.elevation_source = (flags >> 10) & 0x3
-    return 0
-
-def _build_heading_source(obj, flags):
-    obj.heading_source = (flags >> 12) & 0x1
-    return 0
-
-    
-_builder_index = [
-    #0: 
-    _build_ispeed,
-    #1: 
-    _build_total_distance,
-    #2: 
-    _build_location,
-    #3: 
-    _build_elevation,
-    #4: 
-    _build_heading,
-    #5: 
-    _build_rolling_time,
-    #6: 
-    _build_utc_time,
-    #7: 
-    None,
-    #8: 
-    None,
-    #9: 
-    None,
-    #10: 
-    None,
-    #11: 
-    None,
-    #12: 
-    None,
-    #13: 
-    None,
-    #14: 
-    None,
-    #15: 
-    None
+# Per flag bit 0-6: struct format and fields it adds as
+# (attribute, exponent, round digits, 24 bit). 24 bit integers are
+# unpacked as 16 bit low part and a byte, signed for sint24, as high
+# part.
+_FLAG_FIELDS = [
+    #0: Instantaneous Speed
+    ("H", (("ispeed", 10**-2, 2, False),)),
+    #1: Total Distance
+    ("HB", (("total_distance", 10**-1, 1, True),)),
+    #2: Location
+    ("ii", (("latitude", 10**-7, 7, False),
+            ("longitude", 10**-7, 7, False))),
+    #3: Elevation
+    ("Hb", (("elevation", 10**-2, 2, True),)),
+    #4: Heading
+    ("H", (("heading", 10**-2, 2, False),)),
+    #5: Rolling Time, round(v, None) keeps int
+    ("B", (("rolling_time", 1, None, False),)),
+    #6: UTC Time, converted separately
+    ("HBBBBB", ()),
 ]
 
+_UTC_TIME_BIT = 6
+
+_FLAGS = struct.Struct("<H")
+
+# Compiled layouts by flags value, at most 2^16 of them.
+_layouts = {}
+
+def _compile(flags):
+    # (struct, constants, fields, utc time index or None)
+    fmt = "<H"
+    fields = []
+    utc_index = None
+    for bit, (bit_fmt, bit_fields) in enumerate(_FLAG_FIELDS):
+        if not flags & (1 << bit):
+            continue
+        # Index of first value of this bit in unpacked tuple.
+        index = len(fmt) - 1
+        fmt += bit_fmt
+        if bit == _UTC_TIME_BIT:
+            utc_index = index
+        for name, exp, digits, is24 in bit_fields:
+            # Index of high part, 0 if none.
+            high = index + 1 if is24 else 0
+            fields.append((name, index, high, exp, digits))
+            index += 2 if is24 else 1
+    # Attributes coming from flags alone.
+    constants = (("flags", flags),
+                ("position_status", (flags >> 7) & 0x3),
+                ("speed_distance_fmt", (flags >> 9) & 0x1),
+                ("elevation_source", (flags >> 10) & 0x3),
+                ("heading_source", (flags >> 12) & 0x1))
+    layout = (struct.Struct(fmt), constants, tuple(fields), utc_index)
+    _layouts[flags] = layout
+    return layout
+
+def _decode_into(obj, data):
+    flags = _FLAGS.unpack_from(data)[0]
+    layout = _layouts.get(flags)
+    if layout is None:
+        layout = _compile(flags)
+    st, constants, fields, utc_index = layout
+    v = st.unpack_from(data)
+    for name, value in constants:
+        setattr(obj, name, value)
+    for name, i, high, exp, digits in fields:
+        if high:
+            setattr(obj, name, round((v[i] + (v[high] << 16)) * exp, digits))
+        else:
+            setattr(obj, name, round(v[i] * exp, digits))
+    if utc_index is not None:
+        i = utc_index
+        obj.utc_time = datetime.datetime(v[i], v[i + 1], v[i + 2],
+                                hour=v[i + 3], minute=v[i + 4],
+                                second=v[i + 5])
+
+def decode(data):
+    # Same as LocationSpeed(data).
+    obj = LocationSpeed.__new__(LocationSpeed)
+    _decode_into(obj, data)
+    return obj
+
+def decode_batch(packets):
+    # Packets (e.g. replayed from a log) to list of LocationSpeed,
+    # raises struct.error on first truncated one.
+    new = LocationSpeed.__new__
+    result = []
+    for data in packets:
+        obj = new(LocationSpeed)
+        _decode_into(obj, data)
+        result.append(obj)
+    return result
+
 # _deg_sign = u'\N{DEGREE SIGN}'
         
 class LocationSpeed():
+    # Fields not present in flags are not set.
+    __slots__ = ('flags', 'ispeed', 'total_distance', 'latitude',
+                'longitude', 'elevation', 'heading', 'rolling_time',
+                'utc_time', 'position_status', 'speed_distance_fmt',
+                'elevation_source', 'heading_source')
     
     def __init__(self, data):
-        flags = struct.unpack("<H", data[0:2])[0]
-        self.flags = flags
-
-        offset = 2
-        for i in range(0,7):
-            if (flags & (1<<i)) != 0:
-                if _builder_index[i]:
-                    offset += _builder_index[i](self, flags, data[offset:])
-    
-        _build_position_status(self, flags)
-        _build_speed_dist_format(self, flags)
-        _build_elevation_source(self, flags)
-        _build_heading_source(self, flags)
+        _decode_into(self, data)
 
     def is_location_present(self):
         return ((self.flags >> 2) & 0x1) == 1
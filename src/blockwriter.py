@@ -0,0 +1,194 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Write coalescing for record files written by mp4 writer itself
+# (ffmpeg-pipe and raw backends).
+#
+# Data is gathered into blocks of WRITER_BLOCK_BYTES and each block is
+# written with a single write at a multiple of the block size. With
+# 4 MiB blocks on a 4 MiB aligned partition (as made by Raspberry Pi
+# OS images) writes line up with SD card erase blocks. Optionally
+# written blocks are pushed to the card and dropped from page cache
+# (WRITER_FADVISE_DONTNEED) so that recording does not evict
+# everything else.
+#
+# CRC32 of all data is computed on the way (WRITER_CHECKSUM), it is
+# saved in segment summary and checked later by scrub.py.
+
+import ctypes
+import ctypes.util
+import os
+import time
+import zlib
+import logging
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# linux/fs.h
+_SYNC_FILE_RANGE_WAIT_BEFORE = 1
+_SYNC_FILE_RANGE_WRITE = 2
+_SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+_libc = None
+_sync_file_range = None
+
+def _load_sync_file_range():
+    global _libc
+    global _sync_file_range
+    if _libc is not None:
+        return _sync_file_range
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    try:
+        _sync_file_range = _libc.sync_file_range
+        _sync_file_range.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                                    ctypes.c_longlong, ctypes.c_uint]
+    except AttributeError:
+        logger.warning("sync_file_range not available")
+    return _sync_file_range
+
+def size_bucket(n):
+    # Histogram bucket of a write size: next power of two.
+    if n <= 1:
+        return 1
+    return 1 << (n - 1).bit_length()
+
+def add_to_histogram(hist, n):
+    b = size_bucket(n)
+    hist[b] = hist.get(b, 0) + 1
+
+class BlockWriter:
+    # File object writing to an unbuffered file object f (with
+    # fileno()) in whole blocks, starting at offset 0 of f. With 
+    # block_bytes 0 data is written as it comes, only statistics are
+    # collected.
+    def __init__(self, f, block_bytes=None, fadvise=None, checksum=None):
+        if checksum is None:
+            checksum = config.WRITER_CHECKSUM
+        if block_bytes is None:
+            block_bytes = config.WRITER_BLOCK_BYTES
+        if fadvise is None:
+            fadvise = config.WRITER_FADVISE_DONTNEED
+        self._f = f
+        self._block_bytes = block_bytes
+        self._fadvise = (fadvise and block_bytes > 0
+                        and hasattr(os, 'posix_fadvise'))
+        self._buf = bytearray()
+        self._offset = 0
+        self._crc = 0 if checksum else None
+
+        # Statistics, see get_stats()
+        self._input_sizes = {}
+        self._output_sizes = {}
+        self._write_sec = 0.0
+        self._first_write = None
+        self._last_write = None
+
+    def write(self, data):
+        add_to_histogram(self._input_sizes, len(data))
+        if self._crc is not None:
+            self._crc = zlib.crc32(data, self._crc)
+        if self._block_bytes <= 0:
+            self._write_out(data)
+            return len(data)
+        self._buf += data
+        if len(self._buf) >= self._block_bytes:
+            n = len(self._buf) - len(self._buf) % self._block_bytes
+            self._write_out(memoryview(self._buf)[:n])
+            del self._buf[:n]
+        return len(data)
+
+    def _write_out(self, data):
+        t = time.monotonic()
+        if self._first_write is None:
+            self._first_write = t
+        start = self._offset
+        view = data
+        while len(view) > 0:
+            n = self._f.write(view)
+            view = view[n:]
+        self._offset += len(data)
+        add_to_histogram(self._output_sizes, len(data))
+        if self._fadvise:
+            self._drop_cache(start, len(data))
+        self._last_write = time.monotonic()
+        self._write_sec += self._last_write - t
+
+    def _drop_cache(self, start, length):
+        # Start writeback of this block, wait for the one before it
+        # and drop it from page cache. Dirty pages can't be dropped.
+        fd = self._f.fileno()
+        sync_file_range = _load_sync_file_range()
+        if sync_file_range is not None:
+            sync_file_range(fd, start, length, _SYNC_FILE_RANGE_WRITE)
+            if start >= self._block_bytes:
+                prev = start - self._block_bytes
+                sync_file_range(fd, prev, self._block_bytes,
+                                _SYNC_FILE_RANGE_WAIT_BEFORE
+                                | _SYNC_FILE_RANGE_WRITE
+                                | _SYNC_FILE_RANGE_WAIT_AFTER)
+                os.posix_fadvise(fd, prev, self._block_bytes,
+                                os.POSIX_FADV_DONTNEED)
+        else:
+            os.posix_fadvise(fd, start, length, os.POSIX_FADV_DONTNEED)
+
+    def flush(self):
+        # Partial block is written only at close.
+        pass
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def get_written_bytes(self):
+        # Bytes written to file so far, blocks still gathered are not
+        # included.
+        return self._offset
+
+    def close(self):
+        try:
+            if len(self._buf) > 0:
+                self._write_out(memoryview(self._buf))
+                self._buf = bytearray()
+            if self._fadvise and self._offset > 0:
+                os.fdatasync(self._f.fileno())
+                os.posix_fadvise(self._f.fileno(), 0, 0,
+                                os.POSIX_FADV_DONTNEED)
+        finally:
+            self._f.close()
+
+    def get_stats(self):
+        # Histograms map write size bucket (bytes, power of two) to
+        # number of writes: input is as given to write(), output as
+        # written to file. output_mbps is sustained throughput from
+        # first to last write, output_write_mbps over time spent in
+        # writes only. crc32 is of all data, None when disabled.
+        mbytes = self._offset / (1024.0 * 1024.0)
+        elapsed = 0.0
+        if self._first_write is not None:
+            elapsed = self._last_write - self._first_write
+        return {
+            'input_write_sizes': dict(sorted(self._input_sizes.items())),
+            'output_write_sizes': dict(sorted(self._output_sizes.items())),
+            'output_write_sec': round(self._write_sec, 3),
+            'output_mbps': (round(mbytes / elapsed, 2) 
+                            if elapsed > 0 else None),
+            'output_write_mbps': (round(mbytes / self._write_sec, 2)
+                            if self._write_sec > 0 else None),
+            'crc32': self._crc
+        }
@@ -0,0 +1,167 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Catalog of recordings in records location.
+# Record file name format: index_yyyy-mm-dd_HH-MM-SS.mp4
+#
+# The loop ring (recording index to record files) is built once by
+# load_ring() and then kept up to date by recorder and protect, so
+# that overwriting an index needs no directory scan. Records in the
+# ring may live in records location or, once moved by tiering, in
+# secondary location: the ring is the one namespace of both.
+
+import collections
+import os
+import re
+import threading
+from datetime import datetime
+
+import config
+
+# path - full path, mtime - modification time in seconds
+Record = collections.namedtuple('Record',
+                    ['index', 'name', 'path', 'size', 'mtime'])
+
+_RECORD_NAME_RE = re.compile(r'^(\d+)_(\d{4}-\d\d-\d\d_\d\d-\d\d-\d\d)'
+                    + re.escape(config.RECORD_FORMAT_EXTENSION) + '$')
+_RECORD_TIME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+def parse_index(name):
+    # Recording index from file name, None if name is not a record.
+    m = _RECORD_NAME_RE.match(name)
+    if m is None:
+        return None
+    return int(m.group(1))
+
+def parse_start_time(name):
+    # Recording start time (datetime) from file name or None.
+    m = _RECORD_NAME_RE.match(name)
+    if m is None:
+        return None
+    try:
+        return datetime.strptime(m.group(2), _RECORD_TIME_FORMAT)
+    except ValueError:
+        return None
+
+def list_records(location=None):
+    if location is None:
+        location = config.RECORDS_LOCATION
+    records = []
+    with os.scandir(location) as it:
+        for entry in it:
+            index = parse_index(entry.name)
+            if index is None or not entry.is_file():
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                # Deleted in between.
+                continue
+            records.append(Record(index, entry.name, entry.path,
+                                st.st_size, st.st_mtime))
+    return records
+
+# index -> list of record paths in records location
+_ring = {}
+_ring_lock = threading.Lock()
+
+def load_ring(records):
+    with _ring_lock:
+        _ring.clear()
+        for r in records:
+            _ring.setdefault(r.index, []).append(r.path)
+
+def ring_add(index, path):
+    with _ring_lock:
+        _ring.setdefault(index, []).append(path)
+
+def ring_take(index):
+    # Removes and returns record paths of index, to be overwritten.
+    with _ring_lock:
+        return _ring.pop(index, [])
+
+def ring_remove(path):
+    # False when path is not (or no longer) in the ring.
+    with _ring_lock:
+        for index, paths in _ring.items():
+            if path in paths:
+                paths.remove(path)
+                if len(paths) == 0:
+                    del _ring[index]
+                return True
+        return False
+
+def ring_replace(path, new_path):
+    # Record moved, False when path is no longer in the ring.
+    with _ring_lock:
+        for paths in _ring.values():
+            if path in paths:
+                paths[paths.index(path)] = new_path
+                return True
+        return False
+
+def ring_find(name):
+    # Path of record file name in the ring or None.
+    with _ring_lock:
+        index = parse_index(name)
+        for path in _ring.get(index, []):
+            if os.path.basename(path) == name:
+                return path
+        return None
+
+def ring_paths():
+    with _ring_lock:
+        return [p for paths in _ring.values() for p in paths]
+
+def summary_path(record_path):
+    return (os.path.splitext(record_path)[0] 
+            + config.SEGMENT_SUMMARY_EXTENSION)
+
+def next_index(index, max_files):
+    # Index following given one, max_files 0 means no wrap around yet.
+    index += 1
+    if max_files > 0 and index >= max_files:
+        index = 0
+    return index
+
+def recover_index(index, max_files, records=None):
+    # Index of the last started recording, given last saved index.
+    # Saved index may be behind as it is not written on every
+    # segment: follow records written after it, each one newer than
+    # the one before. Returns saved index when no record follows it.
+    if records is None:
+        records = list_records()
+    by_index = {}
+    for r in records:
+        if r.index not in by_index or r.mtime > by_index[r.index].mtime:
+            by_index[r.index] = r
+
+    current = by_index.get(index)
+    if current is None:
+        # Never written or deleted before its replacement was 
+        # created, start from the record after it.
+        current = by_index.get(next_index(index, max_files))
+        if current is None:
+            return index
+
+    for i in range(len(by_index)):
+        r = by_index.get(next_index(current.index, max_files))
+        if r is None or r.mtime < current.mtime or r is current:
+            break
+        current = r
+    return current.index
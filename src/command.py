@@ -17,6 +17,9 @@
 # TAB = 4 spaces
 
 import threading
+import time
+
+import metrics
 
 class Command:
     CMD_STOP_REC            = 1
@@ -32,6 +35,8 @@ class Command:
     CMD_ENABLE_GPS_LOCATION = 8
     # data = LocationSpeed from ble
     CMD_SET_LOCATION_SPEED  = 9
+    # Lock current recording, data = reason text or None
+    CMD_LOCK_RECORD         = 10
     
     # Created by sender.
     def __init__(self, cmd, data=None):
@@ -39,9 +44,11 @@ class Command:
         # Type based on command
         self.data = data
         self._event = threading.Event()
+        self._created = time.monotonic()
         
     # Called from receiver's side.
     def done(self):
+        metrics.command_latency.observe(time.monotonic() - self._created)
         self._event.set()
 
     # Called sender's side.
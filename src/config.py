@@ -56,7 +56,210 @@ TEMPERATURE_THRESHOLD_HIGH = 75.0 # degree Celsius
 # Restore high resolution when temperature drops.
 TEMPERATURE_THRESHOLD_NORMAL = 60.0 # degree Celsius
 
+# Recording levels used by the thermal and load governor, from best
+# quality to lightest load. Each level is:
+# (width, height, fps, quality, bitrate in bits per second)
+# Refer to picamera start_recording() for quality and bitrate, 
+# bitrate 0 means no limit.
+GOVERNOR_LEVELS = [
+    (HIGH_RES_VIDEO_WIDTH, HIGH_RES_VIDEO_HEIGHT, VIDEO_FPS, VIDEO_QUALITY, 0),
+    (HIGH_RES_VIDEO_WIDTH, HIGH_RES_VIDEO_HEIGHT, 25, VIDEO_QUALITY + 2, 0),
+    (LOW_RES_VIDEO_WIDTH, LOW_RES_VIDEO_HEIGHT, VIDEO_FPS, VIDEO_QUALITY, 0),
+    (LOW_RES_VIDEO_WIDTH, LOW_RES_VIDEO_HEIGHT, 20, VIDEO_QUALITY + 4, 8000000),
+    (640, 480, 15, VIDEO_QUALITY + 6, 4000000)
+]
+
+# Governor inputs are evaluated every this many seconds while recording.
+GOVERNOR_INTERVAL_SEC = 5
+# Mp4 writer backlog thresholds.
+GOVERNOR_BACKLOG_HIGH_BYTES = 8*1024*1024
+GOVERNOR_BACKLOG_NORMAL_BYTES = 2*1024*1024
+# Fraction of time records disk is busy.
+GOVERNOR_DISK_BUSY_HIGH = 0.9
+GOVERNOR_DISK_BUSY_NORMAL = 0.6
+# Minimum time between two level reductions.
+GOVERNOR_DOWN_HOLD_SEC = 30
+# All inputs must stay normal this long before level is raised.
+GOVERNOR_UP_HOLD_SEC = 120
+# Append governor inputs to this file for offline tuning with 
+# governor_sim.py, empty string disables it.
+GOVERNOR_TRACE_FILE = ""
+
 HTTP_SERVER_PORT_NUMBER = 8080
+# Record being written is sent as it grows (ffmpeg-pipe and raw 
+# backends), checked this often for new data. Data shows up in steps
+# of WRITER_BLOCK_BYTES.
+HTTP_FOLLOW_POLL_SEC = 0.5
+# The ffmpeg backend file is playable only once finished, so it can
+# not be followed: a request for it waits up to this long for the
+# writer to finish (a record just closed) and otherwise gets the bytes
+# written so far, as a plain partial file.
+HTTP_FOLLOW_FINISH_WAIT_SEC = 5
+# Cache lifetime given to browsers for finished records and exports,
+# which never change once written (a new record gets a new name).
+HTTP_IMMUTABLE_MAX_AGE_SEC = 365*24*3600
+
+# Mp4 writer output backend:
+# "ffmpeg" - mux into mp4 with ffmpeg.
+# "ffmpeg-pipe" - mux into fragmented mp4 with ffmpeg, file is written
+#   by mp4 writer from ffmpeg output. Used in slot mode.
+# "raw" - store h264 elementary stream as it is, without ffmpeg. Not 
+#   playable in browser, meant for comparing writer overhead.
+# Only ffmpeg-pipe and raw records can be streamed by web interface
+# while being written (see HTTP_FOLLOW_FINISH_WAIT_SEC).
+WRITER_BACKEND = "ffmpeg"
+
+# Record files written by mp4 writer itself (ffmpeg-pipe and raw
+# backends) are written in blocks of this size, 0 writes data as it 
+# comes. See blockwriter.py
+WRITER_BLOCK_BYTES = 4*1024*1024
+# Drop written record data from page cache.
+WRITER_FADVISE_DONTNEED = True
+# CRC32 of record files, saved in segment summary for scrubbing. With
+# ffmpeg backend the finished file is read back once to compute it.
+WRITER_CHECKSUM = True
+
+# Scrubber re-reads finished records at most at this rate and checks
+# them against CRC32 in their summary, see scrub.py. Records without
+# one (WRITER_CHECKSUM off) get it on first pass. Newest records are 
+# checked first, loop records are overwritten within hours.
+SCRUB_ENABLED = True
+SCRUB_BYTES_PER_SEC = 1*1024*1024
+# Records younger than this are not checked.
+SCRUB_MIN_AGE_SEC = 10*60
+# Pause between passes over all records.
+SCRUB_INTERVAL_SEC = 60*60
+
+# Arbitration of SD card between recording and web downloads, see 
+# arbiter.py. Downloads are not limited while mp4 writer backlog is 
+# below low mark, from there read rate falls from max to min at high
+# mark.
+ARBITER_ENABLED = True
+ARBITER_BACKLOG_LOW_BYTES = 1*1024*1024
+ARBITER_BACKLOG_HIGH_BYTES = 8*1024*1024
+ARBITER_MAX_READ_BYTES_PER_SEC = 8*1024*1024
+ARBITER_MIN_READ_BYTES_PER_SEC = 256*1024
+ARBITER_BURST_BYTES = 256*1024
+# (ionice class, level) and nice value of ffmpeg, negative nice needs
+# root.
+ARBITER_RECORD_IONICE = (2, 0)
+ARBITER_RECORD_NICE = -5
+# Same for web interface threads serving files.
+ARBITER_DOWNLOAD_IONICE = (2, 7)
+ARBITER_DOWNLOAD_NICE = 10
+
+# Recycle record files in place instead of deleting and creating them
+# (see slots.py), ffmpeg backend is switched to "ffmpeg-pipe".
+RECORD_SLOT_MODE = False
+# Disk space reserved per record file, should be a bit more than a
+# full length segment at highest bitrate.
+RECORD_SLOT_BYTES = 160*1024*1024
+
+# Maximum bytes of video the mp4 writer holds in memory while ffmpeg
+# catches up. Data beyond this is spilled to a file instead of blocking
+# the camera encoder thread.
+WRITER_MAX_QUEUE_BYTES = 16*1024*1024
+# Part of WRITER_MAX_QUEUE_BYTES holding video on its way to the spill
+# file. Once full the camera encoder thread waits for the spill file,
+# or video is dropped if spilling failed.
+WRITER_SPILL_QUEUE_BYTES = 2*1024*1024
+
+# Record spans of each recording stage in memory, exported as Chrome
+# trace json from web interface /trace.json (can be enabled on 
+# command line).
+TRACE_ENABLED = False
+# Number of most recent spans to keep.
+TRACE_MAX_EVENTS = 4096
+
+# Hardware backend, "pi" for Raspberry Pi camera or "fake" to run
+# off device with generated video (can be given on command line).
+HARDWARE_BACKEND = "pi"
+# Fake backend: h264 elementary stream file to replay, empty string 
+# generates video.
+FAKE_CAMERA_SAMPLE = ""
+# Fake backend: bitrate of generated video when recorder asks for no
+# limit.
+FAKE_CAMERA_BITRATE = 10000000
+FAKE_CPU_TEMPERATURE = 50.0 # degree Celsius
+# Fake backend: pretend records are on a disk of this size, 0 uses real 
+# disk usage.
+FAKE_DISK_SIZE_BYTES = 0
+
+# Directory for writer spill files, e.g. "/dev/shm" for tmpfs.
+# Empty string means records location.
+WRITER_SPILL_LOCATION = ""
+
+# Configuration changes are saved at most this many seconds after
+# they are made, except those which must be saved right away.
+STATE_FLUSH_DELAY_SEC = 300
+
+# SD card life estimate: card capacity (0 uses records filesystem 
+# size) times rated program/erase cycles gives total bytes the card
+# can take. Consumer TLC cards manage a few hundred cycles after 
+# internal write amplification.
+WEAR_CARD_CAPACITY_BYTES = 0
+WEAR_CARD_ENDURANCE_CYCLES = 300
+
+# Tiered storage: finished records are moved from RECORDS_LOCATION
+# (fast primary, e.g. tmpfs or SD card) to this directory (large 
+# secondary, e.g. USB drive) by tiering.py. Empty disables.
+SECONDARY_LOCATION = ""
+# Copy rate limit of the mover, also limited by arbiter while the mp4
+# writer has a backlog.
+TIER_MOVE_BYTES_PER_SEC = 4*1024*1024
+TIER_COPY_CHUNK_BYTES = 256*1024
+# Wait before retrying after secondary location errors (unplugged).
+TIER_RETRY_SEC = 30
+
+# Live view of the recording as HLS (see live.py), chunks are cut at
+# the first key frame after LIVE_CHUNK_SEC seconds. Playlist lists
+# the last LIVE_WINDOW_CHUNKS chunks which are held in memory, at most
+# LIVE_MAX_BYTES.
+LIVE_ENABLED = True
+LIVE_CHUNK_SEC = 2
+LIVE_WINDOW_CHUNKS = 5
+LIVE_MAX_BYTES = 24*1024*1024
+# Camera output is parsed only while a live view client is connected
+# or the playlist (or a chunk) was requested within LIVE_IDLE_SEC,
+# chunks are dropped when idle. A playlist request while idle waits
+# up to LIVE_START_WAIT_SEC for the first chunk.
+LIVE_IDLE_SEC = 30
+LIVE_START_WAIT_SEC = 8
+# Camera output waiting to be parsed, beyond this it is dropped until
+# the next key frame.
+LIVE_MAX_QUEUE_BYTES = 4*1024*1024
+# Per client send queue of live view over WebSocket, a slower client
+# skips to the next key frame.
+LIVE_CLIENT_QUEUE_BYTES = 2*1024*1024
+# WebSocket ping interval while no video is sent.
+LIVE_WS_PING_SEC = 5
+
+# Exports (one mp4 of a time range, see export.py) are cached in
+# EXPORT_CACHE_LOCATION, least recently used ones are deleted above
+# EXPORT_CACHE_BYTES. 0 disables caching.
+EXPORT_CACHE_BYTES = 512*1024*1024
+# Longest time range of one export.
+EXPORT_MAX_SEC = 30*60
+
+# Playlist of the web player covers this much before its end time
+# when no start is given, and at most PLAYLIST_MAX_SEC.
+PLAYLIST_DEFAULT_SEC = 60*60
+PLAYLIST_MAX_SEC = 24*60*60
+
+# Locked (protected) recordings are moved out of the recording loop
+# into PROTECTED_LOCATION, total size is limited to this quota. The
+# unused part of the quota is kept free when the loop size is decided.
+PROTECTED_QUOTA_BYTES = 2*1024*1024*1024
+# An event (BLE lock command, hard braking) locks the current
+# recording and also the previous one when the current one started
+# less than this many seconds ago.
+EVENT_PRE_SEC = 30
+# Deceleration in m/s^2 from BLE Location and Speed updates that
+# counts as hard braking event, 0 disables.
+EVENT_HARD_BRAKE_MPS2 = 7.0
+# Minimum time between two notifications of one BLE characteristic,
+# values updated faster are coalesced to the latest one.
+BLE_NOTIFY_INTERVAL_SEC = 1.0
 
 # ---------- Compile time configurable parameters END-----------
 
@@ -67,14 +270,30 @@ LIVESNAP_FILE = RECORDS_LOCATION + '/' + LIVESNAP_FILENAME
 CFG_FILENAME = "cfg.json"
 CFG_FILE = RECORDS_LOCATION + '/' + CFG_FILENAME
 
+# Protected recordings, sub directory so that moving is a rename.
+PROTECTED_DIRNAME = "protected"
+PROTECTED_LOCATION = RECORDS_LOCATION + '/' + PROTECTED_DIRNAME
+
+# Cached exports, sub directory not looked at by recording loop.
+EXPORT_CACHE_DIRNAME = "export-cache"
+EXPORT_CACHE_LOCATION = RECORDS_LOCATION + '/' + EXPORT_CACHE_DIRNAME
+
 RECORD_FORMAT_EXTENSION = ".mp4"
 
+# Per segment summary (frame and writer counters) is saved next to 
+# the record with same name and this extension.
+SEGMENT_SUMMARY_EXTENSION = ".json"
+
 def update_records_location(loc):
     global RECORDS_LOCATION
     global LIVESNAP_FILE
     global CFG_FILE
+    global PROTECTED_LOCATION
+    global EXPORT_CACHE_LOCATION
     
     RECORDS_LOCATION = loc
+    PROTECTED_LOCATION = RECORDS_LOCATION + '/' + PROTECTED_DIRNAME
+    EXPORT_CACHE_LOCATION = RECORDS_LOCATION + '/' + EXPORT_CACHE_DIRNAME
     CFG_FILE = RECORDS_LOCATION + '/' + CFG_FILENAME
     LIVESNAP_FILE = RECORDS_LOCATION + '/' + LIVESNAP_FILENAME
 
@@ -0,0 +1,245 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Export of a wall clock time range as one mp4.
+#
+# Records overlapping the range are joined by ffmpeg concat demuxer
+# with stream copy (no re-encoding): the first record is cut at its
+# inpoint, the last one at its outpoint. With stream copy ffmpeg starts
+# at the keyframe before inpoint, so an export begins up to one GOP
+# early. Output is fragmented mp4, which can be written to a pipe and
+# streamed while ffmpeg runs.
+#
+# Finished exports are kept in config.EXPORT_CACHE_LOCATION named by a
+# hash of the time range and the records used, the least recently used
+# ones are deleted above EXPORT_CACHE_BYTES.
+
+import collections
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import logging
+from datetime import timedelta
+
+import config
+import catalog
+import protect
+import metrics
+import wear
+
+logger = logging.getLogger(__name__)
+
+PART_EXTENSION = ".part"
+
+# Chunk size of reads from ffmpeg output.
+_READ_CHUNK_BYTES = 64*1024
+
+_lock = threading.Lock()
+
+# start is datetime, duration in seconds
+Segment = collections.namedtuple('Segment',
+                        ['name', 'path', 'size', 'mtime', 'start', 'duration'])
+
+cache_hits = metrics.Counter("dashcam_export_cache_hits_total",
+        "Exports served from cache.")
+exports = metrics.Counter("dashcam_exports_total",
+        "Exports made with ffmpeg.")
+
+def init():
+    # Part files of exports interrupted by a restart.
+    try:
+        for name in os.listdir(config.EXPORT_CACHE_LOCATION):
+            if name.endswith(PART_EXTENSION):
+                os.remove(config.EXPORT_CACHE_LOCATION + '/' + name)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(e)
+
+def _duration(path, st, start):
+    # From segment summary, else from file times.
+    try:
+        with open(catalog.summary_path(path)) as f:
+            duration = json.load(f).get('duration_sec')
+        if duration:
+            return float(duration)
+    except (OSError, ValueError):
+        pass
+    return max(0.0, st.st_mtime - start.timestamp())
+
+def select_segments(start, end, exclude=()):
+    # Records overlapping [start, end], oldest first.
+    selected = []
+    for path in protect.all_record_paths():
+        name = os.path.basename(path)
+        if name in exclude:
+            continue
+        rec_start = catalog.parse_start_time(name)
+        if rec_start is None or rec_start >= end:
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        duration = _duration(path, st, rec_start)
+        if rec_start + timedelta(seconds=duration) <= start:
+            continue
+        selected.append(Segment(name, path, st.st_size, int(st.st_mtime),
+                                rec_start, duration))
+    selected.sort(key=lambda s: s.start)
+    return selected
+
+def concat_list(segments, start, end):
+    # ffconcat script cutting first and last segment to the range.
+    lines = ["ffconcat version 1.0"]
+    for i, seg in enumerate(segments):
+        # file: protocol, list is read from pipe.
+        lines.append("file 'file:{0}'".format(seg.path.replace("'",
+                                                        "'\\''")))
+        if i == 0 and start > seg.start:
+            lines.append("inpoint {0:.3f}".format(
+                                (start - seg.start).total_seconds()))
+        if i == len(segments) - 1:
+            out = (end - seg.start).total_seconds()
+            if out < seg.duration:
+                lines.append("outpoint {0:.3f}".format(out))
+    return "\n".join(lines) + "\n"
+
+def cache_key(segments, start, end):
+    # Changes when any record used is overwritten.
+    h = hashlib.sha1()
+    h.update("{0} {1}\n".format(start.isoformat(),
+                                end.isoformat()).encode('utf-8'))
+    for seg in segments:
+        h.update("{0} {1} {2}\n".format(seg.name, seg.size,
+                                        seg.mtime).encode('utf-8'))
+    return h.hexdigest()[:20]
+
+def _cache_file(key):
+    return (config.EXPORT_CACHE_LOCATION + '/' + key
+            + config.RECORD_FORMAT_EXTENSION)
+
+def cache_lookup(key):
+    # Path of cached export, None if not cached.
+    path = _cache_file(key)
+    try:
+        # Marks it recently used.
+        os.utime(path)
+    except OSError:
+        return None
+    cache_hits.inc()
+    return path
+
+def _evict(keep_bytes):
+    # Deletes least recently used exports until keep_bytes fit.
+    files = []
+    try:
+        for name in os.listdir(config.EXPORT_CACHE_LOCATION):
+            path = config.EXPORT_CACHE_LOCATION + '/' + name
+            if name.endswith(PART_EXTENSION):
+                continue
+            st = os.stat(path)
+            files.append((st.st_mtime, st.st_size, path))
+    except OSError as e:
+        logger.error(e)
+        return
+    used = sum(f[1] for f in files)
+    for mtime, size, path in sorted(files):
+        if used + keep_bytes <= config.EXPORT_CACHE_BYTES:
+            break
+        try:
+            os.remove(path)
+            used -= size
+        except OSError as e:
+            logger.error(e)
+
+class Export:
+    # ffmpeg run writing the export to a pipe, output is also saved
+    # into the cache when caching is enabled.
+
+    def __init__(self, segments, start, end, key):
+        self._key = key
+        self._part = None
+        self._part_file = None
+        self._cached_bytes = 0
+        cmd = """ffmpeg -v 16 -f concat -safe 0
+                -protocol_whitelist file,pipe -i pipe:0 -c copy
+                -movflags frag_keyframe+empty_moov -f mp4 pipe:1"""
+        self._proc = subprocess.Popen(cmd.split(), stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+        self._proc.stdin.write(concat_list(segments, start,
+                                end).encode('utf-8'))
+        self._proc.stdin.close()
+        exports.inc()
+
+        if config.EXPORT_CACHE_BYTES > 0:
+            os.makedirs(config.EXPORT_CACHE_LOCATION, exist_ok=True)
+            # Each request writes its own part file.
+            self._part = "{0}.{1}{2}".format(_cache_file(key),
+                                threading.get_ident(), PART_EXTENSION)
+            self._part_file = open(self._part, 'wb')
+
+    def read(self):
+        # Next chunk of output, empty at end.
+        data = self._proc.stdout.read1(_READ_CHUNK_BYTES)
+        if data and self._part_file is not None:
+            if (self._cached_bytes + len(data)
+                    > config.EXPORT_CACHE_BYTES):
+                # Larger than cache.
+                self._drop_part()
+            else:
+                self._part_file.write(data)
+                self._cached_bytes += len(data)
+        return data
+
+    def finish(self):
+        # Returns True when ffmpeg succeeded, output is then cached.
+        ok = self._proc.wait() == 0
+        if not ok:
+            logger.error("Export ffmpeg exited with code %s",
+                        self._proc.returncode)
+            self._drop_part()
+            return False
+        if self._part_file is not None:
+            self._part_file.close()
+            self._part_file = None
+            wear.add(wear.CATEGORY_EXPORT, self._cached_bytes)
+            with _lock:
+                _evict(self._cached_bytes)
+                os.replace(self._part, _cache_file(self._key))
+        return True
+
+    def abort(self):
+        # Client went away.
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+        self._drop_part()
+
+    def _drop_part(self):
+        if self._part_file is None:
+            return
+        self._part_file.close()
+        self._part_file = None
+        wear.add(wear.CATEGORY_EXPORT, self._cached_bytes)
+        try:
+            os.remove(self._part)
+        except OSError:
+            pass
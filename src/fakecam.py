@@ -0,0 +1,436 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Stand-in for picamera.PiCamera to run the recording pipeline off
+# device. Implements only the parts of picamera API used by this
+# program. Video is either replayed from a stored h264 elementary
+# stream or generated. Generated stream is valid h264 (baseline
+# profile, plain gray picture) padded with filler data to match the
+# requested bitrate, so it can be muxed by ffmpeg and played back.
+
+import collections
+import threading
+import random
+import time
+import logging
+import traceback
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Same fields and frame types as picamera.PiVideoFrame
+FakeVideoFrame = collections.namedtuple('FakeVideoFrame',
+                ['index', 'frame_type', 'frame_size', 'video_size',
+                'split_size', 'timestamp', 'complete'])
+
+FRAME_TYPE_FRAME = 0
+FRAME_TYPE_KEY_FRAME = 1
+FRAME_TYPE_SPS_HEADER = 2
+
+# Default bitrate when caller asks for no limit (bitrate 0).
+DEFAULT_BITRATE = config.FAKE_CAMERA_BITRATE
+# Default key frame interval when not given.
+DEFAULT_INTRA_PERIOD = 60
+# Key frame size relative to average frame size.
+_KEY_FRAME_WEIGHT = 4
+
+_START_CODE = b'\x00\x00\x00\x01'
+
+class _BitWriter:
+    def __init__(self):
+        self._bits = []
+
+    def u(self, nbits, value):
+        for i in range(nbits - 1, -1, -1):
+            self._bits.append((value >> i) & 1)
+
+    def ue(self, value):
+        # Exp-Golomb unsigned
+        value += 1
+        n = value.bit_length()
+        self.u(n - 1, 0)
+        self.u(n, value)
+
+    def se(self, value):
+        if value > 0:
+            self.ue(2 * value - 1)
+        else:
+            self.ue(-2 * value)
+
+    def trailing_bits(self):
+        self._bits.append(1)
+        while len(self._bits) % 8 != 0:
+            self._bits.append(0)
+
+    def get_bytes(self):
+        out = bytearray()
+        for i in range(0, len(self._bits), 8):
+            b = 0
+            for bit in self._bits[i:i+8]:
+                b = (b << 1) | bit
+            out.append(b)
+        return bytes(out)
+
+def _nal(header, rbsp):
+    # Insert emulation prevention bytes and prefix start code.
+    out = bytearray(_START_CODE)
+    out.append(header)
+    zeros = 0
+    for b in rbsp:
+        if zeros >= 2 and b <= 3:
+            out.append(3)
+            zeros = 0
+        out.append(b)
+        zeros = zeros + 1 if b == 0 else 0
+    return bytes(out)
+
+def _filler(size):
+    # Filler data NAL unit of given total size (>= 6 bytes)
+    return _START_CODE + b'\x0c' + (b'\xff' * (size - 6)) + b'\x80'
+
+class H264Generator:
+    # Generates access units: (frame_type, data) for one frame each,
+    # key frames are preceded by a separate SPS/PPS header unit.
+
+    def __init__(self, width, height, fps, bitrate, intra_period, seed=0):
+        self._mb_w = (width + 15) // 16
+        self._mb_h = (height + 15) // 16
+        self._intra_period = max(1, intra_period)
+        self._rand = random.Random(seed)
+        self._n = 0
+        self._idr_id = 0
+
+        avg = bitrate / 8.0 / fps
+        g = self._intra_period
+        self._key_size = int(avg * min(_KEY_FRAME_WEIGHT, g))
+        if g > 1:
+            self._frame_size = int(max(0, (g * avg - self._key_size)
+                                    / (g - 1)))
+        else:
+            self._frame_size = self._key_size
+
+        self._headers = self._build_headers(width, height)
+        self._idr_slice = self._build_slice(True)
+
+    def _build_headers(self, width, height):
+        sps = _BitWriter()
+        sps.u(8, 66)    # profile_idc baseline
+        sps.u(8, 0)     # constraint flags
+        sps.u(8, 40)    # level_idc 4.0
+        sps.ue(0)       # seq_parameter_set_id
+        sps.ue(0)       # log2_max_frame_num_minus4
+        sps.ue(2)       # pic_order_cnt_type
+        sps.ue(1)       # max_num_ref_frames
+        sps.u(1, 0)     # gaps_in_frame_num_value_allowed_flag
+        sps.ue(self._mb_w - 1)
+        sps.ue(self._mb_h - 1)
+        sps.u(1, 1)     # frame_mbs_only_flag
+        sps.u(1, 1)     # direct_8x8_inference_flag
+        crop_right = (self._mb_w * 16 - width) // 2
+        crop_bottom = (self._mb_h * 16 - height) // 2
+        if crop_right or crop_bottom:
+            sps.u(1, 1)
+            sps.ue(0)
+            sps.ue(crop_right)
+            sps.ue(0)
+            sps.ue(crop_bottom)
+        else:
+            sps.u(1, 0)
+        sps.u(1, 0)     # vui_parameters_present_flag
+        sps.trailing_bits()
+
+        pps = _BitWriter()
+        pps.ue(0)       # pic_parameter_set_id
+        pps.ue(0)       # seq_parameter_set_id
+        pps.u(1, 0)     # entropy_coding_mode_flag, CAVLC
+        pps.u(1, 0)     # bottom_field_pic_order_in_frame_present_flag
+        pps.ue(0)       # num_slice_groups_minus1
+        pps.ue(0)       # num_ref_idx_l0_default_active_minus1
+        pps.ue(0)       # num_ref_idx_l1_default_active_minus1
+        pps.u(1, 0)     # weighted_pred_flag
+        pps.u(2, 0)     # weighted_bipred_idc
+        pps.se(0)       # pic_init_qp_minus26
+        pps.se(0)       # pic_init_qs_minus26
+        pps.se(0)       # chroma_qp_index_offset
+        pps.u(1, 1)     # deblocking_filter_control_present_flag
+        pps.u(1, 0)     # constrained_intra_pred_flag
+        pps.u(1, 0)     # redundant_pic_cnt_present_flag
+        pps.trailing_bits()
+
+        return (_nal(0x67, sps.get_bytes()) + _nal(0x68, pps.get_bytes()))
+
+    def _build_slice(self, idr, frame_num=0):
+        s = _BitWriter()
+        s.ue(0)                 # first_mb_in_slice
+        s.ue(7 if idr else 5)   # slice_type I or P
+        s.ue(0)                 # pic_parameter_set_id
+        s.u(4, frame_num)
+        if idr:
+            s.ue(self._idr_id)  # idr_pic_id
+        else:
+            s.u(1, 0)           # num_ref_idx_active_override_flag
+            s.u(1, 0)           # ref_pic_list_modification_flag_l0
+        if idr:
+            s.u(1, 0)           # no_output_of_prior_pics_flag
+            s.u(1, 0)           # long_term_reference_flag
+        else:
+            s.u(1, 0)           # adaptive_ref_pic_marking_mode_flag
+        s.se(0)                 # slice_qp_delta
+        s.ue(0)                 # disable_deblocking_filter_idc
+        s.se(0)                 # slice_alpha_c0_offset_div2
+        s.se(0)                 # slice_beta_offset_div2
+
+        n_mbs = self._mb_w * self._mb_h
+        if idr:
+            # Every macroblock is I_16x16 with DC prediction and no
+            # residual: mb_type 3, chroma DC prediction, qp delta 0 and
+            # coeff_token of an empty DC block.
+            for i in range(n_mbs):
+                s.ue(3)
+                s.ue(0)
+                s.se(0)
+                s.u(1, 1)
+        else:
+            # Every macroblock skipped, repeats the previous picture.
+            s.ue(n_mbs)
+        s.trailing_bits()
+
+        return _nal(0x65 if idr else 0x41, s.get_bytes())
+
+    def _pad(self, data, size):
+        size = int(size * self._rand.uniform(0.9, 1.1))
+        if size - len(data) >= 6:
+            data += _filler(size - len(data))
+        return data
+
+    def next(self):
+        # Returns list of (frame_type, data) for the next frame.
+        units = []
+        if self._n % self._intra_period == 0:
+            units.append((FRAME_TYPE_SPS_HEADER, self._headers))
+            data = self._idr_slice
+            # Alternate idr_pic_id for consecutive IDR pictures.
+            self._idr_id ^= 1
+            self._idr_slice = self._build_slice(True)
+            units.append((FRAME_TYPE_KEY_FRAME,
+                        self._pad(data, self._key_size)))
+        else:
+            frame_num = (self._n % self._intra_period) % 16
+            units.append((FRAME_TYPE_FRAME,
+                        self._pad(self._build_slice(False, frame_num),
+                                self._frame_size)))
+        self._n += 1
+        return units
+
+class H264SampleReader:
+    # Replays a stored h264 elementary stream in a loop, same output
+    # as H264Generator.
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        nals = []
+        pos = data.find(b'\x00\x00\x01')
+        while pos >= 0:
+            nxt = data.find(b'\x00\x00\x01', pos + 3)
+            end = len(data) if nxt < 0 else nxt
+            # 4 byte start code leaves a zero at the end of previous.
+            nal = data[pos+3:end].rstrip(b'\x00') if nxt >= 0 \
+                    else data[pos+3:end]
+            if len(nal) > 0:
+                nals.append(nal)
+            pos = nxt
+
+        # Group into frames, starting from first key frame. Assumes one
+        # slice per picture, as picamera encodes.
+        self._units = []
+        header = b''
+        for nal in nals:
+            nal_type = nal[0] & 0x1f
+            if nal_type in (7, 8):
+                header += _START_CODE + nal
+            elif nal_type == 5 or (nal_type == 1 and len(self._units) > 0):
+                units = []
+                if len(header) > 0:
+                    units.append((FRAME_TYPE_SPS_HEADER, header))
+                    header = b''
+                units.append((FRAME_TYPE_KEY_FRAME if nal_type == 5 
+                            else FRAME_TYPE_FRAME, _START_CODE + nal))
+                self._units.append(units)
+            elif len(self._units) > 0:
+                # SEI, filler etc. kept with the previous frame.
+                t, d = self._units[-1][-1]
+                self._units[-1][-1] = (t, d + _START_CODE + nal)
+
+        if len(self._units) == 0:
+            raise ValueError("No h264 frames found in " + path)
+        self._n = 0
+
+    def next(self):
+        units = self._units[self._n % len(self._units)]
+        self._n += 1
+        return units
+
+def make_jpeg(width, height):
+    # Baseline grayscale jpeg of a plain gray picture. Every 8x8 block
+    # has only a zero DC difference and end of block, coded with one
+    # bit each.
+    def segment(marker, payload):
+        return (bytes([0xff, marker])
+                + (len(payload) + 2).to_bytes(2, 'big') + payload)
+
+    huff_table = bytes([1] + [0] * 15) + b'\x00'
+    n_blocks = ((width + 7) // 8) * ((height + 7) // 8)
+    nbits = n_blocks * 2
+    scan = bytearray(nbits // 8)
+    if nbits % 8:
+        # Pad last byte with ones.
+        scan.append(0xff >> (nbits % 8))
+
+    return (b'\xff\xd8'
+        + segment(0xdb, b'\x00' + b'\x01' * 64)
+        + segment(0xc0, b'\x08' + height.to_bytes(2, 'big')
+                + width.to_bytes(2, 'big') + b'\x01\x01\x11\x00')
+        + segment(0xc4, b'\x00' + huff_table)
+        + segment(0xc4, b'\x10' + huff_table)
+        + segment(0xda, b'\x01\x01\x00\x00\x3f\x00')
+        + bytes(scan)
+        + b'\xff\xd9')
+
+class FakeCamera:
+
+    def __init__(self, sample=None, realtime=True):
+        # sample - path of h264 elementary stream to replay instead of
+        #   generated video.
+        # realtime - pace frames at framerate, otherwise write them as
+        #   fast as output accepts (for benchmarks).
+        self.resolution = (config.HIGH_RES_VIDEO_WIDTH,
+                        config.HIGH_RES_VIDEO_HEIGHT)
+        self.framerate = config.VIDEO_FPS
+        self.framerate_range = (1, config.VIDEO_FPS)
+        self.annotate_background = False
+        self.annotate_text_size = 32
+        self.annotate_text = ""
+        self.rotation = 0
+        self.closed = False
+
+        self._sample = sample
+        self._realtime = realtime
+        self._frame = None
+        self._th = None
+        self._stop = False
+        self._error = None
+        self._output = None
+        self._output_opened = False
+
+    @property
+    def frame(self):
+        return self._frame
+
+    @property
+    def recording(self):
+        return self._th is not None
+
+    def start_recording(self, output, format='h264', quality=0,
+                        bitrate=DEFAULT_BITRATE, intra_period=None,
+                        **kwargs):
+        if format != 'h264':
+            raise ValueError("FakeCamera supports only h264 format")
+        if self._th is not None:
+            raise RuntimeError("FakeCamera is already recording")
+
+        if isinstance(output, str):
+            self._output = open(output, 'wb')
+            self._output_opened = True
+        else:
+            self._output = output
+            self._output_opened = False
+
+        fps = float(self.framerate)
+        if self._sample:
+            source = H264SampleReader(self._sample)
+        else:
+            source = H264Generator(self.resolution[0], self.resolution[1],
+                        fps, bitrate if bitrate else DEFAULT_BITRATE,
+                        intra_period if intra_period else DEFAULT_INTRA_PERIOD)
+
+        self._stop = False
+        self._error = None
+        self._th = threading.Thread(target=self._run, args=(source, fps))
+        self._th.daemon = True
+        self._th.start()
+
+    def _run(self, source, fps):
+        index = 0
+        video_size = 0
+        start = time.monotonic()
+        try:
+            while not self._stop:
+                ts = int(index * 1000000 / fps)
+                if self._realtime:
+                    delay = start + ts / 1000000.0 - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                for frame_type, data in source.next():
+                    video_size += len(data)
+                    self._frame = FakeVideoFrame(index, frame_type,
+                                    len(data), video_size, video_size,
+                                    None if frame_type == FRAME_TYPE_SPS_HEADER
+                                        else ts, True)
+                    self._output.write(data)
+                index += 1
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            self._error = e
+
+    def wait_recording(self, timeout=0):
+        if self._th is None:
+            raise RuntimeError("FakeCamera is not recording")
+        if self._error:
+            raise self._error
+        if timeout > 0:
+            time.sleep(timeout)
+
+    def stop_recording(self):
+        if self._th is None:
+            raise RuntimeError("FakeCamera is not recording")
+        self._stop = True
+        self._th.join()
+        self._th = None
+        if self._output_opened:
+            self._output.close()
+        elif hasattr(self._output, 'flush'):
+            self._output.flush()
+        self._output = None
+        if self._error:
+            raise self._error
+
+    def capture(self, output, format='jpeg', use_video_port=False, **kwargs):
+        data = make_jpeg(self.resolution[0], self.resolution[1])
+        if isinstance(output, str):
+            with open(output, 'wb') as f:
+                f.write(data)
+        else:
+            output.write(data)
+
+    def close(self):
+        if self._th is not None:
+            self.stop_recording()
+        self.closed = True
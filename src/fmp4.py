@@ -0,0 +1,205 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Minimal fragmented mp4 muxer for one h264 video track.
+#
+# init_segment() gives ftyp+moov from SPS/PPS, fragment() a moof+mdat
+# of complete access units. Samples are stored with 4 byte length
+# prefixes (AVCC), SPS/PPS only in the init segment. Video has no
+# B-frames (camera encoder), so decode time is presentation time.
+
+import struct
+
+TIMESCALE = 90000
+
+_SAMPLE_FLAGS_SYNC = 0x02000000
+# depends on others, non sync sample
+_SAMPLE_FLAGS_NON_SYNC = 0x01010000
+
+_MATRIX = struct.pack('>9I', 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0,
+                    0x40000000)
+
+# NAL unit types
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+def _box(kind, *payloads):
+    data = b''.join(payloads)
+    return struct.pack('>I4s', 8 + len(data), kind) + data
+
+def _full_box(kind, version, flags, *payloads):
+    return _box(kind, struct.pack('>I', (version << 24) | flags), *payloads)
+
+class _BitReader:
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+
+    def u(self, nbits):
+        value = 0
+        for _ in range(nbits):
+            byte = self._data[self._pos >> 3]
+            value = (value << 1) | ((byte >> (7 - (self._pos & 7))) & 1)
+            self._pos += 1
+        return value
+
+    def ue(self):
+        zeros = 0
+        while self.u(1) == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self):
+        v = self.ue()
+        return (v + 1) // 2 if v & 1 else -(v // 2)
+
+def _rbsp(nal):
+    # Removes emulation prevention bytes.
+    return nal.replace(b'\x00\x00\x03', b'\x00\x00')
+
+def _skip_scaling_list(r, size):
+    last = 8
+    next_scale = 8
+    for _ in range(size):
+        if next_scale != 0:
+            next_scale = (last + r.se() + 256) % 256
+        if next_scale != 0:
+            last = next_scale
+
+def sps_dimensions(sps):
+    # (width, height) in pixels from SPS NAL unit (with header byte).
+    r = _BitReader(_rbsp(sps[1:]))
+    profile_idc = r.u(8)
+    r.u(16)     # constraint flags, level_idc
+    r.ue()      # seq_parameter_set_id
+    chroma_format_idc = 1
+    if profile_idc in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138,
+                    139, 134, 135):
+        chroma_format_idc = r.ue()
+        if chroma_format_idc == 3:
+            r.u(1)
+        r.ue()  # bit_depth_luma_minus8
+        r.ue()  # bit_depth_chroma_minus8
+        r.u(1)
+        if r.u(1):
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if r.u(1):
+                    _skip_scaling_list(r, 16 if i < 6 else 64)
+    r.ue()      # log2_max_frame_num_minus4
+    poc_type = r.ue()
+    if poc_type == 0:
+        r.ue()
+    elif poc_type == 1:
+        r.u(1)
+        r.se()
+        r.se()
+        for _ in range(r.ue()):
+            r.se()
+    r.ue()      # max_num_ref_frames
+    r.u(1)
+    mb_w = r.ue() + 1
+    map_h = r.ue() + 1
+    frame_mbs_only = r.u(1)
+    if not frame_mbs_only:
+        r.u(1)
+    r.u(1)      # direct_8x8_inference_flag
+    crop = (0, 0, 0, 0)
+    if r.u(1):
+        crop = (r.ue(), r.ue(), r.ue(), r.ue())
+
+    if chroma_format_idc == 0:
+        unit_x, unit_y = 1, 2 - frame_mbs_only
+    else:
+        sub_w = 1 if chroma_format_idc == 3 else 2
+        sub_h = 2 if chroma_format_idc == 1 else 1
+        unit_x, unit_y = sub_w, sub_h * (2 - frame_mbs_only)
+    width = mb_w * 16 - unit_x * (crop[0] + crop[1])
+    height = (2 - frame_mbs_only) * map_h * 16 - unit_y * (crop[2] + crop[3])
+    return width, height
+
+def codec_string(sps):
+    # RFC 6381 codecs parameter, e.g. avc1.64002a
+    return "avc1.{0:02x}{1:02x}{2:02x}".format(sps[1], sps[2], sps[3])
+
+def init_segment(sps, pps):
+    width, height = sps_dimensions(sps)
+    avcc = _box(b'avcC', bytes([1, sps[1], sps[2], sps[3], 0xff, 0xe1]),
+                struct.pack('>H', len(sps)), sps,
+                b'\x01', struct.pack('>H', len(pps)), pps)
+    avc1 = _box(b'avc1', bytes(6), struct.pack('>H', 1), bytes(16),
+                struct.pack('>HHIIIH', width, height, 0x00480000,
+                            0x00480000, 0, 1),
+                bytes(32), struct.pack('>Hh', 0x0018, -1), avcc)
+    stbl = _box(b'stbl',
+                _full_box(b'stsd', 0, 0, struct.pack('>I', 1), avc1),
+                _full_box(b'stts', 0, 0, bytes(4)),
+                _full_box(b'stsc', 0, 0, bytes(4)),
+                _full_box(b'stsz', 0, 0, bytes(8)),
+                _full_box(b'stco', 0, 0, bytes(4)))
+    dinf = _box(b'dinf', _full_box(b'dref', 0, 0, struct.pack('>I', 1),
+                                _full_box(b'url ', 0, 1)))
+    minf = _box(b'minf', _full_box(b'vmhd', 0, 1, bytes(8)), dinf, stbl)
+    mdia = _box(b'mdia',
+                _full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0,
+                                                TIMESCALE, 0, 0x55c4, 0)),
+                _full_box(b'hdlr', 0, 0, bytes(4), b'vide', bytes(12),
+                        b'VideoHandler\x00'),
+                minf)
+    tkhd = _full_box(b'tkhd', 0, 3, struct.pack('>IIIII', 0, 0, 1, 0, 0),
+                    bytes(8), struct.pack('>hhhH', 0, 0, 0, 0), _MATRIX,
+                    struct.pack('>II', width << 16, height << 16))
+    mvhd = _full_box(b'mvhd', 0, 0, struct.pack('>IIIIIH', 0, 0, 1000, 0,
+                                            0x00010000, 0x0100),
+                    bytes(10), _MATRIX, bytes(24), struct.pack('>I', 2))
+    mvex = _box(b'mvex', _full_box(b'trex', 0, 0,
+                                struct.pack('>IIIII', 1, 1, 0, 0, 0)))
+    moov = _box(b'moov', mvhd, _box(b'trak', tkhd, mdia), mvex)
+    ftyp = _box(b'ftyp', b'isom', struct.pack('>I', 0x200), b'isom',
+                b'iso6', b'avc1', b'mp41')
+    return ftyp + moov
+
+def fragment(sequence, decode_time, samples):
+    # samples - list of (data, duration, is_key), data in AVCC format.
+    # decode_time - of first sample in TIMESCALE units.
+    def moof(data_offset):
+        entries = b''.join(struct.pack('>III', duration, len(data),
+                _SAMPLE_FLAGS_SYNC if key else _SAMPLE_FLAGS_NON_SYNC)
+                for data, duration, key in samples)
+        # data-offset, duration, size and flags present
+        trun = _full_box(b'trun', 0, 0x000701,
+                        struct.pack('>Ii', len(samples), data_offset),
+                        entries)
+        # default-base-is-moof
+        tfhd = _full_box(b'tfhd', 0, 0x020000, struct.pack('>I', 1))
+        tfdt = _full_box(b'tfdt', 1, 0, struct.pack('>Q', decode_time))
+        return _box(b'moof', _full_box(b'mfhd', 0, 0,
+                                    struct.pack('>I', sequence)),
+                    _box(b'traf', tfhd, tfdt, trun))
+
+    size = len(moof(0))
+    payload = b''.join(s[0] for s in samples)
+    return (moof(size + 8) + struct.pack('>I4s', 8 + len(payload), b'mdat')
+            + payload)
+
+def avcc_sample(nals):
+    # Access unit of Annex B NAL units (without start codes) to AVCC.
+    return b''.join(struct.pack('>I', len(n)) + n for n in nals)
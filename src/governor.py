@@ -0,0 +1,201 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Thermal and load governor. Picks one of config.GOVERNOR_LEVELS
+# (level 0 = best quality) from CPU temperature, mp4 writer backlog,
+# firmware throttled state and disk busy time.
+# Each input has a high and a normal threshold, in between the input
+# holds the current level. Level is lowered when any input is high and
+# raised only after all inputs stayed normal for a while.
+
+import collections
+import json
+import time
+import logging
+
+import hal
+import util
+import config
+
+logger = logging.getLogger(__name__)
+
+# One sample of governor inputs.
+# time - seconds, monotonic
+# cpu_temp - degree Celsius
+# backlog_bytes - mp4 writer queued and spilled bytes
+# throttled - bit mask from "vcgencmd get_throttled"
+# disk_busy - fraction of time records disk was busy since last sample
+Telemetry = collections.namedtuple('Telemetry',
+                ['time', 'cpu_temp', 'backlog_bytes',
+                'throttled', 'disk_busy'])
+
+# Bits of get_throttled which are active now (not sticky bits):
+# under-voltage, frequency capped, throttled, soft temperature limit.
+THROTTLED_NOW_MASK = 0xF
+
+# Input states
+_NORMAL = 0
+_HOLD = 1
+_HIGH = 2
+
+def _classify(value, high, normal):
+    if value >= high:
+        return _HIGH
+    if value <= normal:
+        return _NORMAL
+    return _HOLD
+
+class Governor:
+
+    def __init__(self, levels=None,
+            temp_high=config.TEMPERATURE_THRESHOLD_HIGH,
+            temp_normal=config.TEMPERATURE_THRESHOLD_NORMAL,
+            backlog_high=config.GOVERNOR_BACKLOG_HIGH_BYTES,
+            backlog_normal=config.GOVERNOR_BACKLOG_NORMAL_BYTES,
+            disk_busy_high=config.GOVERNOR_DISK_BUSY_HIGH,
+            disk_busy_normal=config.GOVERNOR_DISK_BUSY_NORMAL,
+            down_hold_sec=config.GOVERNOR_DOWN_HOLD_SEC,
+            up_hold_sec=config.GOVERNOR_UP_HOLD_SEC,
+            trace_file=None):
+        if levels is None:
+            levels = config.GOVERNOR_LEVELS
+        self.levels = levels
+        self.level = 0
+        # Why the level was last lowered, for user interface.
+        self.reason = ""
+
+        self._temp = (temp_high, temp_normal)
+        self._backlog = (backlog_high, backlog_normal)
+        self._disk_busy = (disk_busy_high, disk_busy_normal)
+        self._down_hold_sec = down_hold_sec
+        self._up_hold_sec = up_hold_sec
+
+        self._last_change_time = None
+        # Since when all inputs are normal.
+        self._normal_since = None
+
+        # Optional file to append telemetry samples to, one json
+        # object per line. Can be replayed with governor_sim.py
+        self._trace = None
+        if trace_file:
+            self._trace = open(trace_file, 'a', buffering=1)
+
+    def get_level_params(self):
+        # (width, height, fps, quality, bitrate)
+        return self.levels[self.level]
+
+    def update(self, t):
+        # Evaluate one Telemetry sample, returns True if level changed.
+        states = {
+            'temperature': _classify(t.cpu_temp, *self._temp),
+            'backlog': _classify(t.backlog_bytes, *self._backlog),
+            'throttled': _HIGH if (t.throttled & THROTTLED_NOW_MASK)
+                            else _NORMAL,
+            'disk': _classify(t.disk_busy, *self._disk_busy)
+        }
+
+        if self._last_change_time is None:
+            self._last_change_time = t.time
+
+        changed = False
+        high = [k for k, v in states.items() if v == _HIGH]
+
+        if all(v == _NORMAL for v in states.values()):
+            if self._normal_since is None:
+                self._normal_since = t.time
+        else:
+            self._normal_since = None
+
+        if len(high) > 0:
+            if ((self.level < len(self.levels) - 1) and
+                (t.time - self._last_change_time >= self._down_hold_sec
+                    or self.level == 0)):
+                self.level += 1
+                self.reason = ", ".join(high)
+                changed = True
+        elif self._normal_since is not None and self.level > 0:
+            if ((t.time - self._normal_since >= self._up_hold_sec) and
+                (t.time - self._last_change_time >= self._up_hold_sec)):
+                self.level -= 1
+                if self.level == 0:
+                    self.reason = ""
+                changed = True
+
+        if changed:
+            self._last_change_time = t.time
+            # Next step up must wait for a full normal period again.
+            self._normal_since = None
+
+        if self._trace:
+            self._write_trace(t)
+
+        return changed
+
+    def _write_trace(self, t):
+        try:
+            rec = t._asdict()
+            rec['level'] = self.level
+            self._trace.write(json.dumps(rec) + '\n')
+        except Exception as e:
+            logger.error(e)
+            self._trace = None
+
+    def close(self):
+        if self._trace:
+            self._trace.close()
+            self._trace = None
+
+class TelemetrySampler:
+    # Collects governor inputs on device.
+
+    def __init__(self):
+        self._last_io = None
+
+    def sample(self, cpu_temp, writer=None):
+        now = time.monotonic()
+
+        backlog = 0
+        if writer is not None:
+            backlog = writer.get_backlog_bytes()
+
+        throttled = 0
+        try:
+            throttled = hal.thermal.get_throttled()
+        except Exception as e:
+            logger.debug(e)
+
+        return Telemetry(now, cpu_temp, backlog, throttled,
+                        self._sample_disk_busy(now))
+
+    def _sample_disk_busy(self, now):
+        # Fraction of wall time with I/O in flight, from io_ticks of
+        # the records device.
+        try:
+            io_ticks_ms = hal.disk.get_block_stat(
+                            config.RECORDS_LOCATION)[util.BLK_STAT_IO_TICKS]
+        except Exception as e:
+            logger.debug(e)
+            return 0.0
+
+        busy = 0.0
+        if self._last_io is not None:
+            dt = now - self._last_io[0]
+            if dt > 0:
+                busy = (io_ticks_ms - self._last_io[1]) / 1000.0 / dt
+        self._last_io = (now, io_ticks_ms)
+        return min(busy, 1.0)
@@ -0,0 +1,144 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Replays a governor telemetry trace (config.GOVERNOR_TRACE_FILE)
+# through governor.Governor with given thresholds, for tuning them
+# offline. Prints json summary of the replay and of the recorded run.
+#
+# > python3 governor_sim.py trace.jsonl --temp-high 70 --up-hold 60
+#
+# Replay doesn't model the effect of a level change on temperature or
+# load, the trace already contains the response of the recorded run.
+
+import argparse
+import json
+import sys
+
+import governor
+import config
+
+def _load_trace(path):
+    samples = []
+    recorded_levels = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            rec = json.loads(line)
+            samples.append(governor.Telemetry(rec['time'],
+                            rec['cpu_temp'], rec['backlog_bytes'],
+                            rec['throttled'], rec['disk_busy']))
+            recorded_levels.append(rec.get('level'))
+    return samples, recorded_levels
+
+def _summarize(samples, levels):
+    # Time spent at each level and number of level changes.
+    time_at_level = {}
+    max_temp_at_level = {}
+    changes = 0
+    for i, t in enumerate(samples):
+        level = levels[i]
+        if level is None:
+            continue
+        if i > 0 and levels[i-1] is not None and levels[i-1] != level:
+            changes += 1
+        if i + 1 < len(samples):
+            dt = samples[i+1].time - t.time
+            time_at_level[level] = time_at_level.get(level, 0) + dt
+        max_temp_at_level[level] = max(max_temp_at_level.get(level,
+                                        t.cpu_temp), t.cpu_temp)
+
+    return {
+        'level_changes': changes,
+        'time_at_level_sec': {str(k): round(v, 1)
+                            for k, v in sorted(time_at_level.items())},
+        'max_temp_at_level': {str(k): v
+                            for k, v in sorted(max_temp_at_level.items())}
+    }
+
+def simulate(samples, **params):
+    # Returns level after each sample and indexes of samples where
+    # recorder would cut the segment early (level lowered).
+    gov = governor.Governor(**params)
+    levels = []
+    cuts = []
+    for i, t in enumerate(samples):
+        level = gov.level
+        gov.update(t)
+        if gov.level > level:
+            cuts.append(i)
+        levels.append(gov.level)
+    return levels, cuts
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", help="Governor trace file (json lines)")
+    parser.add_argument("--temp-high", type=float,
+                default=config.TEMPERATURE_THRESHOLD_HIGH)
+    parser.add_argument("--temp-normal", type=float,
+                default=config.TEMPERATURE_THRESHOLD_NORMAL)
+    parser.add_argument("--backlog-high", type=int,
+                default=config.GOVERNOR_BACKLOG_HIGH_BYTES)
+    parser.add_argument("--backlog-normal", type=int,
+                default=config.GOVERNOR_BACKLOG_NORMAL_BYTES)
+    parser.add_argument("--disk-busy-high", type=float,
+                default=config.GOVERNOR_DISK_BUSY_HIGH)
+    parser.add_argument("--disk-busy-normal", type=float,
+                default=config.GOVERNOR_DISK_BUSY_NORMAL)
+    parser.add_argument("--down-hold", type=float,
+                default=config.GOVERNOR_DOWN_HOLD_SEC)
+    parser.add_argument("--up-hold", type=float,
+                default=config.GOVERNOR_UP_HOLD_SEC)
+    parser.add_argument("--levels", type=int,
+                default=len(config.GOVERNOR_LEVELS),
+                help="Use only first N levels of config.GOVERNOR_LEVELS")
+    parser.add_argument("--timeline", action="store_true",
+                help="Include level after each sample in output")
+    args = parser.parse_args(argv)
+
+    samples, recorded_levels = _load_trace(args.trace)
+
+    levels, cuts = simulate(samples,
+                levels=config.GOVERNOR_LEVELS[:args.levels],
+                temp_high=args.temp_high,
+                temp_normal=args.temp_normal,
+                backlog_high=args.backlog_high,
+                backlog_normal=args.backlog_normal,
+                disk_busy_high=args.disk_busy_high,
+                disk_busy_normal=args.disk_busy_normal,
+                down_hold_sec=args.down_hold,
+                up_hold_sec=args.up_hold)
+
+    result = {
+        'samples': len(samples),
+        'duration_sec': (round(samples[-1].time - samples[0].time, 1)
+                        if len(samples) > 0 else 0),
+        'params': vars(args),
+        'simulated': _summarize(samples, levels),
+        'recorded': _summarize(samples, recorded_levels)
+    }
+    result['simulated']['early_segment_cuts'] = len(cuts)
+    if args.timeline:
+        result['simulated']['timeline'] = levels
+
+    json.dump(result, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,130 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Hardware abstraction for camera, SoC thermal and disk. Backend "pi"
+# uses picamera and vcgencmd, backend "fake" runs on any Linux box
+# with a generated video stream (see fakecam.py).
+# Other modules use hal.open_camera(), hal.thermal and hal.disk,
+# call init() once at startup to select the backend.
+
+import os
+import math
+import logging
+
+import util
+import config
+
+logger = logging.getLogger(__name__)
+
+BACKEND_PI = "pi"
+BACKEND_FAKE = "fake"
+
+class PiThermal:
+    def get_cpu_temperature(self):
+        return util.get_cpu_temperature()
+
+    def get_throttled(self):
+        return util.get_throttled()
+
+class FakeThermal:
+    # Values can be changed at runtime by tests.
+    def __init__(self, temperature=config.FAKE_CPU_TEMPERATURE):
+        self.temperature = temperature
+        self.throttled = 0
+
+    def get_cpu_temperature(self):
+        return self.temperature
+
+    def get_throttled(self):
+        return self.throttled
+
+class SystemDisk:
+    def get_used_percent(self, path):
+        # Same as "Use%" of df: used / (used + available to users)
+        st = os.statvfs(path)
+        used = st.f_blocks - st.f_bfree
+        total = used + st.f_bavail
+        if total == 0:
+            return 0
+        return int(math.ceil(used * 100.0 / total))
+
+    def get_free_bytes(self, path):
+        st = os.statvfs(path)
+        return st.f_bavail * st.f_frsize
+
+    def get_block_stat(self, path):
+        return util.get_block_device_stat(path)
+
+class FakeDisk(SystemDisk):
+    # Pretends records location is on a disk of given size, used space
+    # is the size of files in it. Lets loop recording be exercised
+    # without filling the real disk.
+    def __init__(self, size_bytes=config.FAKE_DISK_SIZE_BYTES):
+        self.size_bytes = size_bytes
+
+    def _get_used_bytes(self, path):
+        used = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                try:
+                    used += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    # Deleted in between.
+                    pass
+        return used
+
+    def get_used_percent(self, path):
+        if self.size_bytes <= 0:
+            return SystemDisk.get_used_percent(self, path)
+        return int(math.ceil(self._get_used_bytes(path) * 100.0 
+                            / self.size_bytes))
+
+    def get_free_bytes(self, path):
+        if self.size_bytes <= 0:
+            return SystemDisk.get_free_bytes(self, path)
+        return max(0, self.size_bytes - self._get_used_bytes(path))
+
+backend = BACKEND_PI
+thermal = PiThermal()
+disk = SystemDisk()
+
+def init(name=config.HARDWARE_BACKEND):
+    global backend
+    global thermal
+    global disk
+
+    if name == BACKEND_PI:
+        thermal = PiThermal()
+        disk = SystemDisk()
+    elif name == BACKEND_FAKE:
+        thermal = FakeThermal()
+        disk = FakeDisk()
+    else:
+        raise ValueError("Unknown hardware backend: " + str(name))
+
+    backend = name
+    logger.info("Hardware backend: %s", backend)
+
+def open_camera():
+    if backend == BACKEND_FAKE:
+        import fakecam
+        return fakecam.FakeCamera(sample=config.FAKE_CAMERA_SAMPLE or None)
+
+    # Imported here so that other backends don't need picamera.
+    import picamera
+    return picamera.PiCamera()
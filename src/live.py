@@ -0,0 +1,529 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Live stream of the recording as HLS with fragmented mp4 chunks.
+#
+# mp4 writer hands every piece of camera h264 output to feed(), which
+# only queues it: parsing runs in the live thread so that the camera
+# callback never waits. The thread splits the stream into access
+# units and cuts a chunk (one moof+mdat, see fmp4.py) at the first key
+# frame after LIVE_CHUNK_SEC. The last LIVE_WINDOW_CHUNKS chunks, at
+# most LIVE_MAX_BYTES, are kept in memory and listed by playlist().
+# Nothing is encoded or written to the card for live viewing.
+#
+# Live view clients (see subscribe()) get every frame as its own
+# fragment for low latency. Each has a queue of at most
+# LIVE_CLIENT_QUEUE_BYTES, a client falling behind loses its queue and
+# continues from the next key frame.
+#
+# Timestamps come from the frame rate of the recording and run on
+# across segments. An SPS/PPS change (governor changed resolution)
+# starts a new init segment behind a discontinuity.
+#
+# Without viewers (no subscriber, no playlist or chunk request for
+# LIVE_IDLE_SEC) feed() ignores camera output and chunks are freed,
+# the stream starts again at the next key frame once requested.
+
+import collections
+import hashlib
+import json
+import math
+import threading
+import time
+import logging
+
+import config
+import fmp4
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_START_CODE = b'\x00\x00\x01'
+
+PLAYLIST_NAME = "live.m3u8"
+# Sub path of chunks and init segments, relative to playlist.
+FILES_PATH = "live/"
+_INIT_PREFIX = "init-"
+_INIT_EXTENSION = ".mp4"
+_CHUNK_EXTENSION = ".m4s"
+
+# seq - media sequence number, duration in seconds
+Chunk = collections.namedtuple('Chunk', ['seq', 'duration', 'data',
+                                        'init_id'])
+
+# Marker queued by stream_started()
+_StreamStart = collections.namedtuple('_StreamStart', ['fps'])
+_RESYNC = object()
+# Queued by feed() when viewers are gone.
+_IDLE = object()
+
+# Input queue of feed(), protected by _cv.
+_cv = threading.Condition()
+_in_q = collections.deque()
+_in_q_bytes = 0
+_th_live = None
+# monotonic time of last playlist or chunk request
+_last_request = None
+# feed() is queueing camera output, used only by feed().
+_feeding = False
+
+# Parser state, used only by live thread.
+_buf = bytearray()
+_scan_pos = 0
+_sps = None
+_pps = None
+_au = []
+_au_key = False
+_synced = False
+_frame_duration = fmp4.TIMESCALE // 30
+_decode_time = 0
+_pending = []
+_pending_bytes = 0
+_pending_start = 0
+_pending_duration = 0
+# (sps, pps) and id of init segment of pending chunk
+_cur_params = None
+_cur_init_id = None
+
+# Published chunks, protected by _lock.
+_lock = threading.Lock()
+_chunks = collections.deque()
+_chunks_bytes = 0
+_inits = {}
+_next_seq = 0
+_disc_seq = 0
+_ended = False
+_subscribers = []
+_frag_seq = 0
+# Chunk names differ between program runs, so that browsers may cache
+# them.
+_run_id = "{0:x}".format(int(time.time()))
+
+metrics.Gauge("dashcam_live_bytes",
+        "Bytes of live stream chunks held in memory.",
+        lambda: _chunks_bytes)
+client_skips = metrics.Counter("dashcam_live_client_skips_total",
+        "Live view client queues dropped for being too slow.")
+resyncs = metrics.Counter("dashcam_live_resyncs_total",
+        "Live stream input dropped until the next key frame.")
+
+def enabled():
+    return config.LIVE_ENABLED
+
+def stream_started(fps):
+    # Called before camera starts recording a segment.
+    global _th_live
+
+    if not enabled():
+        return
+    if _th_live is None or not _th_live.is_alive():
+        _th_live = threading.Thread(target=_run, name="live")
+        _th_live.daemon = True
+        _th_live.start()
+    _put(_StreamStart(fps), 0)
+
+def stream_stopped():
+    # Called when recording stops, ends the playlist.
+    if enabled():
+        _put(None, 0)
+
+def touch():
+    # Playlist or chunk requested, keeps the stream going.
+    global _last_request
+    _last_request = time.monotonic()
+
+def _watched():
+    if len(_subscribers) > 0:
+        return True
+    last = _last_request
+    return (last is not None 
+            and time.monotonic() - last < config.LIVE_IDLE_SEC)
+
+def feed(data):
+    # Camera output, called from mp4 writer. Never blocks.
+    global _in_q_bytes, _feeding
+
+    if not _watched():
+        if _feeding:
+            _feeding = False
+            _put(_IDLE, 0)
+        return
+    _feeding = True
+    with _cv:
+        if _in_q_bytes + len(data) > config.LIVE_MAX_QUEUE_BYTES:
+            # Live thread can't keep up, drop video and start again at
+            # the next key frame rather than growing. Markers stay in
+            # order.
+            kept = []
+            for item in _in_q:
+                if isinstance(item, bytes) or item is _RESYNC:
+                    if not kept or kept[-1] is not _RESYNC:
+                        kept.append(_RESYNC)
+                else:
+                    kept.append(item)
+            if not kept or kept[-1] is not _RESYNC:
+                # Video given now is dropped too.
+                kept.append(_RESYNC)
+            _in_q.clear()
+            _in_q.extend(kept)
+            _in_q_bytes = 0
+        else:
+            _in_q.append(bytes(data))
+            _in_q_bytes += len(data)
+        _cv.notify()
+
+def _put(item, nbytes):
+    global _in_q_bytes
+
+    with _cv:
+        _in_q.append(item)
+        _in_q_bytes += nbytes
+        _cv.notify()
+
+def _run():
+    global _in_q_bytes
+
+    while True:
+        with _cv:
+            while len(_in_q) == 0:
+                _cv.wait()
+            item = _in_q.popleft()
+            if isinstance(item, bytes):
+                _in_q_bytes -= len(item)
+        try:
+            if isinstance(item, bytes):
+                _parse(item)
+            elif isinstance(item, _StreamStart):
+                _start(item.fps)
+            elif item is _RESYNC:
+                resyncs.inc()
+                _resync()
+            elif item is _IDLE:
+                _go_idle()
+            else:
+                _stop()
+        except Exception as e:
+            logger.error("Live stream: %s", e)
+            resyncs.inc()
+            _resync()
+
+def _resync():
+    global _scan_pos, _au, _au_key, _synced
+
+    del _buf[:]
+    _scan_pos = 0
+    _au = []
+    _au_key = False
+    _synced = False
+    _drop_pending()
+
+def _go_idle():
+    # Frees chunks, init segment is made again with the next key frame.
+    global _chunks_bytes, _cur_params, _cur_init_id
+
+    _resync()
+    _cur_params = None
+    _cur_init_id = None
+    with _lock:
+        _chunks.clear()
+        _chunks_bytes = 0
+        _inits.clear()
+    logger.info("Live stream idle")
+
+def _drop_pending():
+    global _pending, _pending_bytes, _pending_duration
+
+    _pending = []
+    _pending_bytes = 0
+    _pending_duration = 0
+
+def _start(fps):
+    global _frame_duration, _ended
+
+    # Rest of the previous segment.
+    _flush_buffer()
+    _frame_duration = int(round(fmp4.TIMESCALE / fps))
+    with _lock:
+        _ended = False
+
+def _stop():
+    global _ended
+
+    _flush_buffer()
+    _close_chunk()
+    with _lock:
+        _ended = True
+
+def _flush_buffer():
+    global _scan_pos
+
+    start = _buf.find(_START_CODE)
+    if start >= 0:
+        _on_nal(bytes(_buf[start + 3:]).rstrip(b'\x00'))
+    del _buf[:]
+    _scan_pos = 0
+    _finish_au()
+
+def _parse(data):
+    # Splits Annex B byte stream into NAL units, the last one stays in
+    # _buf until the next start code.
+    global _scan_pos
+
+    _buf.extend(data)
+    start = _buf.find(_START_CODE)
+    if start < 0:
+        _scan_pos = max(0, len(_buf) - 2)
+        return
+    pos = max(start + 3, _scan_pos)
+    while True:
+        nxt = _buf.find(_START_CODE, pos)
+        if nxt < 0:
+            break
+        _on_nal(bytes(_buf[start + 3:nxt]).rstrip(b'\x00'))
+        start = nxt
+        pos = nxt + 3
+    del _buf[:start]
+    # Start code may be split between two writes.
+    _scan_pos = max(3, len(_buf) - 2)
+
+def _on_nal(nal):
+    global _sps, _pps, _au_key
+
+    if len(nal) == 0:
+        return
+    nal_type = nal[0] & 0x1f
+    if nal_type in (fmp4.NAL_SLICE, fmp4.NAL_IDR):
+        # first_mb_in_slice == 0 starts a new picture.
+        if len(nal) > 1 and nal[1] & 0x80:
+            _finish_au()
+        _au.append(nal)
+        if nal_type == fmp4.NAL_IDR:
+            _au_key = True
+        return
+    _finish_au()
+    if nal_type == fmp4.NAL_SPS:
+        _sps = nal
+    elif nal_type == fmp4.NAL_PPS:
+        _pps = nal
+    # AUD and SEI are not needed.
+
+def _finish_au():
+    global _au, _au_key
+
+    if len(_au) == 0:
+        return
+    sample = fmp4.avcc_sample(_au)
+    key = _au_key
+    _au = []
+    _au_key = False
+    _add_sample(sample, key)
+
+def _add_sample(data, key):
+    global _synced, _decode_time, _pending_bytes, _pending_start
+    global _pending_duration, _cur_params, _cur_init_id
+
+    if key and _sps is not None and _pps is not None:
+        if (_sps, _pps) != _cur_params:
+            _close_chunk()
+            _cur_params = (_sps, _pps)
+            _cur_init_id = hashlib.sha1(_sps + _pps).hexdigest()[:12]
+            with _lock:
+                if _cur_init_id not in _inits:
+                    _inits[_cur_init_id] = fmp4.init_segment(_sps, _pps)
+        elif _pending_duration >= config.LIVE_CHUNK_SEC * fmp4.TIMESCALE:
+            _close_chunk()
+        _synced = True
+    if not _synced:
+        return
+
+    if len(_pending) == 0:
+        _pending_start = _decode_time
+    _pending.append((data, _frame_duration, key))
+    _pending_bytes += len(data)
+    _pending_duration += _frame_duration
+    if len(_subscribers) > 0:
+        _publish(data, key)
+    _decode_time += _frame_duration
+    if _pending_bytes > config.LIVE_MAX_BYTES // 2:
+        # Key frames too rare for the memory budget.
+        logger.warning("Live chunk too large, dropped")
+        _drop_pending()
+        _synced = False
+
+def _publish(data, key):
+    # Frame to live view clients, new ones get all frames of the
+    # pending chunk, which starts with a key frame.
+    global _frag_seq
+
+    with _lock:
+        subs = list(_subscribers)
+        init = _inits.get(_cur_init_id)
+    codec = fmp4.codec_string(_cur_params[0])
+    fragment = None
+    for sub in subs:
+        if sub.new:
+            sub.new = False
+            _frag_seq += 1
+            sub.push(_cur_init_id, init, codec, fmp4.fragment(_frag_seq,
+                        _pending_start, _pending), True)
+            continue
+        if fragment is None:
+            _frag_seq += 1
+            fragment = fmp4.fragment(_frag_seq, _decode_time,
+                                    [(data, _frame_duration, key)])
+        sub.push(_cur_init_id, init, codec, fragment, key)
+
+def _close_chunk():
+    global _chunks_bytes, _next_seq, _disc_seq
+
+    if len(_pending) == 0:
+        return
+    with _lock:
+        seq = _next_seq
+        _next_seq += 1
+    data = fmp4.fragment(seq + 1, _pending_start, _pending)
+    chunk = Chunk(seq, _pending_duration / fmp4.TIMESCALE, data,
+                _cur_init_id)
+    _drop_pending()
+
+    with _lock:
+        _chunks.append(chunk)
+        _chunks_bytes += len(data)
+        while len(_chunks) > 1 and (
+                len(_chunks) > config.LIVE_WINDOW_CHUNKS
+                or _chunks_bytes > config.LIVE_MAX_BYTES):
+            old = _chunks.popleft()
+            _chunks_bytes -= len(old.data)
+            # Discontinuity before the new first chunk leaves the
+            # playlist.
+            if _chunks[0].init_id != old.init_id:
+                _disc_seq += 1
+        used = set(c.init_id for c in _chunks)
+        used.add(_cur_init_id)
+        for init_id in list(_inits.keys()):
+            if init_id not in used:
+                del _inits[init_id]
+
+def playlist():
+    # Sliding window media playlist, None before the first chunk.
+    touch()
+    with _lock:
+        chunks = list(_chunks)
+        disc_seq = _disc_seq
+        ended = _ended
+    if len(chunks) == 0:
+        return None
+    lines = ["#EXTM3U",
+            "#EXT-X-VERSION:7",
+            "#EXT-X-TARGETDURATION:{0}".format(
+                max(int(math.ceil(c.duration)) for c in chunks)),
+            "#EXT-X-MEDIA-SEQUENCE:{0}".format(chunks[0].seq),
+            "#EXT-X-DISCONTINUITY-SEQUENCE:{0}".format(disc_seq),
+            "#EXT-X-INDEPENDENT-SEGMENTS"]
+    init_id = None
+    for c in chunks:
+        if c.init_id != init_id:
+            if init_id is not None:
+                lines.append("#EXT-X-DISCONTINUITY")
+            lines.append('#EXT-X-MAP:URI="{0}{1}{2}{3}"'.format(
+                        FILES_PATH, _INIT_PREFIX, c.init_id,
+                        _INIT_EXTENSION))
+            init_id = c.init_id
+        lines.append("#EXTINF:{0:.3f},".format(c.duration))
+        lines.append("{0}{1}-{2}{3}".format(FILES_PATH, _run_id, c.seq,
+                                            _CHUNK_EXTENSION))
+    if ended:
+        lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+def get_file(name):
+    # Init segment or chunk by file name, None when not (or no longer)
+    # held.
+    touch()
+    with _lock:
+        if name.startswith(_INIT_PREFIX) and name.endswith(_INIT_EXTENSION):
+            return _inits.get(name[len(_INIT_PREFIX):-len(_INIT_EXTENSION)])
+        if not name.endswith(_CHUNK_EXTENSION):
+            return None
+        run_id, _, seq = name[:-len(_CHUNK_EXTENSION)].partition('-')
+        if run_id != _run_id:
+            return None
+        for c in _chunks:
+            if str(c.seq) == seq:
+                return c.data
+    return None
+
+class Subscriber:
+    # Live view client. Messages are (text, None) with codec info
+    # before each init segment, or (None, bytes) for init segments and
+    # fragments.
+
+    def __init__(self):
+        self._cv = threading.Condition()
+        self._q = collections.deque()
+        self._q_bytes = 0
+        self._init_id = None
+        self._waiting_key = True
+        # First push gives the frames since the last key frame.
+        self.new = True
+
+    def push(self, init_id, init, codec, fragment, key):
+        # Called from live thread, never blocks.
+        with self._cv:
+            if self._q_bytes + len(fragment) > config.LIVE_CLIENT_QUEUE_BYTES:
+                client_skips.inc()
+                self._q.clear()
+                self._q_bytes = 0
+                # Init segment may have been dropped unsent.
+                self._init_id = None
+                self._waiting_key = True
+            if self._waiting_key:
+                if not key:
+                    return
+                self._waiting_key = False
+            if init_id != self._init_id:
+                self._init_id = init_id
+                self._q.append((json.dumps({'codec': codec}), None))
+                self._q.append((None, init))
+                self._q_bytes += len(init)
+            self._q.append((None, fragment))
+            self._q_bytes += len(fragment)
+            self._cv.notify()
+
+    def get(self, timeout):
+        # Next message, None on timeout.
+        with self._cv:
+            if len(self._q) == 0:
+                self._cv.wait(timeout)
+            if len(self._q) == 0:
+                return None
+            text, data = self._q.popleft()
+            if data is not None:
+                self._q_bytes -= len(data)
+            return text, data
+
+def subscribe():
+    sub = Subscriber()
+    with _lock:
+        _subscribers.append(sub)
+    return sub
+
+def unsubscribe(sub):
+    with _lock:
+        if sub in _subscribers:
+            _subscribers.remove(sub)
@@ -30,6 +30,9 @@ import traceback
 
 import webinterface
 import recorder
+import hal
+import tracing
+import wear
 from command import Command
 import config
 
@@ -41,6 +44,13 @@ parser.add_argument("-r", "--records-location",
 parser.add_argument("-L", "--loglevel", 
             help="Log level threshold",
             default="info")
+parser.add_argument("--hw", 
+            help="Hardware backend, 'fake' runs without Pi camera",
+            choices=[hal.BACKEND_PI, hal.BACKEND_FAKE],
+            default=config.HARDWARE_BACKEND)
+parser.add_argument("--trace", 
+            help="Record recording stage spans, see /trace.json",
+            action="store_true")
 
 args = parser.parse_args()
 
@@ -76,6 +86,7 @@ logging.basicConfig(format='%(module)s:%(lineno)s:%(levelname)s:%(message)s',
         level=loglevel)
 
 logger = logging.getLogger(__name__)
+wear.count_log_writes()
 
 try:
     if user_dir_error[0]: 
@@ -93,6 +104,10 @@ try:
 
     util.delete_old_logs(config.RECORDS_LOCATION, config.KEEP_OLD_LOGS_FOR_DAYS)
 
+    hal.init(args.hw)
+    if args.trace:
+        tracing.enabled = True
+    
     # Global command queue
     cmd_q = queue.Queue()
 
@@ -152,6 +167,9 @@ try:
             # Activate that here.
             request.done()
         elif request.cmd == Command.CMD_SET_LOCATION_SPEED:
+            recorder.set_location(request.data)
+            request.done()
+        elif request.cmd == Command.CMD_LOCK_RECORD:
             recorder.queue_commands(request)
 
 except Exception as e:
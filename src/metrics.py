@@ -0,0 +1,198 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Numeric telemetry in Prometheus text exposition format, served by
+# web interface at /metrics.
+#
+# Counters are updated without locks: every thread adds to its own
+# cell and cells are summed when metrics are read. Lock is taken only
+# the first time a thread touches a counter and while reading, cells
+# of finished threads are then folded into one value.
+# Gauges are either set directly or computed by a function when read.
+
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def _register(m):
+    with _registry_lock:
+        _registry.append(m)
+    return m
+
+def _format_value(v):
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+class Counter:
+    def __init__(self, name, help_text, register=True):
+        self.name = name
+        self.help = help_text
+        self._local = threading.local()
+        # [value, owner thread]
+        self._cells = []
+        # Values of cells of finished threads.
+        self._retired = 0
+        self._lock = threading.Lock()
+        if register:
+            _register(self)
+
+    def inc(self, n=1):
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = [0, threading.current_thread()]
+            with self._lock:
+                # Short lived threads (one per HTTP request) would
+                # otherwise leave their cells behind until read.
+                self._retire_dead()
+                self._cells.append(cell)
+            self._local.cell = cell
+        cell[0] += n
+
+    def _retire_dead(self):
+        # Called with lock held.
+        alive = []
+        for cell in self._cells:
+            if cell[1].is_alive():
+                alive.append(cell)
+            else:
+                # Thread is gone, its cell will not change again.
+                self._retired += cell[0]
+        self._cells = alive
+
+    def get(self):
+        with self._lock:
+            self._retire_dead()
+            return self._retired + sum(cell[0] for cell in self._cells)
+
+    def collect(self):
+        return [("# HELP {0} {1}".format(self.name, self.help)),
+                ("# TYPE {0} counter".format(self.name)),
+                "{0} {1}".format(self.name, _format_value(self.get()))]
+
+class Gauge:
+    def __init__(self, name, help_text, func=None):
+        # func - optional callable returning current value, or None
+        #   when not available.
+        self.name = name
+        self.help = help_text
+        self._func = func
+        self._value = 0
+        _register(self)
+
+    def set(self, v):
+        self._value = v
+
+    def get(self):
+        if self._func:
+            return self._func()
+        return self._value
+
+    def set_function(self, func):
+        self._func = func
+
+    def collect(self):
+        try:
+            v = self.get()
+        except Exception as e:
+            logger.debug("%s: %s", self.name, e)
+            v = None
+        lines = [("# HELP {0} {1}".format(self.name, self.help)),
+                ("# TYPE {0} gauge".format(self.name))]
+        if v is not None:
+            lines.append("{0} {1}".format(self.name, _format_value(v)))
+        return lines
+
+class Summary:
+    # Count and sum of observations, e.g. latencies.
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._count = Counter(name + "_count", "", register=False)
+        self._sum = Counter(name + "_sum", "", register=False)
+        _register(self)
+
+    def observe(self, v):
+        self._count.inc()
+        self._sum.inc(v)
+
+    def collect(self):
+        return [("# HELP {0} {1}".format(self.name, self.help)),
+                ("# TYPE {0} summary".format(self.name)),
+                "{0}_count {1}".format(self.name, self._count.get()),
+                "{0}_sum {1}".format(self.name,
+                                    _format_value(float(self._sum.get())))]
+
+def render():
+    with _registry_lock:
+        ms = list(_registry)
+    lines = []
+    for m in ms:
+        lines.extend(m.collect())
+    return "\n".join(lines) + "\n"
+
+_start_time = time.monotonic()
+
+# Metrics updated by other modules.
+segments = Counter("dashcam_segments_total",
+                "Recorded segments finished by the writer.")
+segment_duration = Summary("dashcam_segment_duration_seconds",
+                "Duration of finished segments.")
+frames_received = Counter("dashcam_frames_received_total",
+                "Video frames received from encoder.")
+frames_dropped = Counter("dashcam_frames_dropped_total",
+                "Estimated video frames lost before the writer.")
+writer_bytes = Counter("dashcam_writer_bytes_total",
+                "Video bytes given to ffmpeg or written to records.")
+writer_spilled_bytes = Counter("dashcam_writer_spilled_bytes_total",
+                "Video bytes that overflowed writer queue into spill file.")
+writer_dropped_bytes = Counter("dashcam_writer_dropped_bytes_total",
+                "Video bytes lost because spill file could not be written.")
+writer_queue_bytes = Gauge("dashcam_writer_queue_bytes",
+                "Video bytes queued in writer of current segment.")
+writer_queue_high_water_bytes = Gauge(
+                "dashcam_writer_queue_high_water_bytes",
+                "Writer queue high-water mark of last finished segment.")
+disk_free_bytes = Gauge("dashcam_disk_free_bytes",
+                "Free bytes on records disk.")
+disk_used_percent = Gauge("dashcam_disk_used_percent",
+                "Used space of records disk in percent.")
+cpu_temperature = Gauge("dashcam_cpu_temperature_celsius",
+                "SoC temperature.")
+governor_level = Gauge("dashcam_governor_level",
+                "Current thermal and load governor level, 0 is best quality.")
+http_requests = Counter("dashcam_http_requests_total",
+                "HTTP requests handled by web interface.")
+http_bytes = Counter("dashcam_http_response_bytes_total",
+                "Bytes sent by web interface.")
+ble_writes = Counter("dashcam_ble_writes_total",
+                "BLE characteristic writes received.")
+ble_writes_coalesced = Counter("dashcam_ble_writes_coalesced_total",
+                "BLE writes replaced by a newer one before being handled.")
+ble_notifications = Counter("dashcam_ble_notifications_total",
+                "BLE characteristic value notifications sent.")
+command_latency = Summary("dashcam_command_latency_seconds",
+                "Time from command creation until it is done.")
+uptime = Gauge("dashcam_uptime_seconds", "Program uptime.",
+                lambda: round(time.monotonic() - _start_time, 1))
@@ -18,44 +18,171 @@
 
 import subprocess
 import threading
-import queue
+import collections
 import traceback
 import logging
 import io
-import shutil
+import os
+import time
+import zlib
+
+import tracing
+import metrics
+import wear
+import blockwriter
+import arbiter
+import config
 
 logger = logging.getLogger(__name__)
 
+# Frame types of picamera.PiVideoFrameType which are not video frames.
+_FRAME_TYPE_SPS_HEADER = 2
+_FRAME_TYPE_MOTION_DATA = 3
+
 class MP4Writer:
     # Converts h264 video from camera to mp4 format with ffmpeg on the
     # fly. Class instance can be passed as argument where file object
     # is expected.
     
-    MAX_QUEUE_SIZE = 50
+    # Memory budget of queued video in bytes, beyond this video is 
+    # spilled to a file.
+    MAX_QUEUE_BYTES = config.WRITER_MAX_QUEUE_BYTES
+    # Part of MAX_QUEUE_BYTES for chunks on their way to spill file.
+    MAX_SPILL_QUEUE_BYTES = config.WRITER_SPILL_QUEUE_BYTES
     # Video buffer size to hold before commiting to queue.
     MAX_VIDEO_BIO_SIZE = 1*1024*1024
     
+    # Output backends, see config.WRITER_BACKEND
+    BACKEND_FFMPEG = "ffmpeg"
+    BACKEND_FFMPEG_PIPE = "ffmpeg-pipe"
+    BACKEND_RAW = "raw"
+    
+    # Chunk size of reads from ffmpeg output.
+    PIPE_READ_SIZE = 256*1024
+    
     def __init__(self, filepath="o.mp4", fps=30, 
-                input_format="h264", codec="copy"):
+                input_format="h264", codec="copy",
+                frame_source=None, on_finish=None, backend=None,
+                slot=None, tap=None):
+        # slot - optional slots.SlotFile to write into instead of 
+        #   creating filepath.
+        # tap - optional callable given all video data as written by
+        #   camera, e.g. live.feed. Must not block.
         self._filepath = filepath
         self._fps = fps
         self._iformat = input_format
         self._codec = codec
+        # Optional callable returning metadata (picamera.PiVideoFrame) 
+        # of the last frame given to write(), e.g. lambda: camera.frame 
+        self._frame_source = frame_source
+        # Optional callable, called from writer thread with get_stats()
+        # after ffmpeg exits.
+        self._on_finish = on_finish
+        self._tap = tap
+        
+        # Segment counters, see get_stats()
+        self._frames_received = 0
+        self._frames_gap = 0
+        self._last_frame_ts = None
+        self._blocked_sec = 0.0
+        self._max_blocked_sec = 0.0
+        self._q_high_water_bytes = 0
+        self._spilled_bytes = 0
+        self._dropped_bytes = 0
+        self._bytes_received = 0
+        self._bytes_written = 0
+        self._file_bytes = None
+        self._file_crc = None
+        self._exit_code = None
+        
+        self._backend = backend if backend else config.WRITER_BACKEND
+        if slot and self._backend == MP4Writer.BACKEND_FFMPEG:
+            # ffmpeg can't write into an existing file.
+            self._backend = MP4Writer.BACKEND_FFMPEG_PIPE
+        self._proc = None
+        self._slot = slot
+        # Output file of pipe and raw backends.
+        self._dst = None
+        self._th_pipe = None
+        if self._backend == MP4Writer.BACKEND_FFMPEG:
+            # For fast playback in browser use option -movflags faststart.
+            # Write input to process stdin.
+            ffmpeg_cmd = """ffmpeg -v 16 -framerate {0} -f {1}
+                        -i pipe:0 -codec {2} -movflags faststart
+                        -y -f mp4 {3}""".format(
+                            self._fps,
+                            self._iformat,
+                            self._codec,
+                            self._filepath)
+            
+            self._proc = subprocess.Popen(
+                                    arbiter.recording_command_prefix()
+                                    + ffmpeg_cmd.split(), 
+                                    stdin=subprocess.PIPE)
+            self._out = self._proc.stdin
+        elif self._backend == MP4Writer.BACKEND_FFMPEG_PIPE:
+            # Fragmented mp4 needs no seeking back, file is playable
+            # while being written and after a power cut.
+            ffmpeg_cmd = """ffmpeg -v 16 -framerate {0} -f {1}
+                        -i pipe:0 -codec {2} 
+                        -movflags frag_keyframe+empty_moov+default_base_moof
+                        -f mp4 pipe:1""".format(
+                            self._fps,
+                            self._iformat,
+                            self._codec)
+            
+            self._dst = self._open_dst()
+            self._proc = subprocess.Popen(
+                                    arbiter.recording_command_prefix()
+                                    + ffmpeg_cmd.split(), 
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+            self._out = self._proc.stdin
+            self._th_pipe = threading.Thread(target=self._copy_output)
+            self._th_pipe.daemon = True
+            self._th_pipe.start()
+        elif self._backend == MP4Writer.BACKEND_RAW:
+            # In-house writer, video is stored as it is.
+            self._dst = self._open_dst()
+            self._out = self._dst
+        else:
+            raise ValueError("Unknown writer backend: " + str(self._backend))
+        
+        # Queue of video chunks in memory, bounded by MAX_QUEUE_BYTES
+        # less MAX_SPILL_QUEUE_BYTES. Protected by _cv.
+        self._cv = threading.Condition()
+        self._video_q = collections.deque()
+        self._video_q_bytes = 0
+        self._closed = False
+        self._failed = False
+        
+        # Append only spill file, used once memory budget is exceeded.
+        # Video is consumed in order from _video_q, the spill file and
+        # _spill_q. Once spilling starts every new chunk goes to
+        # _spill_q, behind the spill file, until both are drained. The
+        # spill thread moves _spill_q into the file, so camera callback
+        # waits for the card only when _spill_q is full, i.e. the card
+        # is slower than the camera. When spilling fails chunks stay in
+        # _spill_q, in memory but still in order, and those which don't
+        # fit are dropped.
+        self._spill_q = collections.deque()
+        self._spill_q_bytes = 0
+        # Chunk being written to spill file by spill thread.
+        self._spill_inflight = 0
+        self._spill_failed = False
+        self._spill_stop = False
+        self._th_spill = None
+        spill_dir = config.WRITER_SPILL_LOCATION
+        # Only spills on records disk count towards card wear.
+        self._spill_wear = not spill_dir
+        if not spill_dir:
+            spill_dir = config.RECORDS_LOCATION
+        self._spill_path = (spill_dir + '/' 
+                        + os.path.basename(self._filepath) + ".spill")
+        self._spill_fd = None
+        self._spill_wpos = 0
+        self._spill_rpos = 0
         
-        # For fast playback in browser use option -movflags faststart.
-        # Write input to process stdin.
-        ffmpeg_cmd = """ffmpeg -v 16 -framerate {0} -f {1}
-                    -i pipe:0 -codec {2} -movflags faststart
-                    -y -f mp4 {3}""".format(
-                        self._fps,
-                        self._iformat,
-                        self._codec,
-                        self._filepath)
-        
-        self._proc = subprocess.Popen(ffmpeg_cmd.split(), 
-                                stdin=subprocess.PIPE)
-                                
-        self._video_q = queue.Queue(MP4Writer.MAX_QUEUE_SIZE)
         self._video_bio_size = 0
         self._video_bio = io.BytesIO()
         
@@ -63,33 +190,265 @@ class MP4Writer:
         self._th.daemon = True
         self._th.start()
         
+    def _open_dst(self):
+        f = self._slot if self._slot else open(self._filepath, 'wb',
+                                            buffering=0)
+        return blockwriter.BlockWriter(f)
+        
     def write(self, vdata):
         # Passing process stdin directly to picamera causes frame
         # drop in full-hd 30 fps format even with large buffer size
         # in the beginning few seconds. This is an alternative 
         # implementation to queue frames until subprocess 
-        # catches up. If MAX_QUEUE_SIZE is also not sufficient then
-        # frames will be dropped.
+        # catches up. If MAX_QUEUE_BYTES is exceeded then frames are
+        # spilled to a file, this function never waits for the 
+        # subprocess, only for the spill file when it falls behind.
         
         # Buffered IO consumes all given data.
         self._video_bio.write(vdata)
         self._video_bio_size += len(vdata)
+        self._bytes_received += len(vdata)
+        
+        if self._tap:
+            try:
+                self._tap(vdata)
+            except Exception as e:
+                logger.debug(e)
+        
+        if self._frame_source:
+            try:
+                self._count_frame(self._frame_source())
+            except Exception as e:
+                # Accounting must never stop the recording.
+                logger.debug(e)
         
         if self._video_bio_size >= MP4Writer.MAX_VIDEO_BIO_SIZE:
-            self._video_q.put(self._video_bio)
-            self._video_bio = io.BytesIO()
-            self._video_bio_size = 0
+            self._commit()
+    
+    def _count_frame(self, frame):
+        # A frame may be delivered in multiple writes, count it once 
+        # on its last write.
+        if frame is None or not frame.complete:
+            return
+        if frame.frame_type in (_FRAME_TYPE_SPS_HEADER, 
+                            _FRAME_TYPE_MOTION_DATA):
+            return
+        
+        self._frames_received += 1
+        
+        # Timestamps are in microseconds and can be None at the start.
+        if frame.timestamp is None:
+            return
+        if self._last_frame_ts is not None:
+            interval = 1000000.0 / self._fps
+            missing = round((frame.timestamp - self._last_frame_ts) 
+                            / interval) - 1
+            if missing > 0:
+                self._frames_gap += missing
+        self._last_frame_ts = frame.timestamp
             
     def flush(self):
         if self._video_bio_size > 0:
-            self._video_q.put(self._video_bio)
-            self._video_bio = io.BytesIO()
-            self._video_bio_size = 0
+            self._commit()
             
+    def _commit(self):
+        data = self._video_bio.getvalue()
+        self._video_bio.close()
+        self._video_bio = io.BytesIO()
+        self._video_bio_size = 0
+        
+        t = time.monotonic()
+        with self._cv:
+            if self._failed:
+                # Nobody is going to consume it.
+                return
+            
+            if (self._spilling() or (self._video_q_bytes + len(data) 
+                                    > MP4Writer.MAX_QUEUE_BYTES
+                                    - MP4Writer.MAX_SPILL_QUEUE_BYTES)):
+                if not self._spilling():
+                    logger.warning("Writer queue full (%s bytes), "
+                                "spilling to %s", self._video_q_bytes,
+                                self._spill_path)
+                # Wait for spill thread to make room, total memory stays
+                # within MAX_QUEUE_BYTES.
+                while (not self._failed and not self._spill_failed
+                        and not self._spill_stop and self._spill_full(data)):
+                    self._cv.wait()
+                if self._failed:
+                    return
+                if self._spill_full(data):
+                    # Spill file is gone, losing video beats running out
+                    # of memory. Decoder picks up at the next keyframe.
+                    self._dropped_bytes += len(data)
+                    metrics.writer_dropped_bytes.inc(len(data))
+                    return
+                self._spill_q.append(data)
+                self._spill_q_bytes += len(data)
+                self._start_spill_thread()
+            else:
+                self._video_q.append(data)
+                self._video_q_bytes += len(data)
+            
+            backlog = self.get_backlog_bytes()
+            if backlog > self._q_high_water_bytes:
+                self._q_high_water_bytes = backlog
+            self._cv.notify_all()
+        
+        t = time.monotonic() - t
+        self._blocked_sec += t
+        if t > self._max_blocked_sec:
+            self._max_blocked_sec = t
+    
+    def get_backlog_bytes(self):
+        # Video bytes queued in memory and spill file yet to be given
+        # to ffmpeg. No locking, value is approximate.
+        return (self._video_q_bytes 
+                + self._spill_wpos - self._spill_rpos
+                + self._spill_inflight + self._spill_q_bytes)
+    
+    def get_readable_bytes(self):
+        # Length of the record file that can be read (and played) 
+        # while it is being written, None when the file is valid only
+        # once finished (ffmpeg backend moves the index to the front 
+        # at the end).
+        if self._backend == MP4Writer.BACKEND_FFMPEG:
+            return None
+        return self._dst.get_written_bytes()
+    
+    def is_finished(self):
+        # File complete, all of get_readable_bytes() is final.
+        return not self._th.is_alive()
+    
+    def get_stats(self):
+        # Counters of this segment. frames_* are available only when
+        # frame_source is given. Write size histograms and output
+        # throughput are added when blocks are written, see 
+        # blockwriter.BlockWriter.get_stats()
+        stats = {
+            'frames_received': self._frames_received,
+            'frames_timestamp_gap': self._frames_gap,
+            'write_blocked_sec': round(self._blocked_sec, 3),
+            'write_max_blocked_sec': round(self._max_blocked_sec, 3),
+            'queue_high_water_bytes': self._q_high_water_bytes,
+            'spilled_bytes': self._spilled_bytes,
+            'dropped_bytes': self._dropped_bytes,
+            'bytes_received': self._bytes_received,
+            'bytes_written': self._bytes_written,
+            'file_bytes': self._file_bytes,
+            'ffmpeg_exit_code': self._exit_code
+        }
+        if isinstance(self._dst, blockwriter.BlockWriter):
+            stats.update(self._dst.get_stats())
+        elif self._file_crc is not None:
+            stats['crc32'] = self._file_crc
+            stats['crc32_source'] = "finalize"
+        return stats
+            
+    def _spilling(self):
+        # Called with _cv held. True while video waits behind the
+        # spill file.
+        return (self._spill_wpos > self._spill_rpos 
+                or self._spill_inflight > 0 or len(self._spill_q) > 0)
+    
+    def _spill_full(self, data):
+        # Called with _cv held. At least one chunk is always taken.
+        pending = self._spill_q_bytes + self._spill_inflight
+        return (pending > 0 and pending + len(data) 
+                                > MP4Writer.MAX_SPILL_QUEUE_BYTES)
+    
+    def _start_spill_thread(self):
+        # Called with _cv held.
+        if self._th_spill is None:
+            self._th_spill = threading.Thread(target=self._spill_loop)
+            self._th_spill.daemon = True
+            self._th_spill.start()
+    
+    def _spill_loop(self):
+        while True:
+            with self._cv:
+                while (not self._spill_stop and (self._spill_failed 
+                                            or len(self._spill_q) == 0)):
+                    self._cv.wait()
+                if self._spill_stop:
+                    return
+                data = self._spill_q.popleft()
+                self._spill_q_bytes -= len(data)
+                self._spill_inflight = len(data)
+                pos = self._spill_wpos
+            
+            # Region beyond _spill_wpos is written only by this thread
+            # and read only once _spill_wpos covers it.
+            try:
+                if self._spill_fd is None:
+                    self._spill_fd = os.open(self._spill_path, 
+                            os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+                written = 0
+                while written < len(data):
+                    written += os.pwrite(self._spill_fd, data[written:], 
+                                    pos + written)
+            except Exception as e:
+                # Last resort, keep it in memory rather than losing it.
+                logger.error("Spill failed: %s", e)
+                with self._cv:
+                    self._spill_q.appendleft(data)
+                    self._spill_q_bytes += len(data)
+                    self._spill_inflight = 0
+                    self._spill_failed = True
+                    self._cv.notify_all()
+                continue
+            
+            if self._spill_wear:
+                wear.add(wear.CATEGORY_SPILL, written)
+            self._spilled_bytes += written
+            metrics.writer_spilled_bytes.inc(written)
+            with self._cv:
+                self._spill_wpos += written
+                self._spill_inflight = 0
+                self._cv.notify_all()
+    
+    def _next_chunk(self):
+        # Returns next video chunk in order, None when writer is closed
+        # and everything is drained.
+        with self._cv:
+            while True:
+                if len(self._video_q) > 0:
+                    data = self._video_q.popleft()
+                    self._video_q_bytes -= len(data)
+                    return data
+                if self._spill_rpos < self._spill_wpos:
+                    pos = self._spill_rpos
+                    n = min(MP4Writer.MAX_VIDEO_BIO_SIZE, 
+                            self._spill_wpos - pos)
+                    break
+                if self._spill_inflight == 0 and len(self._spill_q) > 0:
+                    # Spill file drained and not keeping up (or failed),
+                    # the next chunk in order is in memory.
+                    data = self._spill_q.popleft()
+                    self._spill_q_bytes -= len(data)
+                    self._cv.notify_all()
+                    return data
+                if self._closed and not self._spilling():
+                    return None
+                self._cv.wait()
+        
+        # Spilled region is never modified once written, read it 
+        # without holding the lock.
+        data = os.pread(self._spill_fd, n, pos)
+        with self._cv:
+            self._spill_rpos += len(data)
+            if (self._spill_rpos == self._spill_wpos 
+                    and self._spill_inflight == 0):
+                # Drained, start the file over.
+                os.ftruncate(self._spill_fd, 0)
+                self._spill_rpos = 0
+                self._spill_wpos = 0
+        return data
+    
     def get_file_object(self):
         # If using underlying stdin file object directly then do 
         # not pass this instance as file object.  
-        return self._proc.stdin
+        return self._out
             
     def close(self):
         # Call this function to close writer thread 
@@ -97,24 +456,132 @@ class MP4Writer:
         self.flush()
         self._video_bio.close()
         self._video_bio_size = 0
-        self._video_q.put(None)
+        with self._cv:
+            self._closed = True
+            self._cv.notify_all()
         #self._th.join()
+    
+    def wait(self, timeout=None):
+        # Wait for writer thread to finish the file after close().
+        # Returns False on timeout.
+        self._th.join(timeout)
+        return not self._th.is_alive()
             
     def write_to_proc(self):
         while True:
             try:
-                bio = self._video_q.get()
-                if bio is None:
+                data = self._next_chunk()
+                if data is None:
                     break
-                bio.seek(0)
-                shutil.copyfileobj(bio, self._proc.stdin)
-                bio.close()
+                self._out.write(data)
+                self._bytes_written += len(data)
+                metrics.writer_bytes.inc(len(data))
             except Exception as e:
                 logger.error(traceback.format_exc())
                 logger.error(e)
+                with self._cv:
+                    self._failed = True
+                    self._video_q.clear()
+                    self._video_q_bytes = 0
+                    self._spill_q.clear()
+                    self._spill_q_bytes = 0
+                    self._cv.notify_all()
                 break
-                            
-        self._proc.stdin.flush()
-        # does close internally calls flush?
-        self._proc.stdin.close()
-        self._proc.wait()
+        
+        self._remove_spill()
+        
+        with tracing.span("writer finalize", 
+                        file=os.path.basename(self._filepath)):
+            try:
+                self._out.flush()
+                # does close internally calls flush?
+                self._out.close()
+            except Exception as e:
+                logger.error(e)
+            if self._th_pipe:
+                self._th_pipe.join()
+            if self._proc:
+                self._exit_code = self._proc.wait()
+                if self._exit_code != 0:
+                    logger.error("ffmpeg exited with code %s for %s", 
+                                self._exit_code, self._filepath)
+            if self._dst and self._dst is not self._out:
+                try:
+                    self._dst.close()
+                except Exception as e:
+                    logger.error(e)
+        self._count_file_writes()
+        self._checksum_file()
+        
+        if self._on_finish:
+            try:
+                self._on_finish(self.get_stats())
+            except Exception as e:
+                logger.error(traceback.format_exc())
+                logger.error(e)
+        
+    def _copy_output(self):
+        # Pipe backend: ffmpeg output to record file.
+        try:
+            while True:
+                data = self._proc.stdout.read1(MP4Writer.PIPE_READ_SIZE)
+                if not data:
+                    break
+                self._dst.write(data)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            logger.error(e)
+            # Unblock ffmpeg so that it can exit.
+            self._proc.kill()
+        
+    def _checksum_file(self):
+        # ffmpeg backend writes the file itself, read it back once 
+        # finished so scrubber has a checksum to compare with from its 
+        # first check. File is still in page cache.
+        if (self._backend != MP4Writer.BACKEND_FFMPEG 
+                or not config.WRITER_CHECKSUM or self._exit_code != 0):
+            return
+        crc = 0
+        try:
+            with tracing.span("writer checksum", 
+                            file=os.path.basename(self._filepath)):
+                with open(self._filepath, 'rb') as f:
+                    while True:
+                        data = f.read(MP4Writer.MAX_VIDEO_BIO_SIZE)
+                        if len(data) == 0:
+                            break
+                        crc = zlib.crc32(data, crc)
+        except OSError as e:
+            logger.error("Checksum of %s failed: %s", self._filepath, e)
+            return
+        self._file_crc = crc
+    
+    def _count_file_writes(self):
+        if self._slot:
+            # May already be renamed for reuse.
+            size = self._slot.valid_bytes
+        else:
+            try:
+                size = os.path.getsize(self._filepath)
+            except OSError:
+                return
+        self._file_bytes = size
+        wear.add(wear.CATEGORY_RECORDING, size)
+        if self._backend == MP4Writer.BACKEND_FFMPEG:
+            # faststart moves index to the front by rewriting the 
+            # whole file once muxing is done.
+            wear.add(wear.CATEGORY_FASTSTART, size)
+        
+    def _remove_spill(self):
+        with self._cv:
+            self._spill_stop = True
+            self._cv.notify_all()
+        if self._th_spill is not None:
+            self._th_spill.join()
+        with self._cv:
+            if self._spill_fd is not None:
+                os.close(self._spill_fd)
+                self._spill_fd = None
+                os.remove(self._spill_path)
+            self._spill_rpos = 0
+            self._spill_wpos = 0
@@ -0,0 +1,233 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Protected (locked) recordings.
+#
+# Locking moves a record and its summary from the recording loop into
+# config.PROTECTED_LOCATION, where loop overwrite never looks. Total
+# size of protected records is limited by PROTECTED_QUOTA_BYTES, a
+# lock that doesn't fit is refused. Records still being written are
+# locked once their writer has finished them.
+#
+# Unlocking moves the record back into the loop, it is overwritten
+# when the loop reaches its index again.
+#
+# lock() only updates bookkeeping, the file is moved by a mover
+# thread: a record already in secondary location is copied, which
+# must not hold up the recording loop (it locks on events) or _lock.
+# Until moved, get_record_path() gives its old path.
+
+import os
+import queue
+import shutil
+import threading
+import logging
+
+import config
+import catalog
+import metrics
+import arbiter
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# name -> size in bytes of protected records
+_records = {}
+# Records being written: name -> lock reason or None
+_in_progress = {}
+# Locked records not moved yet: name -> current path
+_moving = {}
+_move_q = queue.Queue()
+_th_mover = None
+
+# Record copied into protected location, renamed once complete.
+PART_EXTENSION = ".part"
+
+def init():
+    # Protected area is small, listed once at start.
+    os.makedirs(config.PROTECTED_LOCATION, exist_ok=True)
+    with _lock:
+        _records.clear()
+        for r in catalog.list_records(config.PROTECTED_LOCATION):
+            _records[r.name] = r.size
+    # Moves interrupted by a restart, the record is still in loop.
+    try:
+        for name in os.listdir(config.PROTECTED_LOCATION):
+            if name.endswith(PART_EXTENSION):
+                os.remove(config.PROTECTED_LOCATION + '/' + name)
+    except OSError as e:
+        logger.error(e)
+
+def get_used_bytes():
+    with _lock:
+        return sum(_records.values())
+
+def get_reserved_bytes():
+    # Part of quota not used yet, kept free by recording loop.
+    return max(0, config.PROTECTED_QUOTA_BYTES - get_used_bytes())
+
+metrics.Gauge("dashcam_protected_bytes",
+        "Bytes used by protected recordings.", get_used_bytes)
+metrics.Gauge("dashcam_protected_records",
+        "Number of protected recordings.", lambda: len(_records))
+locks = metrics.Counter("dashcam_protected_locks_total",
+        "Recordings locked, including automatic events.")
+
+def is_protected(name):
+    return name in _records
+
+def list_names():
+    with _lock:
+        return sorted(_records.keys())
+
+def get_record_path(name):
+    # Path of a record by file name, wherever it is.
+    name = os.path.basename(name)
+    path = _moving.get(name)
+    if path is not None:
+        return path
+    if name in _records:
+        return config.PROTECTED_LOCATION + '/' + name
+    path = catalog.ring_find(name)
+    if path is not None:
+        return path
+    return config.RECORDS_LOCATION + '/' + name
+
+def all_record_paths():
+    # Records of the loop ring and protected ones.
+    paths = catalog.ring_paths()
+    paths += [get_record_path(n) for n in list_names()]
+    return paths
+
+def get_summary():
+    return {
+        'records': len(_records),
+        'used_bytes': get_used_bytes(),
+        'quota_bytes': config.PROTECTED_QUOTA_BYTES
+    }
+
+def segment_started(name):
+    with _lock:
+        _in_progress[name] = None
+
+def segment_finished(name):
+    # Called once writer has finished the record and its summary.
+    with _lock:
+        reason = _in_progress.pop(name, None)
+    if reason is not None:
+        lock(name, reason)
+
+def lock(name, reason):
+    # Returns (ok, message).
+    name = os.path.basename(name)
+    if catalog.parse_index(name) is None:
+        return False, "Not a recording: " + name
+    with _lock:
+        if name in _records:
+            return True, name + " is already locked"
+        if name in _in_progress:
+            _in_progress[name] = reason
+            logger.info("%s will be locked when finished (%s)",
+                        name, reason)
+            return True, name + " will be locked when finished"
+
+        path = catalog.ring_find(name)
+        if path is None:
+            return False, name + " not found"
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return False, name + " not found"
+        used = sum(_records.values())
+        if used + size > config.PROTECTED_QUOTA_BYTES:
+            logger.warning("Not locking %s (%s): protected quota full",
+                        name, reason)
+            return False, "Protected quota full, unlock recordings first"
+        # Taken out of the ring first, so that loop can't overwrite it
+        # while it is moved.
+        if not catalog.ring_remove(path):
+            return False, name + " is being overwritten"
+
+        _records[name] = size
+        _moving[name] = path
+        _start_mover()
+    _move_q.put(name)
+    locks.inc()
+    logger.warning("Locked %s (%s)", name, reason)
+    return True, name + " locked"
+
+def _start_mover():
+    # Called with _lock held.
+    global _th_mover
+    if _th_mover is None:
+        _th_mover = threading.Thread(target=_mover, name="protect mover")
+        _th_mover.daemon = True
+        _th_mover.start()
+
+def _mover():
+    arbiter.deprioritize_current_thread()
+    while True:
+        name = _move_q.get()
+        with _lock:
+            path = _moving[name]
+        dst = config.PROTECTED_LOCATION + '/' + name
+        part = dst + PART_EXTENSION
+        try:
+            # Copied when record has been moved to secondary location.
+            shutil.move(path, part)
+            os.rename(part, dst)
+            try:
+                shutil.move(catalog.summary_path(path), 
+                            catalog.summary_path(dst))
+            except FileNotFoundError:
+                pass
+        except OSError as e:
+            logger.error("Moving locked %s failed: %s", name, e)
+            if os.path.exists(path):
+                try:
+                    os.remove(part)
+                except OSError:
+                    pass
+            with _lock:
+                del _moving[name]
+                del _records[name]
+            # Back into loop, unlocked.
+            if os.path.exists(path):
+                catalog.ring_add(catalog.parse_index(name), path)
+            continue
+        with _lock:
+            del _moving[name]
+
+def unlock(name):
+    name = os.path.basename(name)
+    with _lock:
+        if name not in _records:
+            return False, name + " is not locked"
+        if name in _moving:
+            return False, name + " is still being locked, try again"
+        src = config.PROTECTED_LOCATION + '/' + name
+        path = config.RECORDS_LOCATION + '/' + name
+        try:
+            os.rename(catalog.summary_path(src), catalog.summary_path(path))
+        except FileNotFoundError:
+            pass
+        os.rename(src, path)
+        del _records[name]
+        catalog.ring_add(catalog.parse_index(name), path)
+    logger.info("Unlocked %s", name)
+    return True, name + " unlocked"
@@ -19,12 +19,10 @@
 
 
 import time
-import picamera
 from datetime import datetime
 import json
 import os
 import subprocess
-import glob
 import sys
 import logging
 import util
@@ -33,6 +31,19 @@ import queue
 import traceback
 
 import mp4writer
+import governor
+import hal
+import tracing
+import metrics
+import wear
+import state
+import catalog
+import slots
+import arbiter
+import protect
+import tiering
+import scrub
+import live
 from command import Command
 import config
 
@@ -44,7 +55,8 @@ logger = logging.getLogger(__name__)
 CFG_ROT_KEY = 'rotation'
 
 # Index number of the current recording. Post reboot/power cycle
-# this number will be incremented before use.
+# this number will be incremented before use. Saved lazily, recordings
+# catalog tells the index actually reached (see catalog.recover_index).
 CFG_CURR_INDEX_KEY = 'cindex'
 
 # Loop when index number exceeds maximum files. Maximum number of 
@@ -57,24 +69,35 @@ CFG_MAX_FILES_KEY = 'max-files'
 # sd card life expectancy.
 CFG_N_LOOPS_KEY = 'n-loops'
 
-# Dictionary to save configuration settings.
-_cfg = { 
+# Lifetime write counters of wear module, saved along with the
+# configuration so that they cost no extra writes.
+CFG_WEAR_KEY = 'wear'
+
+# Default configuration settings.
+_CFG_DEFAULTS = { 
     CFG_ROT_KEY: 0,
     CFG_CURR_INDEX_KEY: 0,
     CFG_MAX_FILES_KEY:0,
     CFG_N_LOOPS_KEY: 0
 }
 
+# Configuration settings, state.StateStore created by init().
+_cfg = None
+
 KB = 1024
 MB = KB * KB
 
 # Read only variables for other modules.
+# Thermal and load governor, created when recording starts.
+video_governor = None
 # No synchronization. Merely to show on user interface.
 current_record_name = ""
 last_recorded_name = "Please wait for one recording to be over"
 n_loops = 0
 recording_on = False
 recording_status_text = ""
+# Summary of last finished segment, see _on_segment_finished()
+last_segment_stats = {}
 # -------------------------------------
 
 
@@ -85,6 +108,20 @@ _VIDEO_HEIGHT = config.HIGH_RES_VIDEO_HEIGHT
 _th_recorder = None
 _stop = True
 
+# Writer of the segment being recorded.
+_mp4wfile = None
+# Writers of records not finished yet, by record file name.
+_writers = {}
+# monotonic time current segment started
+_current_start = None
+
+# Last BLE speed (m/s) and its monotonic time for hard brake events.
+_last_speed = None
+# Newest BLE location not yet taken by recording loop, see
+# set_location().
+_location = None
+_location_lock = threading.Lock()
+
 
 _cpu_temp_subscribers = []
 _status_subscribers = []
@@ -93,15 +130,19 @@ _cmd_q = queue.Queue()
 
 # ---------------------------------------
 
+# Subscribers are called on recorder thread without the lock held,
+# they must return quickly (BLE only queues the notification).
 def _update_subs_on_status(status):
     with _subscribers_lock:
-        for s in _status_subscribers:
-            s(status)
+        subs = list(_status_subscribers)
+    for s in subs:
+        s(status)
         
 def _update_subs_on_cpu_temp(temp):
     with _subscribers_lock:
-        for s in _cpu_temp_subscribers:
-            s(temp)
+        subs = list(_cpu_temp_subscribers)
+    for s in subs:
+        s(temp)
             
 def subscribe_for_cpu_temp(cb):
     with _subscribers_lock:
@@ -112,41 +153,168 @@ def subscribe_for_status(cb):
         _status_subscribers.append(cb)
 
 
-def _cfg_save():
-    global _cfg
-    with open(config.CFG_FILE, 'w') as f:
-        json.dump(_cfg, f)
-
         
 def get_disk_space_info():
-    params = None
+    # Percent of disk space used on the "filesystem" where recordings
+    # are stored, in case multiple storage options are available in
+    # future.
     try:
-        # get disk space info of the "filesystem" where recordings 
-        # are stored, in case multiple storage options are available in
-        # future.
-        op = subprocess.check_output(['df',
-                        config.RECORDS_LOCATION]).decode('utf-8').split('\n')
-        params = op[1].split()                
-        params[4] = int(params[4].strip('%')) # Percent used
-        # params[1] = int(params[1]) * KB # Disk Size - bytes
-        # params[2] = int(params[2]) * KB # Used size - bytes
-        # params[3] = int(params[3]) * KB # Available size - bytes
-        # return (params[1], params[2], params[3], params[4])
-        return params[4]
+        return hal.disk.get_used_percent(config.RECORDS_LOCATION)
     except Exception as e:
         logger.error(e)
         logger.error(traceback.format_exc())
         return None
 
 
-
+def _writer_backlog_bytes():
+    w = _mp4wfile
+    if w is None:
+        return 0
+    return w.get_backlog_bytes()
+
+metrics.writer_queue_bytes.set_function(_writer_backlog_bytes)
+arbiter.set_backlog_source(_writer_backlog_bytes)
+metrics.governor_level.set_function(
+    lambda: video_governor.level if video_governor else None)
+metrics.disk_free_bytes.set_function(
+    lambda: hal.disk.get_free_bytes(config.RECORDS_LOCATION))
+metrics.disk_used_percent.set_function(get_disk_space_info)
+
+def _get_loop_used_percent(disk_used_space_percent):
+    # Disk use as seen by loop size decision: unused protected quota
+    # counts as used. With tiered storage the fuller of both
+    # locations decides.
+    try:
+        used = (disk_used_space_percent + protect.get_reserved_bytes()
+                * 100.0 / util.get_filesystem_size(config.RECORDS_LOCATION))
+        if tiering.enabled():
+            used = max(used, 
+                    hal.disk.get_used_percent(config.SECONDARY_LOCATION))
+        return used
+    except OSError as e:
+        logger.error(e)
+        return disk_used_space_percent
+
+def get_writer(name):
+    # MP4Writer of record file name while it is being written, else
+    # None.
+    return _writers.get(name)
+
+def get_unfinished_record_names():
+    # Records still being written, including previous segments whose
+    # ffmpeg is finishing the file.
+    names = set(_writers)
+    if recording_on:
+        names.add(current_record_name)
+    return names
+
+def lock_record(name=None, reason="user"):
+    # Locks recording name, or with None the current recording (and 
+    # the previous one when current has just started) as an event.
+    # Returns (ok, message), may be called from any thread.
+    if name is not None:
+        return protect.lock(name, reason)
+    
+    if not current_record_name:
+        return False, "Nothing recorded yet"
+    result = protect.lock(current_record_name, reason)
+    start = _current_start
+    if (start is not None and last_recorded_name != current_record_name
+            and time.monotonic() - start < config.EVENT_PRE_SEC
+            and catalog.parse_index(last_recorded_name) is not None):
+        protect.lock(last_recorded_name, reason)
+    return result
+
+def set_location(location_speed):
+    # Latest value wins, recording loop takes it once a second.
+    global _location
+    with _location_lock:
+        _location = location_speed
+
+def _take_location():
+    global _location
+    with _location_lock:
+        loc = _location
+        _location = None
+    return loc
+
+def _check_hard_brake(location_speed):
+    global _last_speed
+    
+    if (config.EVENT_HARD_BRAKE_MPS2 <= 0 
+            or not location_speed.is_speed_present()):
+        return
+    now = time.monotonic()
+    last = _last_speed
+    _last_speed = (location_speed.ispeed, now)
+    if last is None or now - last[1] <= 0 or now - last[1] > 5:
+        return
+    decel = (last[0] - location_speed.ispeed) / (now - last[1])
+    if decel >= config.EVENT_HARD_BRAKE_MPS2:
+        logger.warning("Hard braking %.1f m/s^2", decel)
+        lock_record(reason="hard braking")
+
+def get_current_segment_stats():
+    # Live counters of the segment being recorded.
+    w = _mp4wfile
+    if w is None:
+        return {}
+    return w.get_stats()
+    
+def _on_segment_finished(seg, stats):
+    # Called from mp4writer thread once ffmpeg has finished the file.
+    global last_segment_stats
+    
+    _writers.pop(seg['name'], None)
+    seg.update(stats)
+    if seg['frames_received'] > 0:
+        # Frames lost anywhere before the writer show up as fewer 
+        # frames than expected or as gaps between frame timestamps.
+        seg['frames_dropped'] = max(0, 
+                        seg['frames_expected'] - seg['frames_received'],
+                        seg['frames_timestamp_gap'])
+        # One frame either way is normal at segment boundaries.
+        if seg['frames_dropped'] > max(1, seg['frames_expected'] / 100):
+            logger.warning("%s: %s of %s frames dropped", seg['name'],
+                        seg['frames_dropped'], seg['frames_expected'])
+    else:
+        # No frame metadata available.
+        seg['frames_dropped'] = None
+    
+    last_segment_stats = seg
+    
+    metrics.segments.inc()
+    metrics.segment_duration.observe(seg['duration_sec'])
+    metrics.frames_received.inc(seg['frames_received'])
+    if seg['frames_dropped']:
+        metrics.frames_dropped.inc(seg['frames_dropped'])
+    metrics.writer_queue_high_water_bytes.set(seg['queue_high_water_bytes'])
+    
+    record_file = config.RECORDS_LOCATION + '/' + seg['name']
+    if not os.path.exists(record_file):
+        # Index already reused (very short loop), a summary now would
+        # never be deleted.
+        protect.segment_finished(seg['name'])
+        return
+    summary_file = catalog.summary_path(record_file)
+    data = json.dumps(seg)
+    with open(summary_file, 'w') as f:
+        f.write(data)
+    wear.add(wear.CATEGORY_SUMMARY, len(data))
+    protect.segment_finished(seg['name'])
+    tiering.segment_finished(record_file)
+    
 def init():
     global _cfg
     
     # Load existing configuration file or start fresh.
-    if os.path.exists(config.CFG_FILE):
-        with open(config.CFG_FILE, 'r') as f:
-            _cfg = json.load(f)
+    _cfg = state.StateStore(config.CFG_FILE, _CFG_DEFAULTS)
+    wear.restore(_cfg.get(CFG_WEAR_KEY))
+    wear.sample()
+    protect.init()
+    # Records are listed by the web interface (and archive, export)
+    # from the ring, also when the camera never comes up.
+    catalog.load_ring(tiering.list_records())
 
 def start():
     global _th_recorder
@@ -174,6 +342,24 @@ def _build_timestamp(forfile=True):
         return datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
 
 
+def _repair_interrupted_record(index, records):
+    # Slot record of given index may be left with old video after its
+    # end if recording was interrupted, i.e. it has no summary.
+    for r in records:
+        if r.index != index:
+            continue
+        if not os.path.exists(catalog.summary_path(r.path)):
+            try:
+                slots.repair(r.path)
+            except Exception as e:
+                logger.error("Repairing %s failed: %s", r.path, e)
+
+def _log_governor_level():
+    level = video_governor.level
+    logger.warning("Governor level changed to %s %s (%s)", level, 
+                    video_governor.get_level_params(),
+                    video_governor.reason if level > 0 else "load normal")
+
 def _loop_recoder():
     global _cfg
     global _stop
@@ -184,76 +370,103 @@ def _loop_recoder():
     global last_recorded_name
     global recording_on
     global recording_status_text
+    global _mp4wfile
+    global _current_start
+    global video_governor
     
     try:
         camera = None
+        video_governor = governor.Governor(
+                            trace_file=config.GOVERNOR_TRACE_FILE)
+        telemetry = governor.TelemetrySampler()
+        _VIDEO_WIDTH, _VIDEO_HEIGHT, video_fps, video_quality, \
+                video_bitrate = video_governor.get_level_params()
+        
         recording_status_text = "Initializing Pi Camera to {0}x{1} @ {2} fps".format(
-                    _VIDEO_WIDTH, _VIDEO_HEIGHT, config.VIDEO_FPS)
+                    _VIDEO_WIDTH, _VIDEO_HEIGHT, video_fps)
         logger.info(recording_status_text)
         _update_subs_on_status(recording_status_text)
         
+        # Only directory scan of records while recording, from here
+        # on loop ring is kept up to date.
+        records = tiering.list_records()
+        catalog.load_ring(records)
+
         # Initialize camera
-        camera = picamera.PiCamera()
+        camera = hal.open_camera()
         camera.resolution = (_VIDEO_WIDTH, _VIDEO_HEIGHT)
-        camera.framerate_range = (1, config.VIDEO_FPS)
-        camera.framerate = config.VIDEO_FPS
+        camera.framerate_range = (1, video_fps)
+        camera.framerate = video_fps
         camera.annotate_background = True
         fixed_annotation =  "RavikiranB.com"
         camera.annotate_text_size = config.ANNOTATE_TEXT_SIZE
-        current_rotation = _cfg[CFG_ROT_KEY]
+        current_rotation = _cfg.get(CFG_ROT_KEY)
         camera.rotation = current_rotation
     
         location_text = None
     
-        index = _cfg[CFG_CURR_INDEX_KEY] + 1
-        n_loops = _cfg[CFG_N_LOOPS_KEY]
+        # Locked records left the loop but still mark how far it got,
+        # an event lock is often followed by a power cut.
+        index = catalog.recover_index(_cfg.get(CFG_CURR_INDEX_KEY),
+                    _cfg.get(CFG_MAX_FILES_KEY),
+                    records + catalog.list_records(config.PROTECTED_LOCATION))
+        if config.RECORD_SLOT_MODE:
+            _repair_interrupted_record(index, records)
+        tiering.start(records, skip_index=index)
+        scrub.start()
+        index += 1
+        n_loops = _cfg.get(CFG_N_LOOPS_KEY)
         
         recording_status_text = "Starting Recording."
         _update_subs_on_status(recording_status_text)
         
         #webinterface.WebInterfaceHandler.program_start_time = datetime.now()
-        high_temp_triggered = False
         
         recording_on = True
     
         while not _stop:
             try:        
-                disk_used_space_percent = get_disk_space_info()
+                seg_trace = tracing.begin()
+                with tracing.span("disk check"):
+                    disk_used_space_percent = get_disk_space_info()
                     
-                if _cfg[CFG_MAX_FILES_KEY] == 0:
-                    if (disk_used_space_percent >= 
-                            config.MAX_USED_DISK_SPACE_PERCENT):
+                # Loop changes are saved right away together with 
+                # the index, other index changes are recovered from 
+                # catalog.
+                if _cfg.get(CFG_MAX_FILES_KEY) == 0:
+                    if (_get_loop_used_percent(disk_used_space_percent)
+                            >= config.MAX_USED_DISK_SPACE_PERCENT):
                         # From now on recording index will loop 
                         # back to zero when index 
                         # reaches _cfg[CFG_MAX_FILES_KEY]
-                        _cfg[CFG_MAX_FILES_KEY] = index
+                        _cfg.update({CFG_MAX_FILES_KEY: index,
+                                    CFG_CURR_INDEX_KEY: 0,
+                                    CFG_N_LOOPS_KEY: n_loops + 1},
+                                    durable=True)
                         index = 0
                         n_loops += 1
-                        _cfg[CFG_N_LOOPS_KEY] = n_loops
-                elif index >= _cfg[CFG_MAX_FILES_KEY]:
+                elif index >= _cfg.get(CFG_MAX_FILES_KEY):
                     index = 0
                     n_loops += 1
-                    _cfg[CFG_N_LOOPS_KEY] = n_loops
+                    _cfg.update({CFG_CURR_INDEX_KEY: index,
+                                CFG_N_LOOPS_KEY: n_loops}, durable=True)
                         
                 # Update SoC temperature in video annotation, to keep 
                 # track of resolution drop vs temp.
-                cpu_temp = util.get_cpu_temperature()
-                if cpu_temp >= config.TEMPERATURE_THRESHOLD_HIGH:
-                    if not high_temp_triggered:
-                        logger.warning("CPU temperature %s C exceeded threshold %s C",
-                                        cpu_temp, config.TEMPERATURE_THRESHOLD_HIGH)
-                        logger.warning("Reducing video resolution")
-                        _VIDEO_WIDTH = config.LOW_RES_VIDEO_WIDTH
-                        _VIDEO_HEIGHT = config.LOW_RES_VIDEO_HEIGHT
-                        camera.resolution = (_VIDEO_WIDTH, _VIDEO_HEIGHT)
-                        high_temp_triggered = True
-                elif cpu_temp <= config.TEMPERATURE_THRESHOLD_NORMAL:
-                    if high_temp_triggered:
-                        logger.warning("Restoring high video resolution")
-                        _VIDEO_WIDTH = config.HIGH_RES_VIDEO_WIDTH
-                        _VIDEO_HEIGHT = config.HIGH_RES_VIDEO_HEIGHT
-                        camera.resolution = (_VIDEO_WIDTH, _VIDEO_HEIGHT)
-                        high_temp_triggered = False
+                with tracing.span("temperature read"):
+                    cpu_temp = hal.thermal.get_cpu_temperature()
+                    metrics.cpu_temperature.set(cpu_temp)
+                    if video_governor.update(telemetry.sample(cpu_temp)):
+                        _log_governor_level()
+                
+                # Apply governor level, camera settings can't be 
+                # changed while recording.
+                _VIDEO_WIDTH, _VIDEO_HEIGHT, video_fps, video_quality, \
+                        video_bitrate = video_governor.get_level_params()
+                if camera.resolution != (_VIDEO_WIDTH, _VIDEO_HEIGHT):
+                    camera.resolution = (_VIDEO_WIDTH, _VIDEO_HEIGHT)
+                if camera.framerate != video_fps:
+                    camera.framerate = video_fps
                         
                 _update_subs_on_cpu_temp(cpu_temp)
                         
@@ -269,22 +482,64 @@ def _loop_recoder():
                 video_format_text = "RPi DashCam {0}x{1} @ {2}fps".format(
                                         _VIDEO_WIDTH,
                                         _VIDEO_HEIGHT,
-                                        config.VIDEO_FPS)
+                                        video_fps)
                 
-                _cfg[CFG_CURR_INDEX_KEY] = index
-                _cfg_save()
+                with tracing.span("config save"):
+                    wear.sample()
+                    _cfg.update({CFG_CURR_INDEX_KEY: index,
+                                CFG_WEAR_KEY: wear.to_dict()})
                 
                 # Delete old record with same index number, 
                 # Note: old record will have different time stamp on it. 
-                existing_records = glob.glob(config.RECORDS_LOCATION 
-                                    + '/' 
-                                    + rec_index +  '_*')
-                # There should be only one old record.
-                for record in existing_records:
-                    os.remove(record)
+                # In slot mode the old record file is reused. Locked
+                # records are not in the ring.
+                slot = None
+                with tracing.span("old file delete"):
+                    # There should be only one old record.
+                    reuse_path = None
+                    for record in catalog.ring_take(index):
+                        try:
+                            os.remove(catalog.summary_path(record))
+                        except FileNotFoundError:
+                            pass
+                        # Records moved to secondary location can't
+                        # be renamed back.
+                        if (config.RECORD_SLOT_MODE and reuse_path is None
+                                and os.path.dirname(record) 
+                                    == config.RECORDS_LOCATION):
+                            reuse_path = record
+                        else:
+                            try:
+                                os.remove(record)
+                            except FileNotFoundError:
+                                pass
+                    if config.RECORD_SLOT_MODE:
+                        slot = slots.SlotFile(rec_filepath, 
+                                            reuse_path=reuse_path)
+                    catalog.ring_add(index, rec_filepath)
+                    protect.segment_started(rec_filename)
                         
+                seg = {
+                    'name': rec_filename,
+                    'index': index,
+                    'start_time': rec_time,
+                    'width': _VIDEO_WIDTH,
+                    'height': _VIDEO_HEIGHT,
+                    'fps': video_fps,
+                    'governor_level': video_governor.level,
+                    'cpu_temp': cpu_temp,
+                    'duration_sec': 0,
+                    'frames_expected': 0
+                }
+                
+                live.stream_started(video_fps)
                 mp4wfile = mp4writer.MP4Writer(filepath=rec_filepath,
-                                fps=config.VIDEO_FPS)
+                                fps=video_fps,
+                                frame_source=lambda: camera.frame,
+                                on_finish=lambda stats, seg=seg:
+                                    _on_segment_finished(seg, stats),
+                                slot=slot,
+                                tap=live.feed if live.enabled() else None)
                 
                 # Uncomment the below call to record directly to the 
                 # underlying stdin object.
@@ -293,25 +548,34 @@ def _loop_recoder():
                 
                 # Or use queue mechanism of mp4writer, this will
                 # need more memory but no frame drops at higher resolutions.
-                camera.start_recording(mp4wfile, format='h264',
-                                quality=config.VIDEO_QUALITY)
+                with tracing.span("start_recording"):
+                    camera.start_recording(mp4wfile, format='h264',
+                                    quality=video_quality,
+                                    bitrate=video_bitrate)
+                rec_start = time.monotonic()
+                _current_start = rec_start
+                _mp4wfile = mp4wfile
+                _writers[rec_filename] = mp4wfile
                 
                 current_record_name = rec_filename
                                 
-                if high_temp_triggered:
-                    recording_status_text = "Temperature exceeded {0}&deg;C, " \
-                                    " video resolution reduced to {1}x{2}. " \
-                                    "High resolution will be restored after temperature drops " \
-                                    "below {3}&deg;C".format(
-                                    config.TEMPERATURE_THRESHOLD_HIGH,
+                if video_governor.level > 0:
+                    recording_status_text = "High {0}, " \
+                                    " video reduced to {1}x{2} @ {3} fps. " \
+                                    "Full quality will be restored after " \
+                                    "load drops, temperature below " \
+                                    "{4}&deg;C".format(
+                                    video_governor.reason,
                                     _VIDEO_WIDTH,
                                     _VIDEO_HEIGHT,
+                                    video_fps,
                                     config.TEMPERATURE_THRESHOLD_NORMAL)
                 else:
                     recording_status_text = "All OK"
                     
                 _update_subs_on_status(recording_status_text)
                 
+                wait_trace = tracing.begin()
                 seconds = 0 
                 while (not _stop) and (seconds < config.DURATION_SEC):
                     # update time
@@ -325,6 +589,10 @@ def _loop_recoder():
                                             + ' - '
                                             + fixed_annotation)
                     
+                    loc = _take_location()
+                    if loc is not None:
+                        location_text = str(loc)
+                        _check_hard_brake(loc)
                     if location_text:
                         camera.annotate_text += '\n' + location_text
                     
@@ -336,14 +604,16 @@ def _loop_recoder():
                             if current_rotation >= 360:
                                 current_rotation = 0
                             camera.rotation = current_rotation
-                            _cfg[CFG_ROT_KEY] = current_rotation
-                            _cfg_save()
+                            _cfg.set(CFG_ROT_KEY, current_rotation,
+                                    durable=True)
                             request.done()
                         elif request.cmd == Command.CMD_TAKE_LIVE_SNAPSHOT:
                             camera.capture(config.LIVESNAP_FILE, use_video_port=True)
+                            wear.add(wear.CATEGORY_SNAPSHOT, 
+                                    os.path.getsize(config.LIVESNAP_FILE))
                             request.done()
-                        elif request.cmd == Command.CMD_SET_LOCATION_SPEED:
-                            location_text = str(request.data)
+                        elif request.cmd == Command.CMD_LOCK_RECORD:
+                            lock_record(reason=request.data or "event")
                             request.done()
                     except queue.Empty:
                         pass
@@ -351,11 +621,34 @@ def _loop_recoder():
                     camera.wait_recording(1)
                     seconds += 1
                     
-                camera.stop_recording()
+                    # Re-evaluate load in the middle of the segment, 
+                    # when level has to be lowered finish this segment
+                    # early so that next one starts with new settings.
+                    if seconds % config.GOVERNOR_INTERVAL_SEC == 0:
+                        cpu_temp = hal.thermal.get_cpu_temperature()
+                        metrics.cpu_temperature.set(cpu_temp)
+                        level = video_governor.level
+                        if video_governor.update(
+                                telemetry.sample(cpu_temp, mp4wfile)):
+                            _log_governor_level()
+                            if video_governor.level > level:
+                                break
+                    
+                tracing.end("wait loop", wait_trace, seconds=seconds)
+                
+                with tracing.span("stop_recording"):
+                    camera.stop_recording()
                 
-                mp4wfile.close()
+                seg['duration_sec'] = round(time.monotonic() - rec_start, 3)
+                seg['frames_expected'] = int(round(seg['duration_sec'] 
+                                        * video_fps))
+                _mp4wfile = None
+                with tracing.span("writer close"):
+                    mp4wfile.close()
                 
                 last_recorded_name = rec_filename
+                tracing.end("segment", seg_trace, index=index,
+                            file=rec_filename)
                 
                 index += 1
                 
@@ -368,6 +661,7 @@ def _loop_recoder():
                 break
         
         recording_on = False
+        live.stream_stopped()
         if _stop:
             recording_status_text = "Recording stopped by user at " \
                         "{0}. Camera closed.".format(
@@ -380,5 +674,8 @@ def _loop_recoder():
         recording_status_text = "Internal error.<br>" + str(e)
         _update_subs_on_status(recording_status_text)
     finally:
+        _cfg.flush()
         if camera:
             camera.close()
+        if video_governor:
+            video_governor.close()
@@ -0,0 +1,241 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Background scrubber of finished records.
+#
+# SCRUB_INTERVAL_SEC after each pass all records of the loop ring and
+# protected records are read back, newest first, at 
+# SCRUB_BYTES_PER_SEC (lowest priority, see arbiter) and their CRC32 
+# compared with the one mp4 writer saved in the segment summary. 
+# Records failing the check get "scrub_error" in their summary. Records
+# without checksum get one from their first check, later changes are
+# caught from then on.
+# Page cache is dropped before reading so that the card is read.
+
+import json
+import os
+import threading
+import time
+import zlib
+import logging
+from datetime import datetime
+
+import config
+import catalog
+import protect
+import arbiter
+import metrics
+import wear
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_KEY_CRC = 'crc32'
+SUMMARY_KEY_CRC_SOURCE = 'crc32_source'
+SUMMARY_KEY_ERROR = 'scrub_error'
+
+ERROR_CHECKSUM = "checksum mismatch"
+ERROR_SIZE = "size mismatch"
+ERROR_READ = "read error"
+
+_CHUNK_BYTES = 256*1024
+
+_th_scrubber = None
+_stop = threading.Event()
+_bucket = arbiter.TokenBucket(rate_func=lambda:
+            arbiter.get_background_rate(config.SCRUB_BYTES_PER_SEC))
+
+# Results of the last complete pass and the one running.
+_bad = {}
+_last_pass = {}
+
+checked_bytes = metrics.Counter("dashcam_scrub_checked_bytes_total",
+        "Bytes of records read back by scrubber.")
+checked_records = metrics.Counter("dashcam_scrub_checked_records_total",
+        "Records checked by scrubber.")
+metrics.Gauge("dashcam_scrub_bad_records",
+        "Records failing scrubber check.", lambda: len(_bad))
+
+def start():
+    global _th_scrubber
+
+    if not config.SCRUB_ENABLED:
+        return
+    if _th_scrubber is None or not _th_scrubber.is_alive():
+        _stop.clear()
+        _th_scrubber = threading.Thread(target=_scrubber, name="scrubber")
+        _th_scrubber.daemon = True
+        _th_scrubber.start()
+
+def stop():
+    global _th_scrubber
+
+    if _th_scrubber is not None:
+        _stop.set()
+        _th_scrubber.join()
+        _th_scrubber = None
+
+def get_summary():
+    # Card health as seen by scrubber.
+    return {
+        'health': "unknown" if not _last_pass and not _bad
+                else ("errors" if _bad else "ok"),
+        'bad_records': dict(_bad),
+        'last_pass': dict(_last_pass)
+    }
+
+def get_error(name):
+    # Scrub error of record file name, None if not found bad.
+    return _bad.get(name)
+
+def _scrubber():
+    arbiter.deprioritize_current_thread()
+    while not _stop.is_set():
+        try:
+            scrub_pass()
+        except Exception as e:
+            logger.error("Scrub pass failed: %s", e)
+        _stop.wait(config.SCRUB_INTERVAL_SEC)
+
+def scrub_pass():
+    # One pass over all records old enough, returns its statistics.
+    start = time.monotonic()
+    stats = {'checked_records': 0, 'checked_bytes': 0, 'bad_records': 0,
+            'new_checksums': 0}
+    min_mtime = time.time() - config.SCRUB_MIN_AGE_SEC
+    # Loop records are gone a few hours after they are written, check
+    # them while they are still there.
+    for mtime, path in _newest_first(protect.all_record_paths()):
+        if _stop.is_set():
+            return None
+        if mtime > min_mtime:
+            continue
+        try:
+            result = check_record(path)
+        except FileNotFoundError:
+            # Overwritten, moved or locked in between.
+            continue
+        if result is None:
+            continue
+        nbytes, error, new_crc = result
+        stats['checked_records'] += 1
+        stats['checked_bytes'] += nbytes
+        if new_crc:
+            stats['new_checksums'] += 1
+        name = os.path.basename(path)
+        if error:
+            stats['bad_records'] += 1
+            _bad[name] = error
+        else:
+            _bad.pop(name, None)
+
+    stats['duration_sec'] = round(time.monotonic() - start, 1)
+    stats['end_time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    _last_pass.clear()
+    _last_pass.update(stats)
+    # Forget records no longer present.
+    names = set(os.path.basename(p) for p in protect.all_record_paths())
+    for name in list(_bad.keys()):
+        if name not in names:
+            del _bad[name]
+    logger.info("Scrub pass: %s", stats)
+    return stats
+
+def _newest_first(paths):
+    records = []
+    for path in paths:
+        try:
+            records.append((os.path.getmtime(path), path))
+        except OSError:
+            continue
+    records.sort(reverse=True)
+    return records
+
+def _file_crc(path):
+    crc = 0
+    nbytes = 0
+    with open(path, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        while True:
+            if _stop.is_set():
+                return None, nbytes
+            _bucket.acquire(_CHUNK_BYTES)
+            data = f.read(_CHUNK_BYTES)
+            if len(data) == 0:
+                break
+            crc = zlib.crc32(data, crc)
+            nbytes += len(data)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    return crc, nbytes
+
+def _save_summary(summary_file, seg):
+    data = json.dumps(seg)
+    tmp = summary_file + ".tmp"
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.replace(tmp, summary_file)
+    wear.add(wear.CATEGORY_SUMMARY, len(data))
+
+def check_record(path):
+    # Returns (bytes read, error or None, checksum was added) or None
+    # when the record has no summary (not finished) or scrubber was
+    # stopped.
+    summary_file = catalog.summary_path(path)
+    try:
+        with open(summary_file) as f:
+            seg = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.error("Bad summary %s", summary_file)
+        return None
+
+    error = None
+    new_crc = False
+    expected_size = seg.get('file_bytes')
+    try:
+        crc, nbytes = _file_crc(path)
+    except FileNotFoundError:
+        raise
+    except OSError as e:
+        logger.error("Reading %s failed: %s", path, e)
+        crc, nbytes = None, 0
+        error = ERROR_READ
+    else:
+        if crc is None:
+            return None
+        checked_bytes.inc(nbytes)
+        if expected_size is not None and nbytes != expected_size:
+            error = ERROR_SIZE
+        elif seg.get(SUMMARY_KEY_CRC) is None:
+            seg[SUMMARY_KEY_CRC] = crc
+            seg[SUMMARY_KEY_CRC_SOURCE] = "scrub"
+            new_crc = True
+        elif seg[SUMMARY_KEY_CRC] != crc:
+            error = ERROR_CHECKSUM
+    checked_records.inc()
+
+    if error:
+        logger.error("Record %s failed check: %s", path, error)
+    if new_crc or seg.get(SUMMARY_KEY_ERROR) != error:
+        if error:
+            seg[SUMMARY_KEY_ERROR] = error
+        else:
+            seg.pop(SUMMARY_KEY_ERROR, None)
+        _save_summary(summary_file, seg)
+    return nbytes, error, new_crc
@@ -0,0 +1,193 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Segment slots: record files are recycled instead of deleted and
+# created again (config.RECORD_SLOT_MODE).
+#
+# The record being replaced is renamed to the new record name and
+# overwritten from the start. Space for RECORD_SLOT_BYTES is reserved
+# with fallocate beyond end of file, so writes while recording don't
+# allocate and the file keeps the same extents loop after loop. At
+# finalize the file is truncated to the bytes written, its valid
+# length is saved in segment summary (file_bytes). Truncating frees
+# the blocks beyond, they are reserved again right away while still
+# free next to the file.
+#
+# After a power cut the file holds new video followed by the rest of
+# the old one, repair() cuts it after the last fragment which is
+# surely new (needs fragmented mp4, see MP4Writer.BACKEND_FFMPEG_PIPE).
+
+import ctypes
+import ctypes.util
+import os
+import struct
+import logging
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# linux/falloc.h
+_FALLOC_FL_KEEP_SIZE = 0x01
+
+_libc = None
+_fallocate = None
+
+def _load_fallocate():
+    global _libc
+    global _fallocate
+    if _libc is not None:
+        return _fallocate
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    try:
+        _fallocate = _libc.fallocate
+        _fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                            ctypes.c_longlong, ctypes.c_longlong]
+    except AttributeError:
+        logger.warning("fallocate not available, slots are not preallocated")
+    return _fallocate
+
+def preallocate(fd, nbytes):
+    # Reserve disk blocks up to nbytes without changing file size.
+    # Already allocated ranges are left as they are. Returns False when
+    # not supported by the system or filesystem.
+    fallocate = _load_fallocate()
+    if fallocate is None:
+        return False
+    if fallocate(fd, _FALLOC_FL_KEEP_SIZE, 0, nbytes) != 0:
+        e = ctypes.get_errno()
+        logger.warning("fallocate failed: %s", os.strerror(e))
+        return False
+    return True
+
+class SlotFile:
+    # Write only file object recycling reuse_path when given.
+    def __init__(self, path, slot_bytes=config.RECORD_SLOT_BYTES,
+                reuse_path=None):
+        self.path = path
+        self.valid_bytes = 0
+        if reuse_path and reuse_path != path:
+            try:
+                os.rename(reuse_path, path)
+            except FileNotFoundError:
+                pass
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self._slot_bytes = slot_bytes
+        if slot_bytes > 0:
+            preallocate(self._fd, slot_bytes)
+        self._pos = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            n = os.pwrite(self._fd, view, self._pos)
+            self._pos += n
+            view = view[n:]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd is None:
+            return
+        try:
+            # Truncating releases blocks reserved beyond end of file,
+            # only do it when old content has to be cut.
+            if os.fstat(self._fd).st_size > self._pos:
+                os.ftruncate(self._fd, self._pos)
+                if self._slot_bytes > 0:
+                    preallocate(self._fd, self._slot_bytes)
+            self.valid_bytes = self._pos
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+# Top level boxes of a fragmented mp4 written by ffmpeg.
+_HEADER_BOXES = (b'ftyp', b'moov', b'free', b'styp', b'sidx')
+_END_BOXES = (b'mfra',)
+
+def find_valid_length(f, file_size):
+    # Walks mp4 boxes of file object f. Returns (length, complete)
+    # where length is the end of the last fragment whose following
+    # box is also consistent, complete is True if the walk reached
+    # end of file.
+    pos = 0
+    expected_seq = None
+    prev_type = None
+    header_end = 0
+    frag_ends = []
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+        if size < 8 or pos + size > file_size:
+            break
+
+        if box_type == b'moof':
+            # First child is mfhd: size, type, version/flags, sequence.
+            mfhd = f.read(16)
+            if len(mfhd) < 16 or mfhd[4:8] != b'mfhd':
+                break
+            seq = struct.unpack('>I', mfhd[12:16])[0]
+            if expected_seq is not None and seq != expected_seq:
+                break
+            expected_seq = seq + 1
+        elif box_type == b'mdat':
+            if prev_type != b'moof':
+                break
+            frag_ends.append(pos + size)
+        elif box_type in _HEADER_BOXES:
+            if frag_ends:
+                break
+            header_end = pos + size
+        elif box_type in _END_BOXES:
+            pos += size
+            return pos, pos == file_size
+        else:
+            break
+        prev_type = box_type
+        pos += size
+
+    if pos == file_size:
+        return pos, True
+    # Last fragment may be partly old data.
+    if len(frag_ends) >= 2:
+        return frag_ends[-2], False
+    return header_end, False
+
+def repair(path):
+    # Cut interrupted slot record after its last valid fragment.
+    # Returns new length or None when file is not a fragmented mp4.
+    with open(path, 'r+b') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size < 8:
+            return None
+        f.seek(4)
+        if f.read(4) != b'ftyp':
+            return None
+        length, complete = find_valid_length(f, file_size)
+        if not complete:
+            logger.warning("Truncating interrupted record %s from %s to %s"
+                        " bytes", path, file_size, length)
+            f.truncate(length)
+    return length
@@ -0,0 +1,164 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Persistent key value state saved as json.
+#
+# Changes are written behind by a thread: all changes within
+# STATE_FLUSH_DELAY_SEC of the first one go to disk in a single
+# write. Changes which must survive power loss right away are set with
+# durable=True. File is replaced atomically (write temporary file,
+# fsync, rename, fsync directory), so after a crash it holds either the
+# old or the new state, never a mix.
+
+import json
+import os
+import threading
+import time
+import logging
+
+import config
+import wear
+
+logger = logging.getLogger(__name__)
+
+class StateStore:
+    def __init__(self, path, defaults=None,
+                flush_delay_sec=config.STATE_FLUSH_DELAY_SEC):
+        self._path = path
+        self._tmp_path = path + ".tmp"
+        self._flush_delay_sec = flush_delay_sec
+
+        self._data = dict(defaults) if defaults else {}
+        self._data.update(self._load())
+
+        # Protects _data and flush scheduling.
+        self._cv = threading.Condition()
+        # Serializes file writes.
+        self._write_lock = threading.Lock()
+        self._dirty_since = None
+        self._flush_now = False
+        self._closed = False
+        # Number of times state file was written.
+        self.writes = 0
+
+        self._th = threading.Thread(target=self._flush_loop,
+                                    name="state writer")
+        self._th.daemon = True
+        self._th.start()
+
+    def _load(self):
+        try:
+            with open(self._path, 'r') as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("not a json object")
+            return data
+        except FileNotFoundError:
+            return {}
+        except (ValueError, OSError) as e:
+            # Only possible with files written in place by older
+            # versions.
+            logger.error("State file %s unreadable (%s), using defaults",
+                        self._path, e)
+            return {}
+
+    def get(self, key, default=None):
+        with self._cv:
+            return self._data.get(key, default)
+
+    def set(self, key, value, durable=False):
+        self.update({key: value}, durable)
+
+    def update(self, values, durable=False):
+        # Set several keys, they are always saved together.
+        with self._cv:
+            changed = False
+            for key, value in values.items():
+                if key not in self._data or self._data[key] != value:
+                    self._data[key] = value
+                    changed = True
+            if not changed:
+                return
+            if self._dirty_since is None:
+                self._dirty_since = time.monotonic()
+            if durable:
+                self._flush_now = True
+            self._cv.notify()
+
+    def flush(self):
+        # Write pending changes now.
+        with self._write_lock:
+            with self._cv:
+                if self._dirty_since is None:
+                    return
+                data = json.dumps(self._data)
+                self._dirty_since = None
+                self._flush_now = False
+            try:
+                self._write(data)
+            except Exception as e:
+                logger.error("Saving %s failed: %s", self._path, e)
+                with self._cv:
+                    # Retry with next flush.
+                    if self._dirty_since is None:
+                        self._dirty_since = time.monotonic()
+
+    def _write(self, data):
+        with open(self._tmp_path, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._tmp_path, self._path)
+        # Make rename durable.
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self._path)),
+                        os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self.writes += 1
+        wear.add(wear.CATEGORY_CONFIG, len(data))
+
+    def _flush_due(self):
+        # Called with _cv held. Returns seconds to wait, 0 when due.
+        if self._dirty_since is None:
+            return None
+        if self._flush_now:
+            return 0
+        return max(0, self._dirty_since + self._flush_delay_sec
+                    - time.monotonic())
+
+    def _flush_loop(self):
+        while True:
+            with self._cv:
+                while not self._closed:
+                    timeout = self._flush_due()
+                    if timeout == 0:
+                        break
+                    self._cv.wait(timeout)
+                if self._closed:
+                    return
+            self.flush()
+
+    def close(self):
+        # Stop writer thread and write pending changes.
+        with self._cv:
+            self._closed = True
+            self._cv.notify()
+        self._th.join()
+        self.flush()
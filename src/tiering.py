@@ -0,0 +1,257 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Tiered storage: background mover of finished records from
+# config.RECORDS_LOCATION to config.SECONDARY_LOCATION.
+#
+# A record is copied to <name>.part in secondary location at
+# TIER_MOVE_BYTES_PER_SEC, then synced and read back: only when its
+# CRC32 matches the source the part file is renamed to the record
+# name, the ring entry (see catalog) is switched over and the primary
+# copy deleted. An interrupted copy resumes from the size of its part
+# file. Records overwritten or locked while being copied are dropped
+# from secondary location again.
+
+import os
+import queue
+import shutil
+import threading
+import zlib
+import logging
+
+import config
+import catalog
+import arbiter
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PART_EXTENSION = ".part"
+
+_q = queue.Queue()
+_th_mover = None
+_stop = threading.Event()
+
+moved_bytes = metrics.Counter("dashcam_tier_moved_bytes_total",
+        "Bytes of records moved to secondary location.")
+moved_records = metrics.Counter("dashcam_tier_moved_records_total",
+        "Records moved to secondary location.")
+verify_failures = metrics.Counter("dashcam_tier_verify_failures_total",
+        "Copies to secondary location failing checksum verification.")
+metrics.Gauge("dashcam_tier_pending_records",
+        "Records waiting to be moved to secondary location.",
+        lambda: _q.qsize())
+
+def enabled():
+    return bool(config.SECONDARY_LOCATION)
+
+_bucket = arbiter.TokenBucket(rate_func=lambda: 
+            arbiter.get_background_rate(config.TIER_MOVE_BYTES_PER_SEC))
+
+def list_records():
+    # Records of both locations. A record found in both (mover
+    # stopped after verifying) is kept in secondary location.
+    records = catalog.list_records()
+    if not enabled() or not os.path.isdir(config.SECONDARY_LOCATION):
+        return records
+    secondary = catalog.list_records(config.SECONDARY_LOCATION)
+    names = {r.name: r for r in secondary}
+    result = list(secondary)
+    for r in records:
+        s = names.get(r.name)
+        if s is not None and s.size == r.size:
+            _remove_record(r.path)
+        else:
+            result.append(r)
+    return result
+
+def start(records, skip_index=None):
+    # Queues finished records of primary location, oldest first, and
+    # starts the mover. skip_index is the record possibly interrupted.
+    global _th_mover
+
+    if not enabled():
+        return
+    primary = os.path.realpath(config.RECORDS_LOCATION)
+    queued = set()
+    for r in sorted(records, key=lambda r: r.mtime):
+        if (r.index != skip_index and os.path.realpath(
+                os.path.dirname(r.path)) == primary):
+            _q.put(r.path)
+            queued.add(r.name)
+    # Part files of records gone meanwhile are not resumed.
+    try:
+        for name in os.listdir(config.SECONDARY_LOCATION):
+            if (name.endswith(PART_EXTENSION) 
+                    and name[:-len(PART_EXTENSION)] not in queued):
+                os.remove(config.SECONDARY_LOCATION + '/' + name)
+    except OSError as e:
+        logger.error(e)
+    if _th_mover is None or not _th_mover.is_alive():
+        _stop.clear()
+        _th_mover = threading.Thread(target=_mover, name="tier mover")
+        _th_mover.daemon = True
+        _th_mover.start()
+
+def stop():
+    global _th_mover
+
+    if _th_mover is not None:
+        _stop.set()
+        _q.put(None)
+        _th_mover.join()
+        _th_mover = None
+
+def segment_finished(path):
+    # Called once writer has finished the record and its summary.
+    if enabled():
+        _q.put(path)
+
+def _remove_record(path):
+    for p in (catalog.summary_path(path), path):
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+def _mover():
+    arbiter.deprioritize_current_thread()
+    while not _stop.is_set():
+        path = _q.get()
+        if path is None:
+            continue
+        try:
+            _move(path)
+        except FileNotFoundError as e:
+            if os.path.exists(path):
+                # Secondary location is gone.
+                logger.error("Moving %s failed: %s", path, e)
+                _q.put(path)
+                _stop.wait(config.TIER_RETRY_SEC)
+                continue
+            # Overwritten by the loop or locked while being copied.
+            logger.info("%s is gone, not moved", path)
+            _remove_part(path)
+        except OSError as e:
+            # Secondary location unplugged or full, try again later.
+            logger.error("Moving %s failed: %s", path, e)
+            _q.put(path)
+            _stop.wait(config.TIER_RETRY_SEC)
+        except Exception as e:
+            logger.error("Moving %s failed: %s", path, e)
+
+def _remove_part(path):
+    try:
+        os.remove(config.SECONDARY_LOCATION + '/' + os.path.basename(path)
+                + PART_EXTENSION)
+    except OSError:
+        pass
+
+def _copy(src, dst_part):
+    # Returns CRC32 of src, None when stopped. Resumes from existing
+    # part file, whose content is covered by the read back check.
+    chunk = config.TIER_COPY_CHUNK_BYTES
+    crc = 0
+    with open(src, 'rb') as fsrc, open(dst_part, 'ab') as fdst:
+        offset = fdst.tell()
+        if offset > os.fstat(fsrc.fileno()).st_size:
+            fdst.truncate(0)
+            offset = 0
+        if offset > 0:
+            logger.info("Resuming copy of %s at %s", src, offset)
+        pos = 0
+        while True:
+            if _stop.is_set():
+                return None
+            _bucket.acquire(chunk)
+            data = fsrc.read(chunk)
+            if len(data) == 0:
+                break
+            crc = zlib.crc32(data, crc)
+            end = pos + len(data)
+            if end > offset:
+                fdst.write(data[max(0, offset - pos):])
+            pos = end
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    return crc
+
+def _file_crc(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            if _stop.is_set():
+                return None
+            _bucket.acquire(config.TIER_COPY_CHUNK_BYTES)
+            data = f.read(config.TIER_COPY_CHUNK_BYTES)
+            if len(data) == 0:
+                return crc
+            crc = zlib.crc32(data, crc)
+
+def _move(path):
+    name = os.path.basename(path)
+    if catalog.ring_find(name) != path:
+        # Overwritten, locked or already moved.
+        return
+    dst = config.SECONDARY_LOCATION + '/' + name
+    part = dst + PART_EXTENSION
+    crc = _copy(path, part)
+    if crc is None:
+        return
+    # Page cache of the file just written would hide a bad copy.
+    fd = os.open(part, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    dst_crc = _file_crc(part)
+    if dst_crc is None:
+        return
+    if dst_crc != crc:
+        verify_failures.inc()
+        logger.error("Copy of %s failed verification, retrying", name)
+        os.remove(part)
+        _q.put(path)
+        return
+
+    summary = catalog.summary_path(path)
+    if os.path.exists(summary):
+        with open(summary, 'rb') as f:
+            data = f.read()
+        with open(catalog.summary_path(dst), 'wb') as f:
+            f.write(data)
+        shutil.copystat(summary, catalog.summary_path(dst))
+    # Record mtime is its end time: index recovery, archives, listing
+    # order and ETags depend on it staying the same.
+    shutil.copystat(path, part)
+    os.rename(part, dst)
+    dirfd = os.open(config.SECONDARY_LOCATION, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+    if catalog.ring_replace(path, dst):
+        _remove_record(path)
+        size = os.path.getsize(dst)
+        moved_bytes.inc(size)
+        moved_records.inc()
+        logger.info("Moved %s to %s", name, config.SECONDARY_LOCATION)
+    else:
+        # Overwritten or locked meanwhile.
+        _remove_record(dst)
@@ -0,0 +1,114 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# Optional span tracing. Spans are kept in a bounded ring in memory
+# and exported in Chrome trace event format, open the file in
+# chrome://tracing or https://ui.perfetto.dev
+#
+# with tracing.span("stop_recording", index=5):
+#     camera.stop_recording()
+
+import collections
+import threading
+import time
+import os
+
+import config
+
+# Each event: (name, start_us, duration_us, thread id, args)
+_events = collections.deque(maxlen=config.TRACE_MAX_EVENTS)
+_lock = threading.Lock()
+_thread_names = {}
+
+enabled = config.TRACE_ENABLED
+
+def _now_us():
+    return int(time.monotonic() * 1000000)
+
+class _Span:
+    __slots__ = ('_name', '_args', '_start')
+
+    def __init__(self, name, args):
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._start = _now_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._args['error'] = str(exc)
+        add(self._name, self._start, _now_us() - self._start, self._args)
+        return False
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+def span(name, **args):
+    # Context manager timing the enclosed block, costs nothing when
+    # tracing is disabled.
+    if not enabled:
+        return _NO_SPAN
+    return _Span(name, args)
+
+def begin():
+    # For blocks not suited to a with statement, pair with end().
+    if not enabled:
+        return None
+    return _now_us()
+
+def end(name, start_us, **args):
+    if start_us is None:
+        return
+    add(name, start_us, _now_us() - start_us, args)
+
+def add(name, start_us, duration_us, args=None):
+    th = threading.current_thread()
+    with _lock:
+        _thread_names[th.ident] = th.name
+        _events.append((name, start_us, duration_us, th.ident, args))
+
+def clear():
+    with _lock:
+        _events.clear()
+
+def export_chrome_trace():
+    with _lock:
+        events = list(_events)
+        names = dict(_thread_names)
+
+    pid = os.getpid()
+    trace = []
+    for tid, name in names.items():
+        trace.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                    'tid': tid, 'args': {'name': name}})
+    for name, start, dur, tid, args in events:
+        ev = {'name': name, 'ph': 'X', 'ts': start, 'dur': dur,
+            'pid': pid, 'tid': tid}
+        if args:
+            ev['args'] = args
+        trace.append(ev)
+
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
@@ -37,6 +37,33 @@ def get_cpu_temperature():
     return 0.0
 
 
+def get_throttled():
+    # Bit mask of under-voltage and throttling state from firmware.
+    out = subprocess.check_output(['vcgencmd', 
+                    'get_throttled']).decode('utf-8')
+    if 'throttled=' in out:
+        return int(out.strip().split('=')[1], 16)
+    
+    return 0
+
+# Field indexes of block device stat file.
+# https://www.kernel.org/doc/Documentation/block/stat.txt
+BLK_STAT_WRITE_SECTORS = 6
+BLK_STAT_IO_TICKS = 9
+
+def get_block_device_stat(path):
+    # Return fields of /sys/block/<dev>/stat (or of the partition)
+    # for the block device holding given path.
+    st = os.stat(path)
+    stat_file = "/sys/dev/block/{0}:{1}/stat".format(
+                    os.major(st.st_dev), os.minor(st.st_dev))
+    with open(stat_file, 'r') as f:
+        return [int(v) for v in f.read().split()]
+
+def get_filesystem_size(path):
+    st = os.statvfs(path)
+    return st.f_blocks * st.f_frsize
+
 def delete_old_logs(log_dir, days_to_keep=2):
     # Delete log files older than days_to_keep
     td = datetime.timedelta(days=days_to_keep)
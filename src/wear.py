@@ -0,0 +1,201 @@
+# Dash Camera with Raspberry Pi Zero W
+# Copyright (C) 2019 Ravikiran Bukkasagara <contact@ravikiranb.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# TAB = 4 spaces
+
+# SD card wear telemetry.
+#
+# Bytes written by this program are counted per category (host bytes)
+# and compared with sectors written reported by the kernel for the
+# records block device (device bytes). Their ratio is the write
+# amplification caused by filesystem metadata, journal and small
+# rewrites. Amplification inside the card (flash translation layer)
+# is not visible here, WEAR_CARD_ENDURANCE_CYCLES should account
+# for it.
+#
+# Lifetime totals are kept in recorder configuration (see
+# recorder.CFG_WEAR_KEY) so persisting them costs no extra writes.
+
+import threading
+import time
+import logging
+
+import config
+import hal
+import util
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CATEGORY_RECORDING = "recording"
+CATEGORY_FASTSTART = "faststart"
+CATEGORY_SPILL = "spill"
+CATEGORY_CONFIG = "config"
+CATEGORY_SUMMARY = "summary"
+CATEGORY_LOG = "log"
+CATEGORY_SNAPSHOT = "snapshot"
+CATEGORY_EXPORT = "export"
+
+CATEGORIES = (CATEGORY_RECORDING, CATEGORY_FASTSTART, CATEGORY_SPILL,
+            CATEGORY_CONFIG, CATEGORY_SUMMARY, CATEGORY_LOG,
+            CATEGORY_SNAPSHOT, CATEGORY_EXPORT)
+
+_SECTOR_SIZE = 512
+_DAY_SEC = 24 * 60 * 60
+
+# Host bytes written since program start, lock free.
+_counters = {c: metrics.Counter("", "", register=False) for c in CATEGORIES}
+
+_lock = threading.Lock()
+# Lifetime totals restored from configuration.
+_saved_host = {c: 0 for c in CATEGORIES}
+_saved_device_bytes = 0
+_saved_observed_sec = 0.0
+# Device counter since program start.
+_device_bytes = 0
+_device_available = True
+_last_sectors = None
+_start_time = time.monotonic()
+
+def add(category, nbytes):
+    # Count bytes written to records disk. Cheap, call from any thread.
+    _counters[category].inc(nbytes)
+
+def restore(saved):
+    # saved - dictionary from a previous to_dict() or None.
+    global _saved_device_bytes
+    global _saved_observed_sec
+
+    if not saved:
+        return
+    with _lock:
+        for c in CATEGORIES:
+            _saved_host[c] = saved.get('host', {}).get(c, 0)
+        _saved_device_bytes = saved.get('device_bytes', 0)
+        _saved_observed_sec = saved.get('observed_sec', 0.0)
+
+def sample():
+    # Reads sectors written counter of the records device. Counter
+    # restarts on reboot, only the increase since program start is
+    # used.
+    global _device_bytes
+    global _device_available
+    global _last_sectors
+
+    if not _device_available:
+        return
+    try:
+        sectors = hal.disk.get_block_stat(config.RECORDS_LOCATION)[
+                                        util.BLK_STAT_WRITE_SECTORS]
+    except Exception as e:
+        logger.warning("Device write counter not available: %s", e)
+        _device_available = False
+        return
+
+    with _lock:
+        if _last_sectors is not None and sectors >= _last_sectors:
+            _device_bytes += (sectors - _last_sectors) * _SECTOR_SIZE
+        _last_sectors = sectors
+
+def to_dict():
+    # Lifetime totals, to be persisted.
+    with _lock:
+        return {
+            'host': {c: _saved_host[c] + _counters[c].get()
+                    for c in CATEGORIES},
+            'device_bytes': _saved_device_bytes + _device_bytes,
+            'observed_sec': round(_saved_observed_sec
+                        + time.monotonic() - _start_time, 1)
+        }
+
+def _get_card_capacity():
+    if config.WEAR_CARD_CAPACITY_BYTES > 0:
+        return config.WEAR_CARD_CAPACITY_BYTES
+    return util.get_filesystem_size(config.RECORDS_LOCATION)
+
+def get_summary():
+    # Lifetime totals with write amplification and card life estimate.
+    # Values which can not be computed are None.
+    sample()
+    d = to_dict()
+    host_bytes = sum(d['host'].values())
+    device_bytes = d['device_bytes'] if _device_available else None
+
+    summary = {
+        'host_bytes': host_bytes,
+        'host_bytes_by_category': d['host'],
+        'device_bytes': device_bytes,
+        'observed_sec': d['observed_sec'],
+        'write_amplification': None,
+        'endurance_used_percent': None,
+        'estimated_days_left': None
+    }
+
+    # Amplification and life estimate need device counter.
+    if device_bytes is None:
+        return summary
+    if host_bytes > 0:
+        summary['write_amplification'] = round(
+                        float(device_bytes) / host_bytes, 2)
+
+    try:
+        endurance = _get_card_capacity() * config.WEAR_CARD_ENDURANCE_CYCLES
+    except Exception as e:
+        logger.error(e)
+        return summary
+    if endurance <= 0:
+        return summary
+    summary['endurance_used_percent'] = round(
+                        device_bytes * 100.0 / endurance, 3)
+    if device_bytes > 0 and d['observed_sec'] > 0:
+        bytes_per_day = device_bytes * _DAY_SEC / d['observed_sec']
+        summary['estimated_days_left'] = int(
+                        max(0, endurance - device_bytes) / bytes_per_day)
+    return summary
+
+class LogWriteCounter(logging.Filter):
+    # Attach to a file log handler to count bytes of log records
+    # written by it.
+    def __init__(self, handler):
+        logging.Filter.__init__(self)
+        self._handler = handler
+
+    def filter(self, record):
+        try:
+            # Message and line terminator.
+            add(CATEGORY_LOG, len(self._handler.format(record)) + 1)
+        except Exception:
+            pass
+        return True
+
+def count_log_writes():
+    # Count writes of all file handlers of root logger.
+    for h in logging.getLogger().handlers:
+        if isinstance(h, logging.FileHandler):
+            h.addFilter(LogWriteCounter(h))
+
+metrics.Gauge("dashcam_storage_host_written_bytes",
+        "Bytes written to records disk by this program since install.",
+        lambda: sum(to_dict()['host'].values()))
+metrics.Gauge("dashcam_storage_device_written_bytes",
+        "Bytes written to records block device since install.",
+        lambda: get_summary()['device_bytes'])
+metrics.Gauge("dashcam_storage_write_amplification",
+        "Device bytes written per byte written by this program.",
+        lambda: get_summary()['write_amplification'])
+metrics.Gauge("dashcam_storage_estimated_days_left",
+        "Estimated SD card lifetime left at current write rate.",
+        lambda: get_summary()['estimated_days_left'])
@@ -28,15 +28,30 @@ import urllib.parse as url_parse
 import threading
 import subprocess
 import time
-import glob
 import pathlib
 import shutil
 import logging
 import io
+import json
+import email.utils
+import base64
+import hashlib
+import struct
 
 from command import Command
 import util
+import hal
+import tracing
+import metrics
+import wear
+import arbiter
 import recorder
+import protect
+import catalog
+import scrub
+import archive
+import export
+import live
 import config
 
 logger = logging.getLogger(__name__)
@@ -50,13 +65,40 @@ _HOUR_SEC = 60 * _MINUTE_SEC
 _HTTP_STATUS_CODE_BAD_REQUEST = 400
 _HTTP_STATUS_CODE_REQUEST_TIMEOUT = 408
 _HTTP_STATUS_CODE_NOT_FOUND = 404
+_HTTP_STATUS_CODE_CONFLICT = 409
 _HTTP_STATUS_CODE_INTERNAL_SERVER_ERROR = 500
 _HTTP_STATUS_CODE_RANGE_NOT_SATISFIABLE= 416
 
+_METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Record files are sent in chunks of this size.
+_SEND_CHUNK_BYTES = 64*1024
+
+# RFC 6455
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_WS_OPCODE_TEXT = 0x1
+_WS_OPCODE_BINARY = 0x2
+_WS_OPCODE_PING = 0x9
+
+_HTTP_STATUS_CODE_SWITCHING_PROTOCOLS = 101
 _HTTP_STATUS_CODE_OK = 200
 _HTTP_STATUS_CODE_REDIRECT = 302
 _HTTP_STATUS_CODE_PARTIAL_CONTENT = 206
+_HTTP_STATUS_CODE_NOT_MODIFIED = 304
+
 
+class _CountingWriter:
+    # Counts bytes sent on connection for metrics.
+    def __init__(self, wfile):
+        self._wfile = wfile
+        
+    def write(self, data):
+        n = self._wfile.write(data)
+        metrics.http_bytes.inc(len(data) if n is None else n)
+        return n
+        
+    def __getattr__(self, name):
+        return getattr(self._wfile, name)
 
 class WebInterfaceHandler(BaseHTTPRequestHandler):
     # Each request handler runs in its own thread.
@@ -67,12 +109,17 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
     # Global Command queue.
     cmd_q = None
     
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.wfile = _CountingWriter(self.wfile)
+        
     def do_GET(self):
         # Serve URLs, POST method not used in html files.
         # url are at root level.
         
         # Rather than a long list of if-else chain dictionary indexing
         # from path to function might be better ??
+        metrics.http_requests.inc()
         try:
             self.protocol_version = "HTTP/1.1"
             logger.debug("\nPath: %s", self.path)
@@ -120,6 +167,31 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
                     self.serve_record(kv['f'][0], False)        
                 else:
                     self.send_error(_HTTP_STATUS_CODE_BAD_REQUEST)
+            elif ('/lock-record' in self.path 
+                    or '/unlock-record' in self.path):
+                # This url will have paramters: ?f=<name>
+                kv = self.parse_get_params()
+                if 'f' not in kv:
+                    self.send_error(_HTTP_STATUS_CODE_BAD_REQUEST)
+                elif '/unlock-record' in self.path:
+                    self.reply_lock_result(protect.unlock(kv['f'][0]))
+                else:
+                    self.reply_lock_result(
+                        recorder.lock_record(kv['f'][0], "web"))
+            elif '/download-archive' in self.path:
+                # This url will have paramters: ?from=<time>&to=<time>
+                # and/or ?f=<name>&f=<name>...
+                self.serve_archive(self.parse_get_params())
+            elif '/export' in self.path:
+                # This url will have paramters: ?from=<time>&to=<time>
+                self.serve_export(self.parse_get_params())
+            elif '/playlist' in self.path:
+                # This url will have paramters: ?from=<time>&to=<time>
+                self.serve_playlist(self.parse_get_params())
+            elif self.path.startswith('/player'):
+                self.serve_html_page('player.html')
+            elif self.path == '/lock-current':
+                self.reply_lock_result(recorder.lock_record(reason="web"))
             elif self.path == '/rotate':
                 command = Command(Command.CMD_ROTATE)
                 WebInterfaceHandler.cmd_q.put(command)
@@ -127,8 +199,23 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
                     self.redirect_to_home()
                 else:
                     self.send_error(_HTTP_STATUS_CODE_REQUEST_TIMEOUT)
+            elif self.path == '/' + live.PLAYLIST_NAME:
+                self.serve_live_playlist()
+            elif self.path.startswith('/' + live.FILES_PATH):
+                self.serve_live_file(
+                        self.path[len('/' + live.FILES_PATH):])
+            elif self.path == '/live-view':
+                self.serve_html_page('live-view.html')
+            elif self.path == '/live-ws':
+                self.serve_live_ws()
             elif self.path == '/livesnap':
                 self.serve_snap()
+            elif self.path == '/status':
+                self.serve_status()
+            elif self.path == '/trace.json':
+                self.serve_trace()
+            elif self.path == '/metrics':
+                self.serve_metrics()
             elif self.path == '/stop':
                 command = Command(Command.CMD_STOP_REC)
                 WebInterfaceHandler.cmd_q.put(command)
@@ -153,6 +240,8 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
         except Exception as e:
             logger.error(traceback.format_exc())
             logger.error(e)
+        finally:
+            arbiter.restore_current_thread()
                         
     def parse_get_params(self):
         # Convert url query string into key value pairs.
@@ -170,16 +259,106 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.flush_headers()
             
+    def reply_lock_result(self, result):
+        ok, msg = result
+        if ok:
+            self.send_response(_HTTP_STATUS_CODE_REDIRECT) 
+            self.send_header('Location', '/view-records')
+            self.end_headers()
+            self.flush_headers()
+        else:
+            self.send_error(_HTTP_STATUS_CODE_CONFLICT, explain=msg)
+            
     def serve_record(self, recname, download_play):
         # Either send the record file as attachment for download 
         # (download_play == true) or as
         # content (download_play == false)
-        filepath = config.RECORDS_LOCATION + '/' + recname
+        recname = os.path.basename(recname)
+        writer = recorder.get_writer(recname)
+        if writer is not None:
+            self.serve_growing_file(protect.get_record_path(recname), 
+                                    recname, download_play, writer)
+            return
+        # Record being written changes, all others never do.
+        in_progress = (recorder.recording_on 
+                        and recname == recorder.current_record_name)
+        self.serve_file(protect.get_record_path(recname), recname, 
+                        download_play, not in_progress)
         
-        if os.path.exists(filepath) == False:
+    def serve_growing_file(self, filepath, recname, download_play, writer):
+        # Record still being written is sent as the writer appends to
+        # it, the response ends once the writer has finished the file.
+        if writer.get_readable_bytes() is None:
+            # Playable only when finished, don't hold the request for
+            # a whole segment.
+            finished = writer.wait(config.HTTP_FOLLOW_FINISH_WAIT_SEC)
+            self.serve_file(filepath, recname, download_play, finished)
+            return
+        
+        self.send_response(_HTTP_STATUS_CODE_OK)
+        if download_play:
+            self.send_header('Content-type','application/octet-stream')
+            self.send_header('Content-Disposition', 
+                            "attachment;filename=" + recname)
+        else:
+            self.send_header('Content-type','video/mp4')
+        # Length is known only at the end.
+        chunked = self.request_version != 'HTTP/1.0'
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.send_no_cache()
+        self.end_headers()
+        
+        arbiter.deprioritize_current_thread()
+        sent = 0
+        try:
+            with open(filepath, 'rb') as f:
+                while True:
+                    # Finished first: then readable bytes are final.
+                    finished = writer.is_finished()
+                    readable = writer.get_readable_bytes()
+                    if readable > sent:
+                        n = min(_SEND_CHUNK_BYTES, readable - sent)
+                        arbiter.downloads.acquire(n)
+                        data = os.pread(f.fileno(), n, sent)
+                        if len(data) == 0:
+                            raise OSError(filepath + " truncated")
+                        sent += len(data)
+                        if chunked:
+                            data = (b'%x\r\n' % len(data) + data 
+                                    + b'\r\n')
+                        self.write_to_connection(data)
+                    elif finished:
+                        break
+                    else:
+                        time.sleep(config.HTTP_FOLLOW_POLL_SEC)
+            if chunked:
+                self.write_to_connection(b'0\r\n\r\n')
+        except (ConnectionResetError, BrokenPipeError) as e:
+            logger.warning(e)
+        except OSError as e:
+            logger.error("Following %s failed: %s", filepath, e)
+            self.close_connection = True
+        
+    def serve_file(self, filepath, recname, download_play, immutable):
+        try:
+            st = os.stat(filepath)
+        except OSError:
             self.send_error(_HTTP_STATUS_CODE_NOT_FOUND)
             return
         
+        etag = None
+        if immutable:
+            etag = _file_etag(recname, st)
+            if self.is_not_modified(etag, st.st_mtime):
+                self.send_response(_HTTP_STATUS_CODE_NOT_MODIFIED)
+                self.send_validators(etag, st.st_mtime)
+                self.end_headers()
+                return
+        
         # Handle file opening error early, if file's recording is in
         # progress then reading it will cause lock error.
         try:
@@ -189,7 +368,10 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
                     
                     range_len = file_len
                     # Handle range request for iOS/Safari browser
-                    if 'Range' in self.headers.keys():
+                    # Stale If-Range gets the whole file.
+                    if ('Range' in self.headers.keys() 
+                            and self.headers.get('If-Range', etag) 
+                                == etag):
                         logger.debug("Handling range request: %s", 
                                 self.headers['Range'])
                         ok, fpos, lpos, rlen = self.get_range (
@@ -223,17 +405,19 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
                                         "attachment;filename=" + recname)
                     else: #play
                         self.send_header('Content-type','video/mp4')
+                    self.send_header('Accept-Ranges', 'bytes')
+                    if etag is not None:
+                        self.send_validators(etag, st.st_mtime)
+                    else:
+                        self.send_no_cache()
                                     
                     self.end_headers()
                     
                     try:
-                        if range_len < file_len:
-                            # shutil copy should support file length
-                            # along with buffer length, for now
-                            # custom copy.
-                            self.send_file_range(fileobj, range_len)
-                        else:
-                            shutil.copyfileobj(fileobj, self.wfile)
+                        # Reads are paced by arbiter so that downloads
+                        # don't starve recording.
+                        arbiter.deprioritize_current_thread()
+                        self.send_file_range(fileobj, range_len)
                     except ConnectionResetError as e:
                         logger.warning(e)
                     except BrokenPipeError as e:
@@ -245,26 +429,306 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
                         explain=str(e))
             return
         
+    def serve_archive(self, kv):
+        # Tar of records in time range or selection with their 
+        # summaries. Records still being written are left out.
+        try:
+            start = archive.parse_time(kv['from'][0]) if 'from' in kv else None
+            end = archive.parse_time(kv['to'][0]) if 'to' in kv else None
+        except ValueError as e:
+            self.send_error(_HTTP_STATUS_CODE_BAD_REQUEST, explain=str(e))
+            return
+        names = set(kv['f']) if 'f' in kv else None
+        if start is None and end is None and names is None:
+            self.send_error(_HTTP_STATUS_CODE_BAD_REQUEST, 
+                        explain="Give from/to times or f=<record name>")
+            return
+        
+        exclude = recorder.get_unfinished_record_names()
+        layout = archive.TarLayout(archive.select_members(start, end,
+                                    names, exclude))
+        
+        # Selection can change, browsers revalidate with the ETag.
+        if self.is_not_modified(layout.etag, None):
+            self.send_response(_HTTP_STATUS_CODE_NOT_MODIFIED)
+            self.send_header('ETag', layout.etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            return
+        
+        first, last = 0, layout.size - 1
+        # Range only applies to the same layout, resuming after 
+        # records changed starts over.
+        if ('Range' in self.headers.keys() and self.headers.get(
+                'If-Range', layout.etag) == layout.etag):
+            ok, first, last, rlen = self.get_range(self.headers['Range'],
+                                                layout.size)
+            if not ok:
+                self.send_error(_HTTP_STATUS_CODE_RANGE_NOT_SATISFIABLE)
+                return
+            self.send_response(_HTTP_STATUS_CODE_PARTIAL_CONTENT)
+            self.send_header('Content-Range', "bytes {0}-{1}/{2}".format(
+                                first, last, layout.size))
+        else:
+            self.send_response(_HTTP_STATUS_CODE_OK)
+        
+        filename = "records"
+        if start is not None:
+            filename += "_" + start.strftime("%Y-%m-%d_%H-%M")
+        if end is not None:
+            filename += "_" + end.strftime("%Y-%m-%d_%H-%M")
+        self.send_header('Content-type', 'application/x-tar')
+        self.send_header('Content-Disposition', 
+                        "attachment;filename=" + filename + ".tar")
+        self.send_header('Content-Length', str(last - first + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', layout.etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        
+        arbiter.deprioritize_current_thread()
+        try:
+            for data, member, offset, n in layout.iter_range(first, last):
+                if data is not None:
+                    self.write_to_connection(data)
+                else:
+                    self.send_file_part(member.path, offset, n)
+        except (ConnectionResetError, BrokenPipeError) as e:
+            logger.warning(e)
+        except OSError as e:
+            # Record overwritten meanwhile, length can't be kept.
+            logger.error("Archive aborted: %s", e)
+            self.close_connection = True
+            
+    def serve_export(self, kv):
+        # One mp4 of the time range, streamed while ffmpeg joins the
+        # records or from export cache.
+        try:
+            start = archive.parse_time(kv['from'][0])
+            end = archive.parse_time(kv['to'][0])
+        except KeyError:
+            self.send_error(_HTTP_STATUS_CODE_BAD_REQUEST, 
+                        explain="Give from and to times")
+            return
+        except ValueError as e:
+            self.send_error(_HTTP_STATUS_CODE_BAD_REQUEST, explain=str(e))
+            return
+        if (end <= start 
+                or (end - start).total_seconds() > config.EXPORT_MAX_SEC):
+            self.send_error(_HTTP_STATUS_CODE_BAD_REQUEST, 
+                        explain="Time range must be positive and at most "
+                        "{0} seconds".format(config.EXPORT_MAX_SEC))
+            return
+        
+        exclude = recorder.get_unfinished_record_names()
+        segments = export.select_segments(start, end, exclude)
+        if len(segments) == 0:
+            self.send_error(_HTTP_STATUS_CODE_NOT_FOUND, 
+                        explain="No records in time range")
+            return
+        
+        filename = "export_{0}_{1}{2}".format(
+                        start.strftime("%Y-%m-%d_%H-%M-%S"),
+                        end.strftime("%Y-%m-%d_%H-%M-%S"),
+                        config.RECORD_FORMAT_EXTENSION)
+        key = export.cache_key(segments, start, end)
+        path = export.cache_lookup(key)
+        if path is not None:
+            self.serve_file(path, filename, True, True)
+            return
+        
+        arbiter.deprioritize_current_thread()
+        exp = export.Export(segments, start, end, key)
+        # ffmpeg is stopped and part file removed on any failure,
+        # otherwise ffmpeg would stay blocked on a full pipe.
+        sent_all = False
+        try:
+            # Length is known only at the end.
+            self.send_response(_HTTP_STATUS_CODE_OK)
+            self.send_header('Content-type', 'video/mp4')
+            self.send_header('Content-Disposition', 
+                            "attachment;filename=" + filename)
+            self.send_header('Connection', 'close')
+            self.send_no_cache()
+            self.end_headers()
+            self.close_connection = True
+            while True:
+                data = exp.read()
+                if len(data) == 0:
+                    break
+                arbiter.downloads.acquire(len(data))
+                self.write_to_connection(data)
+            sent_all = True
+        except (ConnectionResetError, BrokenPipeError) as e:
+            logger.warning(e)
+        finally:
+            if sent_all:
+                exp.finish()
+            else:
+                exp.abort()
+            
+    def serve_playlist(self, kv):
+        # Consecutive records in time window for the web player, JSON.
+        try:
+            end = (archive.parse_time(kv['to'][0]) if 'to' in kv 
+                    else datetime.now().replace(microsecond=0))
+            start = (archive.parse_time(kv['from'][0]) if 'from' in kv
+                    else end - timedelta(seconds=config.PLAYLIST_DEFAULT_SEC))
+        except ValueError as e:
+            self.send_error(_HTTP_STATUS_CODE_BAD_REQUEST, explain=str(e))
+            return
+        if (end <= start 
+                or (end - start).total_seconds() > config.PLAYLIST_MAX_SEC):
+            self.send_error(_HTTP_STATUS_CODE_BAD_REQUEST, 
+                        explain="Time range must be positive and at most "
+                        "{0} seconds".format(config.PLAYLIST_MAX_SEC))
+            return
+        
+        segments = []
+        for seg in export.select_segments(start, end):
+            segments.append({
+                'name': seg.name,
+                'url': "play-record?f=" + url_parse.quote(seg.name),
+                'start': seg.start.strftime("%Y-%m-%dT%H:%M:%S"),
+                # Seconds from window start, negative when the record
+                # started before it.
+                'offset_sec': round((seg.start - start).total_seconds(), 3),
+                'duration_sec': round(seg.duration, 3),
+                'size': seg.size,
+                'protected': protect.is_protected(seg.name),
+                'in_progress': recorder.get_writer(seg.name) is not None
+            })
+        body = bytes(json.dumps({
+            'from': start.strftime("%Y-%m-%dT%H:%M:%S"),
+            'to': end.strftime("%Y-%m-%dT%H:%M:%S"),
+            'segments': segments
+        }), "utf8")
+        self.send_response(_HTTP_STATUS_CODE_OK)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_no_cache()
+        self.end_headers()
+        self.write_to_connection(body)
+        
+    def serve_live_playlist(self):
+        playlist = live.playlist()
+        # Idle stream starts with the next key frame.
+        deadline = time.monotonic() + config.LIVE_START_WAIT_SEC
+        while (playlist is None and live.enabled() 
+                and recorder.recording_on and time.monotonic() < deadline):
+            time.sleep(0.2)
+            playlist = live.playlist()
+        if playlist is None:
+            self.send_error(_HTTP_STATUS_CODE_NOT_FOUND, 
+                        explain="Live stream not available")
+            return
+        body = playlist.encode('utf-8')
+        self.send_response(_HTTP_STATUS_CODE_OK)
+        self.send_header('Content-type', 'application/vnd.apple.mpegurl')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_no_cache()
+        self.end_headers()
+        self.write_to_connection(body)
+        
+    def serve_live_file(self, name):
+        # Init segments and chunks never change once made.
+        data = live.get_file(name)
+        if data is None:
+            self.send_error(_HTTP_STATUS_CODE_NOT_FOUND)
+            return
+        self.send_response(_HTTP_STATUS_CODE_OK)
+        self.send_header('Content-type', 'video/mp4')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'public, max-age={0}, immutable'
+                        .format(config.HTTP_IMMUTABLE_MAX_AGE_SEC))
+        self.end_headers()
+        try:
+            self.write_to_connection(data)
+        except (ConnectionResetError, BrokenPipeError) as e:
+            logger.warning(e)
+            
+    def serve_html_page(self, filename):
+        # Page without keywords to replace.
+        with open(config.HOME + '/html/' + filename, 'rb') as f:
+            page = f.read()
+        self.send_response(_HTTP_STATUS_CODE_OK)
+        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(page)))
+        self.send_no_cache()
+        self.end_headers()
+        self.write_to_connection(page)
+        
+    def serve_live_ws(self):
+        # WebSocket pushing live video as fragmented mp4, one frame
+        # per message. Client messages are not read, a closed
+        # connection shows up as a failed send.
+        key = self.headers.get('Sec-WebSocket-Key')
+        if (not live.enabled() or key is None 
+                or self.headers.get('Upgrade', '').lower() != 'websocket'):
+            self.send_error(_HTTP_STATUS_CODE_BAD_REQUEST, 
+                        explain="WebSocket upgrade expected")
+            return
+        accept = base64.b64encode(hashlib.sha1(
+                    (key + _WS_GUID).encode('ascii')).digest())
+        self.send_response(_HTTP_STATUS_CODE_SWITCHING_PROTOCOLS)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept.decode('ascii'))
+        self.end_headers()
+        self.close_connection = True
+        
+        sub = live.subscribe()
+        try:
+            while True:
+                msg = sub.get(config.LIVE_WS_PING_SEC)
+                if msg is None:
+                    self.write_to_connection(_ws_frame(_WS_OPCODE_PING, 
+                                                    b''))
+                    continue
+                text, data = msg
+                if text is not None:
+                    self.write_to_connection(_ws_frame(_WS_OPCODE_TEXT,
+                                                text.encode('utf-8')))
+                else:
+                    self.write_to_connection(_ws_frame(_WS_OPCODE_BINARY,
+                                                    data))
+        except OSError as e:
+            logger.info("Live view client left: %s", e)
+        finally:
+            live.unsubscribe(sub)
+            
+    def send_file_part(self, path, offset, length):
+        # sendfile from path to connection, paced by arbiter.
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < offset + length:
+                raise OSError("{0} changed size".format(path))
+            sock_fd = self.connection.fileno()
+            end = offset + length
+            while offset < end:
+                n = min(_SEND_CHUNK_BYTES, end - offset)
+                arbiter.downloads.acquire(n)
+                sent = os.sendfile(sock_fd, f.fileno(), offset, n)
+                if sent == 0:
+                    raise OSError("{0} truncated".format(path))
+                offset += sent
+                metrics.http_bytes.inc(sent)
+        
     def send_file_range(self, fileobj, length):
         # file is already seeked
-        # copy in chunks 
-        
-        bs = length
-        if length > io.DEFAULT_BUFFER_SIZE:
-            bs = io.DEFAULT_BUFFER_SIZE
+        # copy in chunks, each read takes budget from arbiter
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fileobj.fileno(), 0, 0, 
+                            os.POSIX_FADV_SEQUENTIAL)
         
         total_bytes_copied = 0
         while total_bytes_copied < length:
-            # read is buffered: len(d) == bs
-            if bs >= (length - total_bytes_copied):
-                d = fileobj.read(bs)
-            else:
-                d = fileobj.read(length - total_bytes_copied)
-                
+            bs = min(_SEND_CHUNK_BYTES, length - total_bytes_copied)
+            arbiter.downloads.acquire(bs)
+            d = fileobj.read(bs)
             if len(d) == 0:
                 break
             self.write_to_connection(d)
-            total_bytes_copied += bs
+            total_bytes_copied += len(d)
         
     def write_to_connection(self, data):
         # writing to socket may write less data
@@ -336,13 +800,24 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
         
         rec_table_rows = ''
         serial_no = 0;
-        rec_files = glob.glob(config.RECORDS_LOCATION + '/*' 
-                        + config.RECORD_FORMAT_EXTENSION)
-        rec_files.sort(key=os.path.getmtime, reverse=True)
+        # Records of loop ring, either location with tiered storage.
+        rec_files = []
+        for path in catalog.ring_paths():
+            try:
+                rec_files.append((os.path.getmtime(path), path))
+            except OSError:
+                # Moved or deleted in between.
+                pass
+        rec_files = [p for t, p in sorted(rec_files, reverse=True)]
         
         for record in rec_files:
             rec_filename = pathlib.Path(record).name
             serial_no += 1
+            # Records failing scrubber check are marked.
+            rec_label = rec_filename
+            if scrub.get_error(rec_filename):
+                rec_label += " (damaged: {0})".format(
+                                scrub.get_error(rec_filename))
             rec_table_rows += """
                      <tr>
                             <td>{0}</td>
@@ -351,12 +826,36 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
                                 title="Play Record" 
                                 onclick='play_rec("{3}");'>
                                 &#9658;</button></td>
+                            <td><a href="lock-record?f={1}"
+                                title="Keep from being overwritten"
+                                >Lock</a></td>
                      </tr>
                     """.format(serial_no, rec_filename, 
-                                rec_filename, rec_filename)
+                                rec_label, rec_filename)
         
         page = page.replace('_REC_TABLE_ROWS', rec_table_rows)
         
+        protected_rows = ''
+        for rec_filename in reversed(protect.list_names()):
+            protected_rows += """
+                     <tr>
+                            <td><a href="get-record?f={0}">{0}</a></td>
+                            <td><button class="pbutton" 
+                                title="Play Record" 
+                                onclick='play_rec("{0}");'>
+                                &#9658;</button></td>
+                            <td><a href="unlock-record?f={0}"
+                                title="Return to loop recording"
+                                >Unlock</a></td>
+                     </tr>
+                    """.format(rec_filename)
+        
+        summary = protect.get_summary()
+        page = page.replace('_PROTECTED_TABLE_ROWS', protected_rows)
+        page = page.replace('_PROTECTED_USAGE', "{0} of {1} MB used".format(
+                                summary['used_bytes'] // (1024 * 1024),
+                                summary['quota_bytes'] // (1024 * 1024)))
+        
         self.send_header('Content-Length', str(len(page)))
         self.send_no_cache()
         self.end_headers()
@@ -378,7 +877,7 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
         page = page.replace('_STATUS_TEXT', recorder.recording_status_text)
         
         # Update SoC temperature
-        cpu_temp = util.get_cpu_temperature()
+        cpu_temp = hal.thermal.get_cpu_temperature()
         page = page.replace('_STEMP', str(cpu_temp) + "&deg;C")
         
         # Caluclate program uptime not system.
@@ -404,6 +903,7 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
             str(disk_space_used_percent) + '%')
         page = page.replace('_N_LOOPS',
             str(recorder.n_loops))
+        page = page.replace('_SD_WEAR', self.sd_wear_text())
         page = page.replace('_CURR_REC',
             str(recorder.current_record_name))
         
@@ -418,6 +918,7 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
             
         page = page.replace('_WEB_COMMANDS', 
                 '<a href="view-records">View/Download Records</a>' 
+                + '<a href="live-view">Live View</a>' 
                 + '<a href="/rotate">Rotate 90&deg; &#x21bb;</a>' 
                 + rec_control
                 + '<a href="/reboot">Reboot</a>' 
@@ -431,6 +932,95 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
         
         self.wfile.write(bytes(page, "utf8"))
     
+    def sd_wear_text(self):
+        w = wear.get_summary()
+        text = "{0} MB written".format(w['host_bytes'] // (1024*1024))
+        if w['write_amplification'] is not None:
+            text += ", amplification {0}".format(w['write_amplification'])
+        if w['endurance_used_percent'] is not None:
+            text += ", {0}% of endurance used".format(
+                            w['endurance_used_percent'])
+        if w['estimated_days_left'] is not None:
+            text += ", about {0} days left".format(w['estimated_days_left'])
+        return text
+        
+    def serve_status(self):
+        # Machine readable recorder status including frame and writer
+        # counters of current and last segment.
+        status = {
+            'version': config.SOFTWARE_VERSION,
+            'recording_on': recorder.recording_on,
+            'status_text': recorder.recording_status_text,
+            'current_record': recorder.current_record_name,
+            'last_record': recorder.last_recorded_name,
+            'n_loops': recorder.n_loops,
+            'cpu_temp': hal.thermal.get_cpu_temperature(),
+            'disk_space_used_percent': recorder.get_disk_space_info(),
+            'sd_wear': wear.get_summary(),
+            'protected': protect.get_summary(),
+            'card_health': scrub.get_summary(),
+            'current_segment': recorder.get_current_segment_stats(),
+            'last_segment': recorder.last_segment_stats
+        }
+        
+        body = bytes(json.dumps(status), "utf8")
+        self.send_response(_HTTP_STATUS_CODE_OK)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_no_cache()
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def serve_metrics(self):
+        body = bytes(metrics.render(), "utf8")
+        self.send_response(_HTTP_STATUS_CODE_OK)
+        self.send_header('Content-type', _METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_no_cache()
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def serve_trace(self):
+        # Recent recording spans in Chrome trace format.
+        if not tracing.enabled:
+            self.send_error(_HTTP_STATUS_CODE_NOT_FOUND,
+                        explain="Tracing is disabled, see config.TRACE_ENABLED")
+            return
+        
+        body = bytes(json.dumps(tracing.export_chrome_trace()), "utf8")
+        self.send_response(_HTTP_STATUS_CODE_OK)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Disposition', 
+                        "attachment;filename=dashcam-trace.json")
+        self.send_header('Content-Length', str(len(body)))
+        self.send_no_cache()
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def is_not_modified(self, etag, mtime):
+        # Conditional GET, If-None-Match wins over If-Modified-Since.
+        if 'If-None-Match' in self.headers.keys():
+            tags = [t.strip() for t in 
+                    self.headers['If-None-Match'].split(',')]
+            return '*' in tags or etag in tags or ('W/' + etag) in tags
+        since = self.headers.get('If-Modified-Since')
+        if since is None or mtime is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # Header has whole seconds.
+        return int(mtime) <= since
+        
+    def send_validators(self, etag, mtime):
+        # Headers of content that never changes.
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', 
+                        email.utils.formatdate(mtime, usegmt=True))
+        self.send_header('Cache-Control', 'public, max-age={0}, immutable'
+                        .format(config.HTTP_IMMUTABLE_MAX_AGE_SEC))
+        
     def send_no_cache(self):
         self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
         self.send_header('Expires', '0')
@@ -470,6 +1060,24 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
             logger.error(e)
 
 
+def _ws_frame(opcode, payload):
+    # Unmasked server frame.
+    n = len(payload)
+    if n < 126:
+        header = struct.pack('>BB', 0x80 | opcode, n)
+    elif n < 65536:
+        header = struct.pack('>BBH', 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 127, n)
+    return header + payload
+
+def _file_etag(name, st):
+    # Strong ETag of a finished file from record index (or name),
+    # size and modification time.
+    index = catalog.parse_index(name)
+    tag = str(index) if index is not None else name
+    return '"{0}-{1:x}-{2:x}"'.format(tag, st.st_size, st.st_mtime_ns)
+
 class ThreadingWebServer(ThreadingMixIn, HTTPServer):
     # Make each request handler run in its own thread.
     # Improves browser performance and user experience.
@@ -482,6 +1090,7 @@ def _start_webserver():
 
 def start():
     # called from main module
+    export.init()
     th = threading.Thread(target=_start_webserver)
     th.daemon = True
     th.start()